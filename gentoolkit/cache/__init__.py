@@ -2,7 +2,9 @@
 """
 Модуль доступа к серверу memcached.
 
-Данные хранятся в формате JSON.
+По умолчанию данные хранятся в формате JSON, формат сериализации и сжатие
+настраиваются для подключения и для отдельных namespace
+(см. `gentoolkit.cache.codecs`).
 
 Доступ к конкретному подключению::
 
@@ -23,7 +25,40 @@
                 // флаг хеширования ключей алгоритмом md5
                 "hash_keys": false,
                 // время жизни ключа по умолчанию
-                "ttl": 60
+                "ttl": 60,
+                // поколения namespace, см. `Connection.invalidate_namespace`
+                "namespace_generations": false,
+                // время локального кеширования поколения namespace
+                "generation_ttl": 1,
+                // кольцо консистентного хеширования (см. `gentoolkit.cache.ring`)
+                "ring": {"points": 160, "hot_threshold": 1000, "hot_replicas": 2},
+                // выборка горячих ключей (см. `gentoolkit.cache.sampler`)
+                "sampler": {"rate": 0.01, "capacity": 64, "interval": 60},
+                // метрики по namespace (см. `gentoolkit.cache.metrics`)
+                "metrics": true,
+                // автоматический выключатель (см. `gentoolkit.cache.breaker`)
+                "breaker": {"threshold": 5, "cooldown": 10, "secondary": []},
+                // снимок горячих данных для прогрева (см. `gentoolkit.cache.warmup`)
+                "warmup": {"rate": 0.01, "capacity": 1000, "path": "..."},
+                // пул клиентов (см. `gentoolkit.cache.pool`)
+                "pool": {"type": "checkout", "size": 8, "wait": 0.5},
+                // максимальный размер значения, сохраняемого одним ключом,
+                // большие значения сохраняются частями (см. `gentoolkit.cache.chunks`)
+                "chunk_size": 1000000,
+                // максимальное количество ключей в одном запросе get_multi
+                "multi_chunk_size": 1000,
+                // кодек значений (см. `gentoolkit.cache.codecs`)
+                "codec": "json",
+                "namespace_codecs": {},
+                "compression": {"method": "zlib", "threshold": 1024},
+                // локальный кеш процесса (см. `gentoolkit.cache.local`)
+                "local": {
+                    "max_entries": 1024,
+                    "max_bytes": 1048576,
+                    "ttl": 5
+                },
+                // разделяемый кеш экземпляров пула (см. `gentoolkit.cache.shared`)
+                "shared": {"ttl": 60}
             },
             // список заблокированных namespaces
             "disabled": [
@@ -34,46 +69,167 @@
 """
 
 import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
 from functools import wraps
 from hashlib import md5
 
 import pylibmc
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
 
 from gentoolkit.config import Proxy
-from gentoolkit import extjson as json
+from gentoolkit.profiler import Profiler
+
+from . import chunks
+from .breaker import BreakerPool, FailoverPool, LOG_INTERVAL, RateLimitedLog
+from .codecs import Serializer, UnknownCodec
+from .local import LocalCache
+from .metrics import ConnectionMetrics
+from .pool import create_pool
+from .ring import RingClient
+from .sampler import KeySampler
+from . import shared
+from . import warmup
 
 
 DEFAULT_NAMESPACE = ''
 
 
-def cached(key, namespace=None, ttl=None, conn_name=None):
+class _Missing(object):
+    """
+    Служебный класс
+    """
+
+    def __repr__(self):
+        return "cache.MISSING"
+
+    def __nonzero__(self):
+        return False
+
+
+#: признак отсутствия значения в кеше, см. `Connection.get`
+MISSING = _Missing()
+
+#: служебный ключ значения, сохраненного с мягким временем жизни
+ENVELOPE_KEY = '__expires__'
+
+#: максимальное количество ключей в одном запросе get_multi
+MULTI_CHUNK_SIZE = 1000
+
+#: namespace ключей поколений
+GENERATION_NAMESPACE = '__generation__'
+
+#: namespace ключей версий тегов
+TAG_NAMESPACE = '__tag__'
+
+#: служебный ключ значения, сохраненного с тегами
+TAGS_KEY = '__tags__'
+
+#: время локального кеширования поколения namespace
+GENERATION_TTL = 1
+
+#: интервал опроса кеша в ожидании пересчета значения
+LOCK_POLL_INTERVAL = 0.05
+
+
+def cached(key, namespace=None, ttl=None, conn_name=None,
+           lock=False, lock_ttl=10, lock_wait=1.0, stale_ttl=None,
+           beta=None, tags=None, negative_ttl=None):
     """
     Декоратор для кеширования результата вызова функции.
 
+    В режиме `lock` (single-flight) значение хранится вместе с мягким
+    временем жизни. После его истечения значение пересчитывает только
+    один вызов, захвативший `Mutex`, остальные получают устаревшее
+    значение, а при его отсутствии ожидают результат не дольше `lock_wait`
+    секунд, опрашивая кеш.
+
+    Параметр `beta` включает вероятностный досрочный пересчет (XFetch):
+    значение пересчитывается до истечения времени жизни с вероятностью,
+    которая растет по мере приближения к нему и пропорциональна длительности
+    последнего вычисления. Чем больше `beta`, тем раньше пересчет, значение
+    1.0 подходит в большинстве случаев.
+
+    Параметр `negative_ttl` включает кеширование результата `None` на
+    отдельное (как правило, более короткое) время, чтобы запросы
+    несуществующих объектов не доходили до источника данных.
+
+    Корутины Tornado кешируются через неблокирующее подключение
+    (см. `gentoolkit.cache.asynchronous.cached_async`), одновременные
+    вызовы с одинаковым ключом выполняют одно вычисление. Режимы `lock`,
+    `beta` и `tags` для корутин не поддерживаются.
+
     :param str key: ключ
     :param str namespace: namespace для формирования ключа
     :param int ttl: время жизни кеша
     :param str conn_name: название подключения к серверу memcached
+    :param bool lock: защита от одновременного пересчета значения
+    :param int lock_ttl: время жизни блокировки пересчета
+    :param float lock_wait: время ожидания пересчета другим процессом
+    :param int stale_ttl: время хранения устаревшего значения, в режиме `lock` по умолчанию `ttl`
+    :param float beta: коэффициент досрочного пересчета
+    :param list|callable tags: теги значения или функция их формирования, см. `Connection.invalidate_tags`
+    :param int negative_ttl: время жизни результата `None`
 
     :return: Any
     """
     def dec(func):
+        if gen.is_coroutine_function(func):
+            if lock or beta or tags:
+                raise ValueError(
+                    "lock, beta and tags are not supported for coroutine %s" %
+                    func.__name__
+                )
+            from .asynchronous import cached_async
+            return cached_async(
+                key, namespace=namespace, ttl=ttl, conn_name=conn_name,
+                negative_ttl=negative_ttl
+            )(func)
+        func_id = warmup.function_id(func)
+
         @wraps(func)
         def inner_dec(*args, **kwargs):
             try:
                 conn = instance[conn_name]
+                if conn.recorder is not None:
+                    conn.recorder.record(func_id, args, kwargs)
                 if conn.enabled(namespace) and key:
                     key_str = key
                     if callable(key):
                         key_str = key(*args, **kwargs)
-                    value = conn.get(key_str, namespace=namespace)
-                    if value is None:
+                    tags_list = tags
+                    if callable(tags):
+                        tags_list = tags(*args, **kwargs)
+                    if lock or beta:
+                        return _cached_envelope(
+                            conn, conn_name, key_str, namespace,
+                            ttl or conn.config.ttl,
+                            lambda: func(*args, **kwargs),
+                            lock=lock, lock_ttl=lock_ttl,
+                            lock_wait=lock_wait, stale_ttl=stale_ttl,
+                            beta=beta, tags=tags_list,
+                            negative_ttl=negative_ttl
+                        )
+                    value = conn.get(
+                        key_str, namespace=namespace, tags=tags_list,
+                        default=MISSING
+                    )
+                    if value is None and not negative_ttl:
+                        value = MISSING
+                    if value is MISSING:
                         value = func(*args, **kwargs)
-                        if value is not None:
+                        if value is not None or negative_ttl:
                             conn.set(
                                 key_str, value,
                                 namespace=namespace,
-                                ttl=ttl
+                                ttl=ttl if value is not None else negative_ttl,
+                                tags=tags_list
                             )
                     return value
             except NotConfigured, e:
@@ -81,10 +237,173 @@ def cached(key, namespace=None, ttl=None, conn_name=None):
             except Exception as exc:
                 logging.exception("Fail to cache result of %s", func.__name__)
             return func(*args, **kwargs)
+        warmup.register(func_id, inner_dec)
+        return inner_dec
+    return dec
+
+
+def cached_multi(key, namespace=None, ttl=None, conn_name=None,
+                 negative_ttl=None):
+    """
+    Декоратор для поэлементного кеширования результата функции, которая
+    принимает первым аргументом список идентификаторов и возвращает список
+    записей в том же порядке.
+
+    Значения для всех идентификаторов читаются одним `get_multi`, функция
+    вызывается только для отсутствующих в кеше идентификаторов, результаты
+    записываются одним `set_multi`. Порядок результата совпадает с порядком
+    идентификаторов.
+
+    Пример::
+
+        @cached_multi(lambda pk: "user:%s" % pk, conn_name="default")
+        def get_users(ids):
+            return [load_user(pk) for pk in ids]
+
+    :param str|callable key: функция формирования ключа элемента или префикс ключа
+    :param str namespace: namespace для формирования ключа
+    :param int ttl: время жизни кеша
+    :param str conn_name: название подключения к серверу memcached
+    :param int negative_ttl: время жизни результата `None`, по умолчанию `None` не кешируется
+
+    :return: list
+    """
+    def dec(func):
+        @wraps(func)
+        def inner_dec(ids, *args, **kwargs):
+            ids = list(ids)
+            try:
+                conn = instance[conn_name]
+                if conn.enabled(namespace) and key:
+                    if callable(key):
+                        keys = [key(i) for i in ids]
+                    else:
+                        keys = ["%s:%s" % (key, i) for i in ids]
+                    found, _ = conn.get_many(keys, namespace=namespace)
+                    if not negative_ttl:
+                        found = dict(
+                            (k, v) for k, v in found.items() if v is not None
+                        )
+                    missed = []
+                    missed_keys = []
+                    seen = set()
+                    for i, k in zip(ids, keys):
+                        if k not in found and k not in seen:
+                            seen.add(k)
+                            missed.append(i)
+                            missed_keys.append(k)
+                    if missed:
+                        computed = dict(zip(missed_keys, func(missed, *args, **kwargs)))
+                        found.update(computed)
+                        values = dict(
+                            (k, v) for k, v in computed.items() if v is not None
+                        )
+                        if values:
+                            conn.set_multi(values, namespace=namespace, ttl=ttl)
+                        negative = dict(
+                            (k, None) for k, v in computed.items() if v is None
+                        )
+                        if negative and negative_ttl:
+                            conn.set_multi(
+                                negative, namespace=namespace, ttl=negative_ttl
+                            )
+                    return [found.get(k) for k in keys]
+            except NotConfigured, e:
+                logging.error(str(e))
+            except Exception as exc:
+                logging.exception("Fail to cache result of %s", func.__name__)
+            return func(ids, *args, **kwargs)
         return inner_dec
     return dec
 
 
+def _cached_envelope(conn, conn_name, key, namespace, ttl, compute,
+                     lock=False, lock_ttl=10, lock_wait=1.0, stale_ttl=None,
+                     beta=None, tags=None, negative_ttl=None):
+    """
+    Получить значение, сохраненное вместе с мягким временем жизни и
+    длительностью вычисления, с защитой от одновременного пересчета.
+    """
+    found, value, expires, delta = _unpack(
+        conn.get(key, namespace=namespace, tags=tags)
+    )
+    if found and not _should_refresh(expires, delta, beta):
+        return value
+    if stale_ttl is None:
+        stale_ttl = ttl if lock else 0
+
+    def refresh():
+        started = time.time()
+        value = compute()
+        if value is not None:
+            conn.set(
+                key, _envelope(value, ttl, time.time() - started),
+                namespace=namespace,
+                ttl=ttl + stale_ttl,
+                tags=tags
+            )
+        elif negative_ttl:
+            conn.set(
+                key, _envelope(None, negative_ttl, time.time() - started),
+                namespace=namespace,
+                ttl=negative_ttl,
+                tags=tags
+            )
+        return value
+
+    if not lock:
+        return refresh()
+    mutex = Mutex(conn_name, "%s:lock" % key, namespace, ttl=lock_ttl)
+    if mutex.lock():
+        try:
+            return refresh()
+        finally:
+            mutex.release()
+    if found:
+        return value
+    deadline = time.time() + lock_wait
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        found, value, _, _ = _unpack(
+            conn.get(key, namespace=namespace, tags=tags)
+        )
+        if found:
+            return value
+    return compute()
+
+
+def _should_refresh(expires, delta, beta):
+    """
+    Необходимость пересчета значения. Досрочный пересчет выполняется с
+    вероятностью `exp(-(expires - now) / (delta * beta))`.
+    """
+    now = time.time()
+    if now >= expires:
+        return True
+    if beta and delta:
+        return now - delta * beta * math.log(1.0 - random.random()) >= expires
+    return False
+
+
+def _envelope(value, ttl, delta=0):
+    """
+    Упаковать значение вместе с мягким временем жизни и длительностью
+    вычисления.
+    """
+    return {ENVELOPE_KEY: time.time() + ttl, "value": value, "delta": delta}
+
+
+def _unpack(data):
+    """
+    Распаковать значение, сохраненное `_envelope`.
+
+    :return: tuple (found, value, expires, delta)
+    """
+    if isinstance(data, dict) and ENVELOPE_KEY in data:
+        return True, data.get("value"), data[ENVELOPE_KEY], data.get("delta", 0)
+    return False, None, 0, 0
+
+
 class NotConfigured(Exception):
     """
     Исключение. Информация о подключении не найдена.
@@ -152,7 +471,7 @@ class Backend(object):
                 }
             )
             raise NotConfigured(name)
-        return Connection(
+        return self.create_connection(
             Proxy(
                 {
                     "params": {},
@@ -163,30 +482,313 @@ class Backend(object):
             )
         )
 
+    def create_connection(self, config):
+        """
+        Создать подключение по настройкам.
+
+        :param Proxy config: настройки подключения
+
+        :return: Connection
+        """
+        return Connection(config)
+
 
 instance = Backend()
 
 
-class Connection(object):
+def hot_keys(conn_name=None, limit=None):
     """
-    Адаптер подключения к серверу memcached.
+    Горячие ключи подключений с включенной выборкой
+    (см. `gentoolkit.cache.sampler`). Предназначено для просмотра из manhole.
+
+    :param str conn_name: название подключения, по умолчанию все открытые
+    :param int limit: количество ключей
+
+    :return: dict {подключение: {namespace: {вид статистики: [(ключ, оценка)]}}}
+    """
+    return dict(
+        (name, conn.sampler.report(limit))
+        for name, conn in _connections(conn_name).items()
+        if getattr(conn, 'sampler', None) is not None
+    )
+
+
+def metrics_report(conn_name=None):
+    """
+    Метрики подключений по namespace (см. `gentoolkit.cache.metrics`).
+
+    :param str conn_name: название подключения, по умолчанию все открытые
+
+    :return: dict {подключение: {namespace: метрики}}
+    """
+    return dict(
+        (name, conn.metrics.report())
+        for name, conn in _connections(conn_name).items()
+        if getattr(conn, 'metrics', None) is not None
+    )
+
+
+def flush_metrics(profiler=None, prefix="cache"):
+    """
+    Отправить метрики открытых подключений в profiler и сбросить их.
+
+    :param Profiler profiler: профайлер
+    :param str prefix: префикс метрик
+    """
+    profiler = profiler or Profiler()
+    for name, conn in _connections().items():
+        if getattr(conn, 'metrics', None) is not None:
+            conn.metrics.flush(profiler, "%s.%s" % (prefix, name))
+    profiler.flush()
+
+
+def attach_metrics(handler, interval=60):
+    """
+    Периодически отправлять метрики подключений в profiler, включать их в
+    отчет обработчика под ключом `cache` и отправить при завершении сервиса.
+
+    :param services.Handler handler: обработчик сервиса
+    :param float interval: интервал отправки в секундах
+
+    :return: PeriodicCallback
+    """
+    def flush():
+        try:
+            flush_metrics()
+        except Exception as exc:
+            logging.exception("Cache metrics flush fail")
+
+    periodic = PeriodicCallback(flush, interval * 1000)
+    periodic.start()
+    handler.add_report_callback('cache', metrics_report)
+    handler.add_stop_callback(periodic.stop)
+    handler.add_stop_callback(flush)
+    return periodic
+
+
+def _connections(conn_name=None):
+    """
+    Открытые подключения.
+
+    :param str conn_name: название подключения
+
+    :return: dict {название: подключение}
+    """
+    if conn_name:
+        return {conn_name: instance[conn_name]}
+    return dict(
+        (name, conn) for name, conn in instance.__dict__.items()
+        if isinstance(conn, BaseConnection)
+    )
+
+
+class BaseConnection(object):
+    """
+    Общая часть подключений к серверу memcached: формирование ключей,
+    сериализация значений, статус namespace.
     """
 
     disabled_config = Proxy(
-        {},
-        "cache.disabled"
+        {"disabled": []},
+        "cache"
     )
 
+    #: (ревизия настроек, заблокированные namespaces)
+    _disabled = (None, frozenset())
+
     def __init__(self, config):
-        super(Connection, self).__init__()
+        super(BaseConnection, self).__init__()
         self.config = config
+        self._key_settings = None
+        compression = self.config.get("compression", None) or {}
+        namespace_codecs = self.config.get("namespace_codecs", {})
+        self.serializer = Serializer(
+            self.config.get("codec", "json"),
+            compression=compression.get("method"),
+            threshold=compression.get("threshold", 1024),
+            accept=namespace_codecs.values()
+        )
+        self.namespace_serializers = {
+            ns: Serializer(
+                codec,
+                compression=compression.get("method"),
+                threshold=compression.get("threshold", 1024)
+            )
+            for ns, codec in namespace_codecs.items()
+        }
+
+    def dumps(self, value, namespace=None):
+        """
+        Сериализация значения кодеком namespace или подключения.
+
+        :param value: значение
+        :param str namespace: namespace
+
+        :return: str
+        """
+        return self.namespace_serializers.get(
+            namespace, self.serializer
+        ).dumps(value)
+
+    def loads(self, data):
+        """
+        Десериализация значения. Формат определяется по заголовку значения,
+        допустимы json и кодеки из настроек подключения.
+
+        :param str data: сериализованное значение
+
+        :return: Any|MISSING значение или `MISSING`, если формат недопустим
+        """
+        try:
+            return self.serializer.loads(data)
+        except UnknownCodec as exc:
+            logging.warning(
+                "Cache value ignored at server %s: %s", self.config.host, exc
+            )
+            return MISSING
+
+    @classmethod
+    def enabled(cls, namespace):
+        """
+        Статус аспекта/namespace.
+
+        :param str namespace: namespace для формирования ключа
+
+        :return: Bool
+        """
+        if not namespace:
+            return True
+        return namespace not in cls.disabled_namespaces()
+
+    @classmethod
+    def disabled_namespaces(cls):
+        """
+        Множество заблокированных namespaces. Пересчитывается только при
+        смене настроек.
+
+        :return: frozenset
+        """
+        revision = cls.disabled_config.get_revision()
+        if cls._disabled[0] != revision:
+            cls._disabled = (
+                revision,
+                frozenset(cls.disabled_config.get("disabled", []) or [])
+            )
+        return cls._disabled[1]
+
+    @property
+    def key_settings(self):
+        """
+        Снимок настроек формирования ключей. Пересчитывается только при
+        смене настроек.
+
+        :return: KeySettings
+        """
+        settings = self._key_settings
+        revision = self.config.get_revision()
+        if settings is None or settings.revision != revision:
+            settings = self._key_settings = KeySettings(
+                revision,
+                self.config.get("cache_prefix", "") or "",
+                bool(self.config.get("hash_keys", False)),
+                bool(self.config.get("namespace_generations", False)),
+                self.config.get("generation_ttl", GENERATION_TTL)
+            )
+        return settings
+
+    def normalise_key(self, namespace, key):
+        """
+        Нормализация ключа. Проверять необходимость добавления префикса,
+        хеширования ключей (md5).
+
+        :param str namespace: namespace для формирования ключа
+        :param str|list key: ключ или список ключей
+
+        :return: str|list
+        """
+        settings = self.key_settings
+        if isinstance(namespace, unicode):
+            namespace = namespace.encode('utf-8')
+        if isinstance(key, (list, tuple)):
+            return [_normalise(settings, namespace, k) for k in key]
+        return _normalise(settings, namespace, key)
+
+
+class Connection(BaseConnection):
+    """
+    Адаптер подключения к серверу memcached.
+    """
+
+    def __init__(self, config):
+        super(Connection, self).__init__(config)
         self.params = {
             k: self.config.params.get(k)
             for k in self.config.params
         }
-        self.__conn = pylibmc.Client(config.host, **self.params)
+        self.pool = create_pool(
+            self.__create_client(config.host), self.config.get("pool", None)
+        )
+        breaker = self.config.get("breaker", None)
+        if breaker is not None:
+            self.pool = self.__protect(self.pool, config.host, breaker)
+            if breaker.get("secondary"):
+                self.pool = FailoverPool(self.pool, self.__protect(
+                    create_pool(
+                        self.__create_client(breaker["secondary"]),
+                        self.config.get("pool", None)
+                    ),
+                    breaker["secondary"],
+                    breaker
+                ))
+        self.log = RateLimitedLog(
+            (breaker or {}).get("log_interval", LOG_INTERVAL)
+        )
+        # namespace -> (поколение, время устаревания)
+        self.__generations = {}
+        self.chunk_size = self.config.get("chunk_size", chunks.CHUNK_SIZE)
+        # статистика `update`
+        self.update_stats = {'updates': 0, 'retries': 0, 'failures': 0}
+        local = self.config.get("local", None)
+        self.local = LocalCache(**local) if local else None
+        self.__share(self.config.get("shared", None))
+        sampler = self.config.get("sampler", None)
+        self.sampler = KeySampler(**sampler) if sampler else None
+        self.metrics = (
+            ConnectionMetrics() if self.config.get("metrics", True) else None
+        )
+        recorder = self.config.get("warmup", None)
+        self.recorder = warmup.Recorder(**recorder) if recorder else None
+
+    def __create_client(self, hosts):
+        ring = self.config.get("ring", None)
+        if ring is not None:
+            return RingClient(hosts, ring, self.params)
+        return pylibmc.Client(hosts, **self.params)
+
+    def __share(self, config):
+        if not config:
+            return
+        segment = shared.segment()
+        if segment is None:
+            logging.warning(
+                "Shared cache is not created for %s, skipped", self.config.host
+            )
+            return
+        self.local = shared.TieredCache(
+            self.local, segment,
+            prefix=md5(",".join(self.config.host)).hexdigest()[:8] + ":",
+            ttl=config.get("ttl") if isinstance(config, dict) else None
+        )
+
+    @staticmethod
+    def __protect(pool, hosts, config):
+        return BreakerPool(
+            pool, ",".join(hosts),
+            threshold=config.get("threshold", 5),
+            cooldown=config.get("cooldown", 10)
+        )
 
-    def set(self, key, value, namespace=None, ttl=None):
+    def set(self, key, value, namespace=None, ttl=None, tags=None):
         """
         Добавить значение в кеш.
 
@@ -194,47 +796,85 @@ class Connection(object):
         :param value: значение
         :param str namespace: namespace для формирования ключа
         :param int ttl: время жизни кеша
+        :param list tags: теги значения, см. `invalidate_tags`
 
         :return: Bool
         """
         namespace = namespace or DEFAULT_NAMESPACE
         if self.enabled(namespace) and key:
-            key = self.normalise_key(namespace, key)
+            origin, key = key, self.normalise_key(namespace, key)
             logging.debug(
                 "cache::set %s, ttl=%d, namespace=%s",
                 key,
                 ttl if ttl else self.config.ttl,
                 namespace
             )
+            ttl = ttl if ttl else self.config.ttl
+            started = time.time()
             try:
-                self.__conn.set(
-                    key, json.dumps(value),
-                    time=ttl if ttl else self.config.ttl
-                )
+                if tags:
+                    value = {TAGS_KEY: self.tag_versions(tags), "value": value}
+                value = self.dumps(value, namespace)
+                if self.sampler is not None:
+                    self.sampler.record('writes', namespace, origin, len(value))
+                with self.pool.reserve() as mc:
+                    if len(value) > self.chunk_size:
+                        if self.__store_chunked(mc, {key: value}, ttl):
+                            raise chunks.ChunkError(
+                                "fail to store chunks of %s" % key
+                            )
+                    else:
+                        mc.set(key, value, time=ttl)
+                if self.local is not None:
+                    self.local.set(key, value, ttl)
+                self._observe(namespace, 'set', started, sizes=[len(value)])
                 return True
             except Exception as exc:
-                logging.exception(
+                if self.local is not None:
+                    self.local.delete(key)
+                self._observe(namespace, 'set', started, error=True)
+                self.log.exception(
                     "fail to set value at server %s", self.config.host
                 )
         return False
 
-    def set_multi(self, values, namespace=None, ttl=None):
+    def set_multi(self, values, namespace=None, ttl=None, tags=None):
         """
         Добавить несколько значение в кеш.
 
         :param list|tuple values:  пары ключ/значение
         :param str namespace: namespace для формирования ключа
         :param int ttl: время жизни кеша
+        :param list tags: теги значений, см. `invalidate_tags`
 
         :return: Bool
         """
         namespace = namespace or DEFAULT_NAMESPACE
         if self.enabled(namespace) and values:
-            values = dict(
-                [
-                    (self.normalise_key(namespace, k), json.dumps(v))
+            if tags:
+                try:
+                    versions = self.tag_versions(tags)
+                except Exception as exc:
+                    self.log.exception(
+                        "fail to get tag versions at server %s",
+                        self.config.host
+                    )
+                    return False
+                values = dict(
+                    (k, {TAGS_KEY: versions, "value": v})
                     for k, v in values.items()
-                ]
+                )
+            serialized = dict(
+                (k, self.dumps(v, namespace)) for k, v in values.items()
+            )
+            if self.sampler is not None:
+                self.sampler.record_many(
+                    'writes', namespace,
+                    dict((k, len(v)) for k, v in serialized.items())
+                )
+            values = dict(
+                (self.normalise_key(namespace, k), v)
+                for k, v in serialized.items()
             )
             logging.debug(
                 "cache::set_multi %s, ttl=%d, namespace=%s",
@@ -242,52 +882,269 @@ class Connection(object):
                 ttl if ttl else self.config.ttl,
                 namespace
             )
+            ttl = ttl if ttl else self.config.ttl
+            started = time.time()
             try:
-                self.__conn.set_multi(
-                    values,
-                    time=ttl if ttl else self.config.ttl
+                with self.pool.reserve() as mc:
+                    failed = self.__store_chunked(mc, values, ttl)
+                if self.local is not None:
+                    for k, v in values.items():
+                        if failed and k in failed:
+                            self.local.delete(k)
+                        else:
+                            self.local.set(k, v, ttl)
+                self._observe(
+                    namespace, 'set_multi', started,
+                    sizes=[len(v) for v in values.values()]
                 )
                 return True
             except Exception as exc:
-                logging.exception(
+                if self.local is not None:
+                    for k in values:
+                        self.local.delete(k)
+                self._observe(namespace, 'set_multi', started, error=True)
+                self.log.exception(
                     "fail to set_multi value  at server %s", self.config.host
                 )
         return False
 
-    def get(self, key, namespace=None):
+    def get(self, key, namespace=None, tags=None, default=None):
         """
-        Получить значение из кеша.
+        Получить значение из кеша. Для списка ключей возвращает список
+        значений в том же порядке (см. `get_many`).
 
-        :param str key: ключ
+        Если значение сохранено с тегами, их версии проверяются. Переданные
+        `tags` читаются одним запросом вместе со значением, иначе версии
+        тегов запрашиваются отдельно.
+
+        Сохраненное значение `None` возвращается как `None`, при отсутствии
+        значения возвращается `default`. Чтобы отличить одно от другого,
+        передайте `default=MISSING`.
+
+        :param str|list key: ключ или список ключей
         :param str namespace: namespace для формирования ключа
+        :param list tags: теги значения
+        :param default: значение при отсутствии ключа в кеше
 
         :return: Any|None
         """
         namespace = namespace or DEFAULT_NAMESPACE
+        if isinstance(key, (list, tuple)) or tags:
+            keys = key if isinstance(key, (list, tuple)) else [key]
+            found, _ = self.get_many(keys, namespace=namespace, tags=tags)
+            if keys is key:
+                return [found.get(k, default) for k in keys]
+            return found.get(key, default)
         if self.enabled(namespace) and key:
-            key = self.normalise_key(namespace, key)
+            origin, key = key, self.normalise_key(namespace, key)
             logging.debug(
                 "cache::get %s namespace=%s",
                 key, namespace
             )
+            started = time.time()
             try:
-                if isinstance(key, (list, tuple)):
-                    values = self.__conn.get_multi(key) or {}
-                    return [
-                        json.loads(value[k]) if value.get(k, None) else None
-                        for k in key
-                    ]
-                else:
-                    ret = self.__conn.get(key)
-                    if ret:
-                        ret = json.loads(ret)
-                    return ret
+                ret = self.local.get(key) if self.local is not None else None
+                if ret is None:
+                    with self.pool.reserve() as mc:
+                        ret = mc.get(key)
+                        if chunks.is_manifest(ret):
+                            ret = self.__join_chunks(mc, {key: ret}).get(key)
+                    if ret and self.local is not None:
+                        self.local.set(key, ret, self.config.ttl)
+                if self.sampler is not None:
+                    self.sampler.record(
+                        'reads', namespace, origin, len(ret) if ret else 0
+                    )
+                if not ret:
+                    self._observe(namespace, 'get', started, misses=1)
+                    return default
+                size = len(ret)
+                ret = self.loads(ret)
+                if ret is MISSING:
+                    self._observe(namespace, 'get', started, misses=1)
+                    return default
+                if _is_tagged(ret):
+                    versions = self.__fetch_tag_versions(ret[TAGS_KEY])
+                    valid, ret = _untag(ret, versions)
+                    if not valid:
+                        self._observe(namespace, 'get', started, misses=1)
+                        return default
+                self._observe(namespace, 'get', started, hits=1, sizes=[size])
+                return ret
             except Exception as exc:
-                logging.exception(
+                self._observe(namespace, 'get', started, error=True)
+                self.log.exception(
                     "fail to get value at server %s", self.config.host
                 )
-                return None
-        return None
+        return default
+
+    def get_many(self, keys, namespace=None, tags=None):
+        """
+        Получить несколько значений из кеша.
+
+        Ключи нормализуются один раз, значения запрашиваются через
+        `get_multi` пакетами не более `multi_chunk_size` ключей. Версии
+        переданных тегов запрашиваются вместе со значениями.
+
+        :param list keys: список ключей
+        :param str namespace: namespace для формирования ключа
+        :param list tags: теги значений
+
+        :return: tuple (dict {ключ: значение}, set отсутствующих ключей)
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        found = {}
+        if not keys or not self.enabled(namespace):
+            return found, set(keys or [])
+        normalized = {}
+        for k in keys:
+            normalized[self.normalise_key(namespace, k)] = k
+        logging.debug(
+            "cache::get_many %s namespace=%s",
+            normalized.keys(), namespace
+        )
+        tag_keys = self.__tag_keys(tags or [])
+        started = time.time()
+        try:
+            values, versions = self.__get_multi(
+                normalized.keys(), tag_keys.keys()
+            )
+            versions = dict((tag_keys[k], v) for k, v in versions.items())
+            if self.sampler is not None:
+                self.sampler.record_many('reads', namespace, dict(
+                    (k, len(values.get(n) or '')) for n, k in normalized.items()
+                ))
+            tagged = {}
+            for k, value in values.items():
+                value = self.loads(value)
+                if value is MISSING:
+                    continue
+                if _is_tagged(value):
+                    tagged[normalized[k]] = value
+                else:
+                    found[normalized[k]] = value
+            if tagged:
+                missed = set()
+                for value in tagged.values():
+                    missed.update(
+                        t for t in value[TAGS_KEY] if t not in tag_keys.values()
+                    )
+                if missed:
+                    versions.update(self.__fetch_tag_versions(missed))
+                for k, value in tagged.items():
+                    valid, value = _untag(value, versions)
+                    if valid:
+                        found[k] = value
+            self._observe(
+                namespace, 'get_many', started,
+                hits=len(found), misses=len(normalized) - len(found),
+                sizes=[len(v) for v in values.values()]
+            )
+        except Exception as exc:
+            self._observe(namespace, 'get_many', started, error=True)
+            self.log.exception(
+                "fail to get_many values at server %s", self.config.host
+            )
+            found = {}
+        return found, set(k for k in keys if k not in found)
+
+    def __get_multi(self, keys, extra=()):
+        """
+        Прочитать сериализованные значения нормализованных ключей из
+        локального кеша и с сервера.
+
+        :param list keys: нормализованные ключи
+        :param list extra: служебные ключи, всегда читаются с сервера
+
+        :return: tuple (dict значений, dict служебных значений)
+        """
+        values = {}
+        if self.local is not None:
+            for k in keys:
+                value = self.local.get(k)
+                if value is not None:
+                    values[k] = value
+            keys = [k for k in keys if k not in values]
+        extra = set(extra)
+        keys = list(keys) + list(extra)
+        extra_values = {}
+        chunk_size = self.config.get("multi_chunk_size", MULTI_CHUNK_SIZE)
+        fetched_values = {}
+        with self.pool.reserve() as mc:
+            for idx in xrange(0, len(keys), chunk_size):
+                fetched = mc.get_multi(keys[idx:idx + chunk_size]) or {}
+                for k, value in fetched.items():
+                    if not value:
+                        continue
+                    if k in extra:
+                        extra_values[k] = value
+                        continue
+                    fetched_values[k] = value
+            manifests = dict(
+                (k, v) for k, v in fetched_values.items()
+                if chunks.is_manifest(v)
+            )
+            if manifests:
+                for k in manifests:
+                    del fetched_values[k]
+                fetched_values.update(self.__join_chunks(mc, manifests))
+        values.update(fetched_values)
+        if self.local is not None:
+            for k, value in fetched_values.items():
+                self.local.set(k, value, self.config.ttl)
+        return values, extra_values
+
+    def __store_chunked(self, mc, values, ttl):
+        """
+        Сохранить сериализованные значения одним `set_multi`. Значения
+        больше `chunk_size` сохраняются частями (см. `gentoolkit.cache.chunks`).
+
+        :param mc: клиент memcached
+        :param dict values: нормализованный ключ -> сериализованное значение
+        :param int ttl: время жизни
+
+        :return: list ключи несохраненных значений
+        """
+        parents = {}
+        batch = {}
+        for k, value in values.items():
+            if len(value) > self.chunk_size:
+                manifest, parts = chunks.split(k, value, self.chunk_size)
+                batch.update(parts)
+                parents.update((part, k) for part in parts)
+                value = manifest
+            batch[k] = value
+        failed = mc.set_multi(batch, time=ttl) or []
+        if not parents:
+            return failed
+        failed = set(parents.get(k, k) for k in failed)
+        broken = [k for k in failed if k in parents.values()]
+        if broken:
+            mc.delete_multi(broken)
+        return list(failed)
+
+    def __join_chunks(self, mc, manifests):
+        """
+        Прочитать части значений одним `get_multi` и собрать значения.
+        Значения с отсутствующими или поврежденными частями пропускаются.
+
+        :param mc: клиент memcached
+        :param dict manifests: нормализованный ключ -> манифест
+
+        :return: dict нормализованный ключ -> сериализованное значение
+        """
+        keys = []
+        for k, manifest in manifests.items():
+            keys.extend(chunks.chunk_keys(k, manifest))
+        fetched = mc.get_multi(keys) or {}
+        ret = {}
+        for k, manifest in manifests.items():
+            value = chunks.join(k, manifest, fetched)
+            if value is None:
+                logging.warning("cache::chunks %s torn or expired", k)
+                continue
+            ret[k] = value
+        return ret
 
     def add(self, key, value, namespace=None, ttl=None):
         """
@@ -302,20 +1159,28 @@ class Connection(object):
         """
         namespace = namespace or DEFAULT_NAMESPACE
         if self.enabled(namespace) and key:
-            key = self.normalise_key(namespace, key)
+            origin, key = key, self.normalise_key(namespace, key)
             logging.debug(
                 "cache::add %s, timeout=%d, namespace=%s",
                 key,
                 ttl if ttl else self.config.ttl,
                 namespace
             )
+            ttl = ttl if ttl else self.config.ttl
+            started = time.time()
             try:
-                return self.__conn.add(
-                    key, json.dumps(value),
-                    time=ttl if ttl else self.config.ttl
-                )
+                value = self.dumps(value, namespace)
+                if self.sampler is not None:
+                    self.sampler.record('writes', namespace, origin, len(value))
+                with self.pool.reserve() as mc:
+                    added = mc.add(key, value, time=ttl)
+                if added and self.local is not None:
+                    self.local.set(key, value, ttl)
+                self._observe(namespace, 'add', started, sizes=[len(value)])
+                return added
             except Exception as exc:
-                logging.exception(
+                self._observe(namespace, 'add', started, error=True)
+                self.log.exception(
                     "fail to add value at server %s", self.config.host
                 )
         return False
@@ -336,14 +1201,20 @@ class Connection(object):
                 "cache::delete %s namespace=%s",
                 str(key), namespace
             )
+            self.evict_local(key)
+            started = time.time()
             try:
-                if isinstance(key, (list, tuple)):
-                    return self.__conn.delete_multi(key)
-                else:
-                    return self.__conn.delete(key)
+                with self.pool.reserve() as mc:
+                    if isinstance(key, (list, tuple)):
+                        deleted = mc.delete_multi(key)
+                    else:
+                        deleted = mc.delete(key)
+                self._observe(namespace, 'delete', started)
+                return deleted
             except Exception as exc:
-                logging.exception(
-                    "fail to delete value at server", self.config.host
+                self._observe(namespace, 'delete', started, error=True)
+                self.log.exception(
+                    "fail to delete value at server %s", self.config.host
                 )
         return False
 
@@ -359,18 +1230,27 @@ class Connection(object):
         """
         namespace = namespace or DEFAULT_NAMESPACE
         if self.enabled(namespace) and key:
+            if self.sampler is not None:
+                for k in key if isinstance(key, (list, tuple)) else [key]:
+                    self.sampler.record('writes', namespace, k)
             key = self.normalise_key(namespace, key)
             logging.debug(
                 "cache::incr %s namespace=%s",
                 str(key), namespace
             )
+            self.evict_local(key)
+            started = time.time()
             try:
-                if isinstance(key, (list, tuple)):
-                    return all([self.__conn.incr(i, delta) for i in key])
-                else:
-                    return self.__conn.incr(key, delta)
+                with self.pool.reserve() as mc:
+                    if isinstance(key, (list, tuple)):
+                        value = all([mc.incr(i, delta) for i in key])
+                    else:
+                        value = mc.incr(key, delta)
+                self._observe(namespace, 'incr', started)
+                return value
             except Exception as exc:
-                logging.exception(
+                self._observe(namespace, 'incr', started, error=True)
+                self.log.exception(
                     "fail to incr value at server %s", self.config.host
                 )
         return False
@@ -387,22 +1267,122 @@ class Connection(object):
         """
         namespace = namespace or DEFAULT_NAMESPACE
         if self.enabled(namespace) and key:
+            if self.sampler is not None:
+                for k in key if isinstance(key, (list, tuple)) else [key]:
+                    self.sampler.record('writes', namespace, k)
             key = self.normalise_key(namespace, key)
             logging.debug(
                 "cache::incr %s namespace=%s",
                 str(key), namespace
             )
+            self.evict_local(key)
+            started = time.time()
             try:
-                if isinstance(key, (list, tuple)):
-                    return all([self.__conn.decr(i, delta) for i in key])
-                else:
-                    return self.__conn.decr(key, delta)
+                with self.pool.reserve() as mc:
+                    if isinstance(key, (list, tuple)):
+                        value = all([mc.decr(i, delta) for i in key])
+                    else:
+                        value = mc.decr(key, delta)
+                self._observe(namespace, 'decr', started)
+                return value
             except Exception as exc:
-                logging.exception(
+                self._observe(namespace, 'decr', started, error=True)
+                self.log.exception(
                     "fail to decr value at server %s", self.config.host
                 )
         return False
 
+    def update(self, key, fn, namespace=None, ttl=None, retries=10,
+               default=None):
+        """
+        Атомарно изменить значение без блокировки (`gets`/`cas`).
+
+        Функция `fn` получает текущее значение (или `default`) и возвращает
+        новое. Если значение изменено другим клиентом между чтением и
+        записью, попытка повторяется не более `retries` раз. Отсутствующее
+        значение создается через `add`.
+
+        Для работы `cas` в настройках подключения необходимо включить
+        `"params": {"behaviors": {"cas": true}}`.
+
+        Использование::
+
+            result = conn.update("visitors", lambda v: (v or []) + [user_id])
+            if result.ok:
+                ....
+
+        :param str key: ключ
+        :param callable fn: функция изменения значения
+        :param str namespace: namespace для формирования ключа
+        :param int ttl: время жизни кеша
+        :param int retries: максимальное количество повторов
+        :param default: значение при отсутствии ключа в кеше
+
+        :return: UpdateResult (ok, value, retries)
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        if not self.enabled(namespace) or not key:
+            return UpdateResult(False, None, 0)
+        origin, key = key, self.normalise_key(namespace, key)
+        ttl = ttl if ttl else self.config.ttl
+        logging.debug(
+            "cache::update %s, ttl=%d, namespace=%s", key, ttl, namespace
+        )
+        self.evict_local(key)
+        attempt = 0
+        started = time.time()
+        try:
+            with self.pool.reserve() as mc:
+                while True:
+                    data, token = mc.gets(key)
+                    current = self.loads(data) if data else MISSING
+                    if current is MISSING:
+                        current = default
+                    value = fn(current)
+                    data = self.dumps(value, namespace)
+                    if token is None:
+                        stored = mc.add(key, data, time=ttl)
+                    else:
+                        stored = mc.cas(key, data, token, time=ttl)
+                    if stored:
+                        break
+                    if attempt >= retries:
+                        logging.warning(
+                            "cache::update %s gave up after %d retries",
+                            key, attempt
+                        )
+                        self.update_stats['failures'] += 1
+                        self._observe(namespace, 'update', started)
+                        return UpdateResult(False, None, attempt)
+                    attempt += 1
+                    self.update_stats['retries'] += 1
+        except Exception as exc:
+            self._observe(namespace, 'update', started, error=True)
+            self.log.exception(
+                "fail to update value at server %s", self.config.host
+            )
+            return UpdateResult(False, None, attempt)
+        if attempt:
+            logging.debug("cache::update %s retries=%d", key, attempt)
+        self.update_stats['updates'] += 1
+        self._observe(namespace, 'update', started, sizes=[len(data)])
+        if self.sampler is not None:
+            self.sampler.record('writes', namespace, origin, len(data))
+        if self.local is not None:
+            self.local.set(key, data, ttl)
+        return UpdateResult(True, value, attempt)
+
+    def _observe(self, namespace, operation, started, hits=0, misses=0,
+                 sizes=(), error=False):
+        """
+        Учесть операцию в метриках подключения (см. `gentoolkit.cache.metrics`).
+        """
+        if self.metrics is not None:
+            self.metrics.observe(
+                namespace, operation, time.time() - started,
+                hits=hits, misses=misses, sizes=sizes, error=error
+            )
+
     def invalidate(self, key, namespace=None):
         """
         Сброс кеша.
@@ -415,45 +1395,220 @@ class Connection(object):
         logging.debug("invalidating %s namespace=%s", str(key), str(namespace))
         self.delete(key, namespace=namespace)
 
-    @classmethod
-    def enabled(cls, namespace):
+    def invalidate_namespace(self, namespace):
         """
-        Статус аспекта/namespace.
+        Сброс всех значений namespace одной операцией `incr` поколения
+        namespace. Доступно при включенном `namespace_generations`, старые
+        значения вытесняются сервером по времени жизни.
 
-        :param str namespace: namespace для формирования ключа
+        :param str namespace: namespace
 
         :return: Bool
         """
-        if not namespace:
+        if not namespace or not self.key_settings.generations:
+            return False
+        logging.debug("cache::invalidate_namespace %s", namespace)
+        key = self.__generation_key(namespace)
+        try:
+            with self.pool.reserve() as mc:
+                try:
+                    generation = mc.incr(key)
+                except pylibmc.NotFound:
+                    generation = _initial_generation()
+                    if not mc.add(key, str(generation), time=0):
+                        generation = mc.incr(key)
+            self.__generations[namespace] = (
+                int(generation),
+                time.time() + self.key_settings.generation_ttl
+            )
             return True
-        return namespace not in self.disabled_config
+        except Exception as exc:
+            self.log.exception(
+                "fail to invalidate namespace at server %s", self.config.host
+            )
+        return False
+
+    def invalidate_tags(self, tags):
+        """
+        Сброс всех значений, сохраненных с любым из тегов. Новые версии
+        тегов записываются одним `set_multi`.
+
+        :param list tags: теги
+
+        :return: Bool
+        """
+        if not tags:
+            return False
+        logging.debug("cache::invalidate_tags %s", tags)
+        try:
+            with self.pool.reserve() as mc:
+                return not mc.set_multi(
+                    dict((k, _tag_version()) for k in self.__tag_keys(tags)),
+                    time=0
+                )
+        except Exception as exc:
+            self.log.exception(
+                "fail to invalidate tags at server %s", self.config.host
+            )
+        return False
+
+    def tag_versions(self, tags):
+        """
+        Текущие версии тегов. Отсутствующие версии создаются через add,
+        поэтому параллельные записи получают одну версию тега: версии, не
+        сохраненные из-за конкурирующей записи, перечитываются с сервера.
+
+        :param list tags: теги
+
+        :return: dict {тег: версия}
+        """
+        tags = set(tags)
+        versions = self.__fetch_tag_versions(tags)
+        created = dict((t, _tag_version()) for t in tags if t not in versions)
+        if created:
+            lost = set()
+            with self.pool.reserve() as mc:
+                for k, t in self.__tag_keys(created).items():
+                    if not mc.add(k, created[t], time=0):
+                        lost.add(t)
+            if lost:
+                stored = self.__fetch_tag_versions(lost)
+                created.update(stored)
+            versions.update(created)
+        return versions
+
+    def __fetch_tag_versions(self, tags):
+        tag_keys = self.__tag_keys(tags)
+        with self.pool.reserve() as mc:
+            versions = mc.get_multi(tag_keys.keys()) or {}
+        return dict((tag_keys[k], v) for k, v in versions.items())
+
+    def __tag_keys(self, tags):
+        settings = self.key_settings
+        return dict((_normalise(settings, TAG_NAMESPACE, t), t) for t in tags)
+
+    def generation(self, namespace):
+        """
+        Текущее поколение namespace. Значение кешируется локально на
+        `generation_ttl` секунд.
+
+        :param str namespace: namespace
+
+        :return: int
+        """
+        cached = self.__generations.get(namespace)
+        now = time.time()
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        key = self.__generation_key(namespace)
+        try:
+            with self.pool.reserve() as mc:
+                generation = mc.get(key)
+                if generation is None:
+                    generation = _initial_generation()
+                    if not mc.add(key, str(generation), time=0):
+                        generation = mc.get(key)
+            generation = int(generation)
+        except Exception as exc:
+            self.log.exception(
+                "fail to get namespace generation at server %s",
+                self.config.host
+            )
+            return cached[0] if cached is not None else 0
+        self.__generations[namespace] = (
+            generation, now + self.key_settings.generation_ttl
+        )
+        return generation
+
+    def __generation_key(self, namespace):
+        return _normalise(
+            self.key_settings, GENERATION_NAMESPACE, namespace
+        )
+
+    def evict_local(self, key):
+        """
+        Удалить значение из локального кеша процесса и разделяемого кеша
+        пула.
+
+        :param str|list key: нормализованный ключ или список ключей
+        """
+        if self.local is not None:
+            for k in key if isinstance(key, (list, tuple)) else [key]:
+                self.local.delete(k)
 
     def normalise_key(self, namespace, key):
         """
         Нормализация ключа. Проверять необходимость добавления префикса,
-        хеширования ключей (md5).
+        поколения namespace, хеширования ключей (md5).
 
         :param str namespace: namespace для формирования ключа
-        :param str key: ключ
+        :param str|list key: ключ или список ключей
 
-        :return: str
+        :return: str|list
         """
-        if isinstance(key, (list, tuple)):
-            return map(lambda k: self.normalise_key(namespace, k), key)
-        if isinstance(key, unicode):
-            key = key.encode('utf-8')
-        elif not isinstance(key, (str, basestring)):
-            key = repr(key)
-        if isinstance(namespace, unicode):
-            namespace = namespace.encode('utf-8')
-        if namespace:
-            key = "%s:%s" % (namespace, key)
-        cache_prefix = self.config.get("cache_prefix", "")
-        if cache_prefix:
-            key = "%s_%s" % (cache_prefix, key)
-        if self.config.get("hash_keys", False):
-            key = md5(key).hexdigest()
-        return key
+        if namespace and self.key_settings.generations:
+            namespace = "%s@%d" % (namespace, self.generation(namespace))
+        return super(Connection, self).normalise_key(namespace, key)
+
+
+KeySettings = namedtuple(
+    'KeySettings',
+    ['revision', 'cache_prefix', 'hash_keys', 'generations', 'generation_ttl']
+)
+
+#: результат `Connection.update`
+UpdateResult = namedtuple('UpdateResult', ['ok', 'value', 'retries'])
+
+
+def _tag_version():
+    """
+    Новая версия тега.
+    """
+    return os.urandom(8).encode('hex')
+
+
+def _is_tagged(value):
+    return isinstance(value, dict) and TAGS_KEY in value
+
+
+def _untag(value, versions):
+    """
+    Распаковать значение, сохраненное с тегами, и проверить версии тегов.
+
+    :param dict value: значение с тегами
+    :param dict versions: текущие версии тегов
+
+    :return: tuple (valid, value)
+    """
+    for tag, version in value[TAGS_KEY].items():
+        if versions.get(tag) != version:
+            return False, None
+    return True, value.get("value")
+
+
+def _initial_generation():
+    """
+    Начальное поколение namespace. Зависит от времени, чтобы после
+    вытеснения ключа поколения не вернуться к старым значениям.
+    """
+    return int(time.time() * 1000)
+
+
+def _normalise(settings, namespace, key):
+    """
+    Нормализация ключа по снимку настроек `KeySettings`.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    elif not isinstance(key, basestring):
+        key = repr(key)
+    if namespace:
+        key = "%s:%s" % (namespace, key)
+    if settings.cache_prefix:
+        key = "%s_%s" % (settings.cache_prefix, key)
+    if settings.hash_keys:
+        key = md5(key).hexdigest()
+    return key
 
 
 class MutexException(Exception):
@@ -463,8 +1618,49 @@ class MutexException(Exception):
 class Mutex(object):
     """
     Примитив синхронизации mutex, реализован на базе memcached сервера.
+
+    Значением ключа блокировки является уникальный токен владельца, поэтому
+    `release` и `update` не затрагивают блокировку, захваченную другим
+    владельцем после истечения времени жизни.
+
+    Использование::
+
+        with Mutex("default", "report", "jobs", ttl=30, renew=True):
+            build_report()
+
+        mutex = Mutex("default", "report", "jobs")
+        if mutex.acquire(timeout=5):
+            try:
+                ....
+            finally:
+                mutex.release()
+
+    Продление и освобождение выполняются через `gets`/`cas`, если в
+    настройках подключения включено `"params": {"behaviors": {"cas": true}}`.
+    Без `cas` токен проверяется отдельным чтением перед записью: блокировка,
+    истекшая и захваченная другим владельцем между чтением и записью, может
+    быть продлена или удалена.
+    Поток продления использует отдельную копию клиента подключения.
+
+    При ошибке сервера захват не повторяется и завершается неудачей.
+
+    Статистика всех блокировок процесса доступна через `Mutex.stats()`.
     """
-    def __init__(self, server, key, namespace, ttl=60):
+
+    #: статистика блокировок процесса
+    _stats = {
+        'acquired': 0,
+        'contended': 0,
+        'timeouts': 0,
+        'wait_time': 0.0,
+        'max_wait_time': 0.0,
+        'renewals': 0,
+        'lost': 0
+    }
+    _stats_lock = threading.Lock()
+
+    def __init__(self, server, key, namespace, ttl=60, timeout=None,
+                 renew=False, backoff=0.01, max_backoff=0.5):
         """
         Конструктор
 
@@ -472,6 +1668,10 @@ class Mutex(object):
         :param str key: ключ
         :param str namespace: аспект
         :param int ttl: время жизни
+        :param float timeout: время ожидания блокировки в контексте `with`, по умолчанию без ограничения
+        :param bool renew: продлевать блокировку в фоновом потоке
+        :param float backoff: начальная пауза между попытками захвата
+        :param float max_backoff: максимальная пауза между попытками захвата
         """
         super(Mutex, self).__init__()
         self.server = server
@@ -479,37 +1679,236 @@ class Mutex(object):
         self.key = key
         self.namespace = namespace
         self.ttl = ttl
+        self.timeout = timeout
+        self.renew = renew
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.token = None
+        self.__renewal = None
 
     def update(self, ttl=None):
         """
-        Продлить mutex
+        Продлить mutex. Продлевается только собственная блокировка.
 
         :param int ttl: время жизни
+
+        :return: Bool
         """
-        ttl = ttl if ttl else self.ttl
-        self.cache.set(self.key, 1, namespace=self.namespace, ttl=ttl)
+        token = self.token
+        if not token:
+            return False
+        return bool(self.__execute(
+            "update", lambda mc: self.__swap(mc, token, token, ttl or self.ttl)
+        ))
 
     def lock(self):
+        """
+        Захватить блокировку без ожидания.
+
+        :return: Bool
+        """
+        return self.acquire(blocking=False)
+
+    def acquire(self, timeout=None, blocking=True):
+        """
+        Захватить блокировку. Между попытками выдерживается пауза, которая
+        растет экспоненциально от `backoff` до `max_backoff` со случайным
+        разбросом.
+
+        :param float timeout: время ожидания в секундах, по умолчанию без ограничения
+        :param bool blocking: ожидать освобождения блокировки
+
+        :return: Bool
+        """
         if not self.cache:
             logging.error(
                 "Cache server not found. server=%s, key=%s, namespace=%s, ttl=%s",
                 self.server, self.key, self.namespace, self.ttl
             )
             return False
-        if not self.cache.add(self.key, 1, namespace=self.namespace, ttl=self.ttl):
-            logging.error(
-                "Lock fail. server=%s, key=%s, namespace=%s, ttl=%s",
-                self.server, self.key, self.namespace, self.ttl
+        token = uuid.uuid4().hex
+        started = time.time()
+        delay = self.backoff
+        contended = False
+        key = self.cache.normalise_key(self.namespace, self.key)
+        data = self.cache.dumps(token, self.namespace)
+        while True:
+            added = self.__execute(
+                "acquire", lambda mc: mc.add(key, data, time=self.ttl)
             )
-            return False
-        return True
+            if added is None:
+                self.__account(started, contended, acquired=False)
+                return False
+            if added:
+                self.token = token
+                self.__account(started, contended, acquired=True)
+                if self.renew:
+                    self.__start_renewal()
+                return True
+            contended = True
+            remains = None if timeout is None else started + timeout - time.time()
+            if not blocking or (remains is not None and remains <= 0):
+                logging.debug(
+                    "Lock fail. server=%s, key=%s, namespace=%s, ttl=%s",
+                    self.server, self.key, self.namespace, self.ttl
+                )
+                self.__account(started, contended, acquired=False)
+                return False
+            pause = random.uniform(delay / 2, delay)
+            time.sleep(pause if remains is None else min(pause, remains))
+            delay = min(delay * 2, self.max_backoff)
 
     def release(self):
+        """
+        Освободить блокировку. Блокировка другого владельца не удаляется.
+
+        :return: Bool
+        """
         if not self.cache:
             logging.error(
                 "Cache server not found. server=%s, key=%s, namespace=%s, ttl=%s",
                 self.server, self.key, self.namespace, self.ttl
             )
             return False
-        return self.cache.delete(self.key, namespace=self.namespace)
+        self.__stop_renewal()
+        token, self.token = self.token, None
+        if not token:
+            return False
+        key = self.cache.normalise_key(self.namespace, self.key)
+
+        def release(mc):
+            # пока ключ существует, блокировку никто не захватит,
+            # поэтому удаление после cas не затрагивает чужую блокировку
+            if not self.__swap(mc, token, "", self.ttl):
+                return False
+            return mc.delete(key)
+
+        released = self.__execute("release", release)
+        self.cache.evict_local(key)
+        if released is False:
+            logging.warning(
+                "Lock lost before release. server=%s, key=%s, namespace=%s",
+                self.server, self.key, self.namespace
+            )
+            with self._stats_lock:
+                self._stats['lost'] += 1
+        return bool(released)
 
+    def owned(self, token=None):
+        """
+        Блокировка захвачена текущим владельцем.
+
+        :return: Bool
+        """
+        token = token or self.token
+        self.cache.evict_local(
+            self.cache.normalise_key(self.namespace, self.key)
+        )
+        return bool(token) and self.cache.get(
+            self.key, namespace=self.namespace
+        ) == token
+
+    def __enter__(self):
+        if not self.acquire(timeout=self.timeout):
+            raise MutexException(
+                "Lock timeout. server=%s, key=%s, namespace=%s" % (
+                    self.server, self.key, self.namespace
+                )
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __swap(self, mc, token, value, ttl):
+        """
+        Заменить значение ключа, если он содержит токен `token`.
+        """
+        key = self.cache.normalise_key(self.namespace, self.key)
+        data = self.cache.dumps(value, self.namespace)
+        behaviors = self.cache.params.get("behaviors") or {}
+        if not behaviors.get("cas"):
+            current = mc.get(key)
+            if current is None or self.cache.loads(current) != token:
+                return False
+            return mc.set(key, data, time=ttl)
+        current, cas = mc.gets(key)
+        if cas is None or self.cache.loads(current) != token:
+            return False
+        return mc.cas(key, data, cas, time=ttl)
+
+    def __execute(self, operation, fn, client=None):
+        """
+        Выполнить операцию с клиентом подключения.
+
+        :return: результат или None при ошибке сервера
+        """
+        try:
+            if client is not None:
+                return fn(client)
+            with self.cache.pool.reserve() as mc:
+                return fn(mc)
+        except Exception:
+            self.cache.log.exception(
+                "fail to %s lock at server %s", operation,
+                self.cache.config.host
+            )
+            return None
+
+    def __start_renewal(self):
+        stopped = threading.Event()
+        token = self.token
+        # клиент пула "single" нельзя использовать из другого потока
+        client = self.cache.pool.client.clone()
+
+        def renew():
+            while not stopped.wait(max(self.ttl / 3.0, 0.01)):
+                if self.token != token or not self.__execute(
+                    "renew",
+                    lambda mc: self.__swap(mc, token, token, self.ttl),
+                    client
+                ):
+                    logging.warning(
+                        "Lock renewal fail. server=%s, key=%s, namespace=%s",
+                        self.server, self.key, self.namespace
+                    )
+                    return
+                with self._stats_lock:
+                    self._stats['renewals'] += 1
+
+        thread = threading.Thread(target=renew, name="mutex-renewal")
+        thread.daemon = True
+        self.__renewal = stopped
+        thread.start()
+
+    def __stop_renewal(self):
+        if self.__renewal is not None:
+            self.__renewal.set()
+            self.__renewal = None
+
+    @classmethod
+    def __account(cls, started, contended, acquired):
+        waited = time.time() - started
+        with cls._stats_lock:
+            if acquired:
+                cls._stats['acquired'] += 1
+            else:
+                cls._stats['timeouts'] += 1
+            if contended:
+                cls._stats['contended'] += 1
+            cls._stats['wait_time'] += waited
+            cls._stats['max_wait_time'] = max(
+                cls._stats['max_wait_time'], waited
+            )
+
+    @classmethod
+    def stats(cls):
+        """
+        Статистика блокировок процесса: количество захватов, захватов с
+        ожиданием, неудачных попыток, продлений, потерянных блокировок и
+        время ожидания.
+
+        :return: dict
+        """
+        with cls._stats_lock:
+            return dict(cls._stats)
@@ -0,0 +1,760 @@
+# -*- coding: utf-8 -*-
+"""
+Неблокирующий доступ к серверу memcached
+----------------------------------------
+
+Подключение `AsyncConnection` для сервисов на Tornado. Реализует текстовый
+протокол memcached поверх `tornado.iostream`, запросы к серверу
+отправляются по постоянному соединению без ожидания ответа на предыдущие
+(pipelining). Все методы возвращают `Future`.
+
+Ключи и значения формируются так же, как в `Connection`, поэтому данные
+доступны обоим подключениям, поколения namespace (`namespace_generations`)
+учитываются. Не поддерживаются локальный кеш процесса, теги и значения,
+сохраненные частями (см. `gentoolkit.cache.chunks`), - такие значения
+читаются как отсутствующие.
+
+При нескольких серверах ключи распределяются по кольцу консистентного
+хеширования (настройка `ring`, см. `gentoolkit.cache.ring`) так же, как в
+`Connection`; распределение pylibmc по умолчанию не воспроизводится,
+поэтому несколько серверов без `ring` не поддерживаются. Запросы
+отправляются только на основной сервер ключа: после записи через
+`AsyncConnection` реплики горячих ключей могут возвращать прежнее
+значение не дольше `hot_ttl`.
+
+Доступ к подключению::
+
+    conn = gentoolkit.cache.asynchronous.instance.<conn_name>
+
+    @gen.coroutine
+    def handler():
+        yield conn.set("key", {"a": 1})
+        value = yield conn.get("key")
+
+    @cached_async("product", conn_name="default")
+    @gen.coroutine
+    def get_product():
+        ....
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                // время ожидания ответа сервера в секундах
+                "timeout": 1.0
+            }
+        }
+    }
+"""
+import datetime
+import logging
+import sys
+import time
+from collections import deque
+from functools import wraps
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+
+from . import Backend, BaseConnection, NotConfigured, chunks
+from .ring import HashRing
+from . import DEFAULT_NAMESPACE, GENERATION_NAMESPACE, MISSING
+from . import MULTI_CHUNK_SIZE, _initial_generation, _is_tagged, _normalise
+
+
+__all__ = [
+    'MemcacheError', 'StreamClient', 'AsyncConnection', 'AsyncBackend',
+    'instance', 'cached_async'
+]
+
+
+#: максимальная длина ключа
+MAX_KEY_LENGTH = 250
+
+#: время ожидания ответа сервера по умолчанию
+DEFAULT_TIMEOUT = 1.0
+
+
+class MemcacheError(Exception):
+    """
+    Исключение. Ошибка протокола или сервера memcached.
+    """
+
+
+class StreamClient(object):
+    """
+    Клиент одного сервера memcached. Запросы отправляются сразу, ответы
+    читаются в порядке отправки запросов.
+    """
+
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT, stream=None):
+        """
+        Конструктор
+
+        :param str host: хост сервера
+        :param int port: порт сервера
+        :param float timeout: время ожидания ответа в секундах
+        :param tornado.iostream.IOStream stream: установленное соединение
+        """
+        super(StreamClient, self).__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._stream = stream
+        self._connecting = None
+        self._pending = deque()
+        # соединение, ответы которого читаются в данный момент
+        self._reading = None
+
+    @gen.coroutine
+    def request(self, command, parser):
+        """
+        Отправить команду серверу.
+
+        :param str command: команда протокола memcached
+        :param callable parser: корутина чтения ответа из потока
+
+        :return: Future
+        """
+        stream = yield self._connect()
+        future = Future()
+        self._pending.append((future, parser))
+        stream.write(command)
+        if self._reading is not stream:
+            self._reading = stream
+            IOLoop.current().spawn_callback(self._read_loop, stream)
+        try:
+            result = yield gen.with_timeout(
+                datetime.timedelta(seconds=self.timeout), future
+            )
+        except gen.TimeoutError:
+            self.close(MemcacheError(
+                "timeout %s:%s" % (self.host, self.port)
+            ))
+            raise
+        raise gen.Return(result)
+
+    def close(self, exc=None):
+        """
+        Закрыть соединение. Ожидающие ответа запросы завершаются ошибкой.
+
+        :param Exception exc: причина закрытия
+        """
+        stream, self._stream = self._stream, None
+        pending, self._pending = self._pending, deque()
+        if stream is not None:
+            stream.close()
+        for future, _ in pending:
+            if not future.done():
+                future.set_exception(
+                    exc or MemcacheError("connection closed")
+                )
+
+    @gen.coroutine
+    def _connect(self):
+        if self._stream is not None and not self._stream.closed():
+            raise gen.Return(self._stream)
+        if self._connecting is None:
+            self._connecting = TCPClient().connect(self.host, self.port)
+        connecting = self._connecting
+        try:
+            stream = yield connecting
+        finally:
+            if self._connecting is connecting:
+                self._connecting = None
+        if self._stream is None or self._stream.closed():
+            stream.set_nodelay(True)
+            self._stream = stream
+        raise gen.Return(self._stream)
+
+    @gen.coroutine
+    def _read_loop(self, stream):
+        try:
+            while self._pending and self._stream is stream:
+                future, parser = self._pending[0]
+                result = yield parser(stream)
+                self._pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as exc:
+            if self._stream is stream:
+                self.close(exc)
+        finally:
+            if self._reading is stream:
+                self._reading = None
+
+
+@gen.coroutine
+def read_line(stream):
+    """
+    Прочитать строку ответа без завершающего `\\r\\n`.
+    """
+    line = yield stream.read_until("\r\n")
+    raise gen.Return(line[:-2])
+
+
+def server_error(line):
+    """
+    Ошибка сервера в строке ответа.
+
+    :return: MemcacheError|None
+    """
+    if line == "ERROR" or line.startswith(("CLIENT_ERROR", "SERVER_ERROR")):
+        return MemcacheError(line)
+    return None
+
+
+@gen.coroutine
+def parse_values(stream):
+    """
+    Ответ на команды get/gets.
+
+    :return: dict {ключ: (значение, флаги, cas)}
+    """
+    values = {}
+    while True:
+        line = yield read_line(stream)
+        if line == "END":
+            raise gen.Return(values)
+        if line.startswith("VALUE "):
+            parts = line.split(" ")
+            data = yield stream.read_bytes(int(parts[3]) + 2)
+            values[parts[1]] = (
+                data[:-2],
+                int(parts[2]),
+                int(parts[4]) if len(parts) > 4 else None
+            )
+            continue
+        error = server_error(line)
+        if error is not None:
+            raise gen.Return(error)
+        raise MemcacheError("unexpected response %r" % line)
+
+
+@gen.coroutine
+def parse_status(stream):
+    """
+    Ответ на команды изменения данных (STORED, DELETED, NOT_FOUND и т.д.).
+
+    :return: str
+    """
+    line = yield read_line(stream)
+    raise gen.Return(server_error(line) or line)
+
+
+@gen.coroutine
+def parse_counter(stream):
+    """
+    Ответ на команды incr/decr.
+
+    :return: int|None
+    """
+    line = yield read_line(stream)
+    if line == "NOT_FOUND":
+        raise gen.Return(None)
+    error = server_error(line)
+    if error is not None:
+        raise gen.Return(error)
+    raise gen.Return(int(line))
+
+
+def storage_command(command, key, value, ttl, cas=None):
+    """
+    Команда сохранения значения.
+
+    :return: str
+    """
+    return "%s %s 0 %d %d%s\r\n%s\r\n" % (
+        command, key, ttl, len(value),
+        " %d" % cas if cas is not None else "",
+        value
+    )
+
+
+def check_key(key):
+    """
+    Проверка ключа на соответствие протоколу memcached.
+
+    :raises MemcacheError: если ключ не может быть передан серверу
+    """
+    if len(key) > MAX_KEY_LENGTH or any(c <= " " or c == "\x7f" for c in key):
+        raise MemcacheError("invalid key %r" % key)
+    return key
+
+
+class AsyncConnection(BaseConnection):
+    """
+    Неблокирующий адаптер подключения к серверу memcached.
+    """
+
+    def __init__(self, config):
+        super(AsyncConnection, self).__init__(config)
+        timeout = self.config.get("timeout", DEFAULT_TIMEOUT)
+        # namespace -> (поколение, время устаревания)
+        self._generations = {}
+        hosts = list(self.config.host)
+        ring = self.config.get("ring", None)
+        if len(hosts) > 1 and ring is None:
+            raise ValueError(
+                "AsyncConnection requires \"ring\" distribution for several "
+                "hosts %s" % hosts
+            )
+        self.ring = HashRing(
+            hosts, ring.get("weights"), ring.get("points", 160)
+        ) if ring is not None else None
+        self._nodes = dict((host, idx) for idx, host in enumerate(hosts))
+        self.clients = []
+        for host in hosts:
+            host, _, port = host.partition(":")
+            self.clients.append(
+                StreamClient(host, int(port or 11211), timeout=timeout)
+            )
+
+    def client(self, key):
+        """
+        Клиент сервера, на котором хранится ключ.
+
+        :param str key: нормализованный ключ
+
+        :return: StreamClient
+        """
+        if self.ring is None or len(self.clients) == 1:
+            return self.clients[0]
+        return self.clients[self._nodes[self.ring.get_node(key)]]
+
+    @gen.coroutine
+    def get(self, key, namespace=None, default=None):
+        """
+        Получить значение из кеша. Для списка ключей возвращает список
+        значений в том же порядке.
+
+        :param str|list key: ключ или список ключей
+        :param str namespace: namespace для формирования ключа
+        :param default: значение при отсутствии ключа в кеше, см. `Connection.get`
+
+        :return: Future(Any|None)
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        if isinstance(key, (list, tuple)):
+            found, _ = yield self.get_many(key, namespace=namespace)
+            raise gen.Return([found.get(k, default) for k in key])
+        value = default
+        if self.enabled(namespace) and key:
+            versioned = yield self._namespace(namespace)
+            key = self.normalise_key(versioned, key)
+            logging.debug("cache::async::get %s namespace=%s", key, namespace)
+            try:
+                values = yield self.client(key).request(
+                    "get %s\r\n" % check_key(key), parse_values
+                )
+                if key in values:
+                    value = self._loads(values[key][0], default)
+            except Exception as exc:
+                logging.exception(
+                    "fail to get value at server %s", self.config.host
+                )
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def get_many(self, keys, namespace=None):
+        """
+        Получить несколько значений из кеша. Ключи группируются по серверам,
+        каждому серверу отправляются команды get не более чем на
+        `multi_chunk_size` ключей.
+
+        :param list keys: список ключей
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(tuple (dict {ключ: значение}, set отсутствующих ключей))
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        found = {}
+        if not keys or not self.enabled(namespace):
+            raise gen.Return((found, set(keys or [])))
+        versioned = yield self._namespace(namespace)
+        normalized = {}
+        for k in keys:
+            normalized[self.normalise_key(versioned, k)] = k
+        logging.debug(
+            "cache::async::get_many %s namespace=%s",
+            normalized.keys(), namespace
+        )
+        try:
+            chunk_size = self.config.get("multi_chunk_size", MULTI_CHUNK_SIZE)
+            groups = {}
+            for k in normalized:
+                groups.setdefault(self.client(check_key(k)), []).append(k)
+            requests = []
+            for client, group in groups.items():
+                for idx in xrange(0, len(group), chunk_size):
+                    requests.append(client.request(
+                        "get %s\r\n" % " ".join(group[idx:idx + chunk_size]),
+                        parse_values
+                    ))
+            responses = yield requests
+            for values in responses:
+                for k, value in values.items():
+                    value = self._loads(value[0], MISSING)
+                    if value is not MISSING:
+                        found[normalized[k]] = value
+        except Exception as exc:
+            logging.exception(
+                "fail to get_many values at server %s", self.config.host
+            )
+            found = {}
+        raise gen.Return((found, set(k for k in keys if k not in found)))
+
+    @gen.coroutine
+    def set(self, key, value, namespace=None, ttl=None):
+        """
+        Добавить значение в кеш.
+
+        :param str key: ключ
+        :param value: значение
+        :param str namespace: namespace для формирования ключа
+        :param int ttl: время жизни кеша
+
+        :return: Future(Bool)
+        """
+        ret = yield self._store("set", key, value, namespace, ttl)
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def add(self, key, value, namespace=None, ttl=None):
+        """
+        Добавить значение в кеш, если оно еще не установлено.
+
+        :param str key: ключ
+        :param value: значение
+        :param str namespace: namespace для формирования ключа
+        :param int ttl: время жизни кеша
+
+        :return: Future(Bool)
+        """
+        ret = yield self._store("add", key, value, namespace, ttl)
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def set_multi(self, values, namespace=None, ttl=None):
+        """
+        Добавить несколько значений в кеш. Команды отправляются без ожидания
+        ответов на предыдущие.
+
+        :param dict values: пары ключ/значение
+        :param str namespace: namespace для формирования ключа
+        :param int ttl: время жизни кеша
+
+        :return: Future(Bool)
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        ret = False
+        if self.enabled(namespace) and values:
+            ttl = ttl if ttl else self.config.ttl
+            logging.debug(
+                "cache::async::set_multi %s, ttl=%d, namespace=%s",
+                values.keys(), ttl, namespace
+            )
+            versioned = yield self._namespace(namespace)
+            try:
+                requests = []
+                for k, v in values.items():
+                    k = check_key(self.normalise_key(versioned, k))
+                    requests.append(self.client(k).request(
+                        storage_command("set", k, self.dumps(v, namespace), ttl),
+                        parse_status
+                    ))
+                responses = yield requests
+                ret = all([r == "STORED" for r in responses])
+            except Exception as exc:
+                logging.exception(
+                    "fail to set_multi value at server %s", self.config.host
+                )
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def delete(self, key, namespace=None):
+        """
+        Удалить значение из кеша.
+
+        :param str|list key: ключ или список ключей
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(Bool)
+        """
+        namespace = namespace or DEFAULT_NAMESPACE
+        ret = False
+        if self.enabled(namespace) and key:
+            keys = key if isinstance(key, (list, tuple)) else [key]
+            versioned = yield self._namespace(namespace)
+            keys = self.normalise_key(versioned, keys)
+            logging.debug(
+                "cache::async::delete %s namespace=%s", keys, namespace
+            )
+            try:
+                responses = yield [
+                    self.client(k).request(
+                        "delete %s\r\n" % check_key(k), parse_status
+                    )
+                    for k in keys
+                ]
+                ret = all([r == "DELETED" for r in responses])
+            except Exception as exc:
+                logging.exception(
+                    "fail to delete value at server %s", self.config.host
+                )
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def incr(self, key, delta=1, namespace=None):
+        """
+        Инкремент.
+
+        :param str key: ключ
+        :param int delta: величина инкремента
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(int|None)
+        """
+        ret = yield self._counter("incr", key, delta, namespace)
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def decr(self, key, delta=1, namespace=None):
+        """
+        Декремент.
+
+        :param str key: ключ
+        :param int delta: величина декремента
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(int|None)
+        """
+        ret = yield self._counter("decr", key, delta, namespace)
+        raise gen.Return(ret)
+
+    def invalidate(self, key, namespace=None):
+        """
+        Сброс кеша.
+
+        :param str key: ключ
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(Bool)
+        """
+        return self.delete(key, namespace=namespace)
+
+    @gen.coroutine
+    def generation(self, namespace):
+        """
+        Текущее поколение namespace, см. `Connection.generation`. Значение
+        кешируется локально на `generation_ttl` секунд.
+
+        :param str namespace: namespace
+
+        :return: Future(int)
+        """
+        cached = self._generations.get(namespace)
+        now = time.time()
+        if cached is not None and cached[1] > now:
+            raise gen.Return(cached[0])
+        key = check_key(
+            _normalise(self.key_settings, GENERATION_NAMESPACE, namespace)
+        )
+        client = self.client(key)
+        try:
+            values = yield client.request("get %s\r\n" % key, parse_values)
+            if key in values:
+                generation = values[key][0]
+            else:
+                generation = _initial_generation()
+                status = yield client.request(
+                    storage_command("add", key, str(generation), 0),
+                    parse_status
+                )
+                if status != "STORED":
+                    values = yield client.request(
+                        "get %s\r\n" % key, parse_values
+                    )
+                    generation = values[key][0]
+            generation = int(generation)
+        except Exception as exc:
+            logging.exception(
+                "fail to get namespace generation at server %s",
+                self.config.host
+            )
+            raise gen.Return(cached[0] if cached is not None else 0)
+        self._generations[namespace] = (
+            generation, now + self.key_settings.generation_ttl
+        )
+        raise gen.Return(generation)
+
+    @gen.coroutine
+    def _namespace(self, namespace):
+        """
+        Namespace для формирования ключа с учетом поколения.
+        """
+        if namespace and self.key_settings.generations:
+            generation = yield self.generation(namespace)
+            namespace = "%s@%d" % (namespace, generation)
+        raise gen.Return(namespace)
+
+    def _loads(self, data, default):
+        """
+        Десериализация значения. Значения, сохраненные частями или с
+        тегами, считаются отсутствующими.
+        """
+        if chunks.is_manifest(data):
+            return default
+        value = self.loads(data)
+        if value is MISSING or _is_tagged(value):
+            return default
+        return value
+
+    @gen.coroutine
+    def _store(self, command, key, value, namespace, ttl):
+        namespace = namespace or DEFAULT_NAMESPACE
+        ret = False
+        if self.enabled(namespace) and key:
+            versioned = yield self._namespace(namespace)
+            key = self.normalise_key(versioned, key)
+            ttl = ttl if ttl else self.config.ttl
+            logging.debug(
+                "cache::async::%s %s, ttl=%d, namespace=%s",
+                command, key, ttl, namespace
+            )
+            try:
+                status = yield self.client(key).request(
+                    storage_command(
+                        command, check_key(key),
+                        self.dumps(value, namespace), ttl
+                    ),
+                    parse_status
+                )
+                ret = status == "STORED"
+            except Exception as exc:
+                logging.exception(
+                    "fail to %s value at server %s", command, self.config.host
+                )
+        raise gen.Return(ret)
+
+    @gen.coroutine
+    def _counter(self, command, key, delta, namespace):
+        namespace = namespace or DEFAULT_NAMESPACE
+        ret = None
+        if self.enabled(namespace) and key:
+            versioned = yield self._namespace(namespace)
+            key = self.normalise_key(versioned, key)
+            logging.debug(
+                "cache::async::%s %s namespace=%s", command, key, namespace
+            )
+            try:
+                ret = yield self.client(key).request(
+                    "%s %s %d\r\n" % (command, check_key(key), delta),
+                    parse_counter
+                )
+            except Exception as exc:
+                logging.exception(
+                    "fail to %s value at server %s", command, self.config.host
+                )
+        raise gen.Return(ret)
+
+
+class AsyncBackend(Backend):
+    """
+    Управление неблокирующими подключениями к серверу кеширования.
+    """
+
+    instance = None
+
+    def create_connection(self, config):
+        return AsyncConnection(config)
+
+
+instance = AsyncBackend()
+
+
+def cached_async(key, namespace=None, ttl=None, conn_name=None,
+                 negative_ttl=None):
+    """
+    Декоратор для кеширования результата корутины через `AsyncConnection`.
+
+    Одновременные вызовы с одинаковым ключом в пределах процесса
+    объединяются: значение читается из кеша и вычисляется один раз,
+    остальные вызовы ожидают общий результат (в том числе исключение).
+
+    :param str key: ключ
+    :param str namespace: namespace для формирования ключа
+    :param int ttl: время жизни кеша
+    :param str conn_name: название подключения к серверу memcached
+    :param int negative_ttl: время жизни результата `None`
+
+    :return: Future
+    """
+    def dec(func):
+        @wraps(func)
+        @gen.coroutine
+        def inner_dec(*args, **kwargs):
+            conn = None
+            key_str = key
+            try:
+                conn = instance[conn_name]
+                if not conn.enabled(namespace) or not key:
+                    conn = None
+                elif callable(key):
+                    key_str = key(*args, **kwargs)
+            except NotConfigured, e:
+                logging.error(str(e))
+            except Exception as exc:
+                logging.exception("Fail to cache result of %s", func.__name__)
+                conn = None
+            if conn is None:
+                value = yield gen.maybe_future(func(*args, **kwargs))
+                raise gen.Return(value)
+            flight = (IOLoop.current(), conn_name, namespace, key_str)
+            future = _in_flight.get(flight)
+            if future is None:
+                future = _in_flight[flight] = Future()
+                try:
+                    value = yield _load(
+                        conn, key_str, namespace, ttl, negative_ttl,
+                        lambda: func(*args, **kwargs)
+                    )
+                except Exception:
+                    future.set_exc_info(sys.exc_info())
+                else:
+                    future.set_result(value)
+                finally:
+                    del _in_flight[flight]
+            value = yield future
+            raise gen.Return(value)
+        return inner_dec
+    return dec
+
+
+#: вычисляемые значения (IOLoop, подключение, namespace, ключ) -> Future
+_in_flight = {}
+
+
+@gen.coroutine
+def _load(conn, key, namespace, ttl, negative_ttl, compute):
+    """
+    Прочитать значение из кеша, при отсутствии вычислить и сохранить.
+    """
+    value = yield conn.get(key, namespace=namespace, default=MISSING)
+    if value is None and not negative_ttl:
+        value = MISSING
+    if value is MISSING:
+        value = yield gen.maybe_future(compute())
+        if value is not None or negative_ttl:
+            yield conn.set(
+                key, value, namespace=namespace,
+                ttl=ttl if value is not None else negative_ttl
+            )
+    raise gen.Return(value)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочное тестирование кеша
+-----------------------------
+
+Замер производительности `Connection` против встроенного сервера
+memcached (см. `gentoolkit.cache.server`), запущенного в фоновом потоке,
+или против внешнего сервера. Позволяет сравнить кодеки, сжатие и размер
+пакетных запросов без отдельной инфраструктуры.
+
+Запуск::
+
+    python -m gentoolkit.cache.benchmark --codec marshal --compression zlib \\
+        --value-size 4096 --keys 2000 --batch 100
+
+Использование из кода::
+
+    results = benchmark.run(codec="pickle", keys=500)
+    print benchmark.format_results(results)
+"""
+import argparse
+import time
+
+from gentoolkit.config import Proxy
+
+from . import Connection
+from .server import LocalServer
+
+
+__all__ = ['run', 'format_results']
+
+
+#: сценарии по умолчанию
+SCENARIOS = ('set', 'get', 'set_multi', 'get_many', 'incr')
+
+
+def make_value(size):
+    """
+    Тестовое значение: словарь с текстом и числами, сериализованный размер
+    которого примерно равен `size`.
+
+    :param int size: размер в байтах
+
+    :return: dict
+    """
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit ".split()
+    text = " ".join(words[i % len(words)] for i in xrange(size // 12 + 1))
+    return {
+        "id": 1,
+        "title": text[:size // 2],
+        "numbers": range(size // 8)
+    }
+
+
+def connect(hosts, codec="json", compression=None, threshold=1024,
+            pool=None):
+    """
+    Подключение к серверам кеша с заданными настройками.
+
+    :param list hosts: серверы
+    :param str codec: кодек
+    :param str compression: алгоритм сжатия
+    :param int threshold: минимальный размер значения для сжатия
+    :param dict pool: настройки пула клиентов
+
+    :return: Connection
+    """
+    settings = {
+        "host": hosts,
+        "params": {"behaviors": {"cas": True, "tcp_nodelay": True}},
+        "ttl": 600,
+        "codec": codec
+    }
+    if compression:
+        settings["compression"] = {
+            "method": compression,
+            "threshold": threshold
+        }
+    if pool:
+        settings["pool"] = pool
+    return Connection(Proxy(settings, "cache.__benchmark__"))
+
+
+def measure(operation, count):
+    """
+    Выполнить операцию `count` раз.
+
+    :param callable operation: операция, получает номер итерации
+    :param int count: количество итераций
+
+    :return: dict
+    """
+    latencies = []
+    started = time.time()
+    for idx in xrange(count):
+        begin = time.time()
+        operation(idx)
+        latencies.append(time.time() - begin)
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        "calls": count,
+        "elapsed": elapsed,
+        "ops": count / elapsed if elapsed else 0,
+        "p50": latencies[len(latencies) // 2] if latencies else 0,
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0
+    }
+
+
+def run(codec="json", compression=None, value_size=1024, keys=1000,
+        batch=100, hosts=None, max_bytes=256 << 20, scenarios=SCENARIOS):
+    """
+    Выполнить сценарии нагрузки. Если серверы не указаны, запускается
+    встроенный сервер.
+
+    :param str codec: кодек
+    :param str compression: алгоритм сжатия
+    :param int value_size: примерный размер значения в байтах
+    :param int keys: количество ключей
+    :param int batch: количество ключей в пакетном запросе
+    :param list hosts: серверы memcached
+    :param int max_bytes: объем памяти встроенного сервера
+    :param list scenarios: сценарии
+
+    :return: list [(сценарий, результат)]
+    """
+    server = None
+    if not hosts:
+        server = LocalServer(max_bytes=max_bytes).start()
+        hosts = [server.address]
+    try:
+        conn = connect(hosts, codec=codec, compression=compression)
+        value = make_value(value_size)
+        names = ["bench:%d" % i for i in xrange(keys)]
+        batches = [
+            names[i:i + batch] for i in xrange(0, len(names), batch)
+        ]
+        operations = {
+            "set": (
+                lambda i: conn.set(names[i], value, namespace="bench"),
+                keys
+            ),
+            "get": (
+                lambda i: conn.get(names[i], namespace="bench"),
+                keys
+            ),
+            "set_multi": (
+                lambda i: conn.set_multi(
+                    dict((k, value) for k in batches[i]), namespace="bench"
+                ),
+                len(batches)
+            ),
+            "get_many": (
+                lambda i: conn.get_many(batches[i], namespace="bench"),
+                len(batches)
+            ),
+            "incr": (
+                lambda i: conn.incr("counter", namespace="bench"),
+                keys
+            )
+        }
+        # счетчик хранится без заголовка кодека, иначе incr не работает
+        with conn.pool.reserve() as mc:
+            mc.set(conn.normalise_key("bench", "counter"), "0")
+        results = []
+        for name in scenarios:
+            operation, count = operations[name]
+            result = measure(operation, count)
+            result["size"] = len(conn.dumps(value, "bench"))
+            results.append((name, result))
+        return results
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def format_results(results):
+    """
+    Результаты в виде таблицы.
+
+    :param list results: результат `run`
+
+    :return: str
+    """
+    lines = ["%-10s %8s %10s %10s %10s %8s" % (
+        "scenario", "calls", "ops/s", "p50 ms", "p99 ms", "size"
+    )]
+    for name, result in results:
+        lines.append("%-10s %8d %10.0f %10.3f %10.3f %8d" % (
+            name, result["calls"], result["ops"],
+            result["p50"] * 1000, result["p99"] * 1000, result["size"]
+        ))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cache benchmark")
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--compression", default=None)
+    parser.add_argument("--value-size", type=int, default=1024)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument(
+        "--host", action="append", default=None,
+        help="external memcached server, the embedded one is used by default"
+    )
+    parser.add_argument(
+        "--scenario", action="append", default=None, choices=SCENARIOS
+    )
+    args = parser.parse_args()
+    print format_results(run(
+        codec=args.codec,
+        compression=args.compression,
+        value_size=args.value_size,
+        keys=args.keys,
+        batch=args.batch,
+        hosts=args.host,
+        scenarios=args.scenario or SCENARIOS
+    ))
+
+
+if __name__ == "__main__":
+    main()
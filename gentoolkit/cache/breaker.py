@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Автоматический выключатель подключения
+--------------------------------------
+
+При недоступности серверов memcached каждая операция ожидает таймаута
+клиента. `CircuitBreaker` размыкается после `threshold` ошибок подключения
+подряд: в течение `cooldown` секунд операции сразу завершаются исключением
+`CircuitOpen`, которое `Connection` обрабатывает как промах кеша. Доступность
+серверов проверяется в фоновом потоке, после успешной проверки выключатель
+замыкается.
+
+Если указан резервный список серверов `secondary`, при разомкнутом
+выключателе основного кластера операции выполняются на резервном.
+
+Ошибки операций подключения записываются в журнал не чаще одного раза за
+`log_interval` секунд (по умолчанию `LOG_INTERVAL`) для каждого сообщения,
+в том числе у подключений без выключателя.
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "breaker": {
+                    // количество ошибок подряд для размыкания
+                    "threshold": 5,
+                    // время до проверки доступности в секундах
+                    "cooldown": 10,
+                    // резервные серверы
+                    "secondary": ["10.0.1.1:11211"],
+                    // интервал записи повторяющихся ошибок в журнал
+                    "log_interval": 60
+                }
+            }
+        }
+    }
+"""
+import logging
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pylibmc
+
+
+__all__ = [
+    'CircuitOpen', 'CircuitBreaker', 'BreakerPool', 'FailoverPool',
+    'RateLimitedLog'
+]
+
+
+#: ошибки, которые считаются отказом сервера
+FAILURES = (
+    pylibmc.ConnectionError, pylibmc.ServerDead, pylibmc.ServerDown,
+    pylibmc.SomeErrors, pylibmc.ReadError, pylibmc.WriteError,
+    pylibmc.SocketCreateError, pylibmc.HostLookupError,
+    pylibmc.UnknownReadFailure, socket.error
+)
+
+#: интервал записи повторяющихся ошибок в журнал в секундах
+LOG_INTERVAL = 60
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+
+class CircuitOpen(Exception):
+    """
+    Исключение. Выключатель разомкнут, операция не выполнялась.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Выключатель: считает ошибки подряд и размыкается при достижении порога.
+    """
+
+    def __init__(self, name, probe, threshold=5, cooldown=10):
+        """
+        Конструктор
+
+        :param str name: название (для журнала)
+        :param callable probe: проверка доступности, исключение означает отказ
+        :param int threshold: количество ошибок подряд для размыкания
+        :param float cooldown: время до проверки доступности в секундах
+        """
+        super(CircuitBreaker, self).__init__()
+        self.name = name
+        self.probe = probe
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self.opened_at = None
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+        Разрешено ли выполнение операции.
+
+        :return: bool
+        """
+        if self.state == CLOSED:
+            return True
+        with self.__lock:
+            self.rejected += 1
+        return False
+
+    def success(self):
+        """
+        Операция выполнена успешно.
+        """
+        if self.failures:
+            with self.__lock:
+                self.failures = 0
+
+    def failure(self):
+        """
+        Операция завершилась отказом сервера.
+        """
+        with self.__lock:
+            self.failures += 1
+            if self.state != CLOSED or self.failures < self.threshold:
+                return
+            self.state = OPEN
+            self.opened += 1
+            self.opened_at = time.time()
+        logging.error(
+            "Cache circuit %s open after %d failures", self.name, self.failures
+        )
+        thread = threading.Thread(target=self.__recover, name="cache-breaker")
+        thread.daemon = True
+        thread.start()
+
+    def __recover(self):
+        while True:
+            time.sleep(self.cooldown)
+            try:
+                self.probe()
+            except Exception as exc:
+                logging.warning(
+                    "Cache circuit %s probe fail: %s", self.name, exc
+                )
+                continue
+            with self.__lock:
+                self.state = CLOSED
+                self.failures = 0
+            logging.info("Cache circuit %s closed", self.name)
+            return
+
+    def stats(self):
+        """
+        :return: dict
+        """
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'opened_at': self.opened_at
+        }
+
+
+class BreakerPool(object):
+    """
+    Пул клиентов, защищенный выключателем. Отказы сервера, возникшие
+    внутри блока `reserve`, учитываются выключателем.
+    """
+
+    def __init__(self, pool, name, threshold=5, cooldown=10):
+        """
+        Конструктор
+
+        :param pool: пул клиентов (см. `gentoolkit.cache.pool`)
+        :param str name: название (для журнала)
+        :param int threshold: количество ошибок подряд для размыкания
+        :param float cooldown: время до проверки доступности в секундах
+        """
+        super(BreakerPool, self).__init__()
+        self.pool = pool
+        self.client = pool.client
+        self.breaker = CircuitBreaker(
+            name, self.probe, threshold=threshold, cooldown=cooldown
+        )
+
+    def probe(self):
+        """
+        Проверка доступности серверов отдельным клиентом.
+        """
+        client = self.client.clone()
+        client.get("__probe__")
+
+    @contextmanager
+    def reserve(self):
+        if not self.breaker.allow():
+            raise CircuitOpen(self.breaker.name)
+        with self.pool.reserve() as client:
+            try:
+                yield client
+            except FAILURES:
+                self.breaker.failure()
+                raise
+        self.breaker.success()
+
+    def stats(self):
+        stats = dict(self.pool.stats())
+        stats['breaker'] = self.breaker.stats()
+        return stats
+
+
+class FailoverPool(object):
+    """
+    Основной и резервный пулы. Операция выполняется на первом пуле с
+    замкнутым выключателем.
+    """
+
+    def __init__(self, primary, secondary):
+        """
+        Конструктор
+
+        :param BreakerPool primary: основной пул
+        :param BreakerPool secondary: резервный пул
+        """
+        super(FailoverPool, self).__init__()
+        self.primary = primary
+        self.secondary = secondary
+        self.client = primary.client
+        self.failovers = 0
+
+    @contextmanager
+    def reserve(self):
+        pool = self.primary
+        if pool.breaker.state != CLOSED:
+            pool = self.secondary
+            self.failovers += 1
+        with pool.reserve() as client:
+            yield client
+
+    def stats(self):
+        return {
+            'primary': self.primary.stats(),
+            'secondary': self.secondary.stats(),
+            'failovers': self.failovers
+        }
+
+
+class RateLimitedLog(object):
+    """
+    Запись ошибок в журнал не чаще одного раза за `interval` секунд для
+    каждого сообщения. Количество пропущенных записей добавляется к
+    следующей записи.
+    """
+
+    def __init__(self, interval=LOG_INTERVAL):
+        """
+        Конструктор
+
+        :param float interval: интервал в секундах
+        """
+        super(RateLimitedLog, self).__init__()
+        self.interval = interval
+        # сообщение -> [время последней записи, пропущено]
+        self.__messages = {}
+        self.__lock = threading.Lock()
+
+    def exception(self, message, *args):
+        """
+        Записать ошибку с трассировкой стека. Разомкнутый выключатель
+        записывается без трассировки.
+        """
+        now = time.time()
+        with self.__lock:
+            state = self.__messages.get(message)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return
+            suppressed = state[1] if state is not None else 0
+            self.__messages[message] = [now, 0]
+        if suppressed:
+            message = "%s (%d similar messages suppressed)" % (
+                message, suppressed
+            )
+        if isinstance(sys.exc_info()[1], CircuitOpen):
+            logging.warning(message + ": circuit open", *args)
+        else:
+            logging.exception(message, *args)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Отложенная запись в кеш
+-----------------------
+
+`WriteBuffer` накапливает операции записи и отправляет их пакетами:
+
+* повторные `set` одного ключа объединяются, сохраняется последнее значение
+* `incr`/`decr` одного ключа суммируются, `set` отменяет накопленные ранее
+  изменения счетчика
+* значения записываются через `set_multi`, счетчики - одним `incr`/`decr`
+  на ключ; отсутствующий счетчик не мешает записи остальных
+
+Буфер сбрасывается при накоплении `max_size` ключей, при записи спустя
+`interval` секунд после предыдущего сброса, периодически при запуске через
+`start` и при завершении сервиса::
+
+    class Handler(services.Handler):
+        def start(self):
+            self.buffer = WriteBuffer(cache.instance.default)
+            self.buffer.attach(self)
+            ....
+
+        def report(self):
+            return {'cache_buffer': self.buffer.stats()}
+
+    handler.buffer.incr("visits", namespace="stats")
+    handler.buffer.set("last_seen:%s" % user_id, now, ttl=3600)
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from tornado.ioloop import PeriodicCallback
+
+
+__all__ = ['WriteBuffer']
+
+
+class WriteBuffer(object):
+    """
+    Буфер отложенной записи в кеш.
+    """
+
+    def __init__(self, conn, max_size=1000, interval=1.0):
+        """
+        Конструктор
+
+        :param Connection conn: подключение к кешу
+        :param int max_size: количество ключей, при котором буфер сбрасывается
+        :param float interval: максимальное время между сбросами в секундах
+        """
+        super(WriteBuffer, self).__init__()
+        self.conn = conn
+        self.max_size = max_size
+        self.interval = interval
+        self.writes = 0
+        self.merged = 0
+        self.flushes = 0
+        self.max_depth = 0
+        self.flushed_at = time.time()
+        # (namespace, ttl) -> {key: value}
+        self.__sets = OrderedDict()
+        # (namespace, key) -> delta
+        self.__counters = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__periodic = None
+
+    @property
+    def depth(self):
+        """
+        Количество ключей в буфере.
+        """
+        return sum(len(i) for i in self.__sets.values()) + len(self.__counters)
+
+    def set(self, key, value, namespace=None, ttl=None):
+        """
+        Отложенная запись значения.
+
+        :param str key: ключ
+        :param value: значение
+        :param str namespace: namespace для формирования ключа
+        :param int ttl: время жизни кеша
+        """
+        with self.__lock:
+            self.writes += 1
+            for group, values in self.__sets.items():
+                if group[0] == namespace and key in values:
+                    del values[key]
+                    self.merged += 1
+            if self.__counters.pop((namespace, key), None) is not None:
+                self.merged += 1
+            self.__sets.setdefault((namespace, ttl), OrderedDict())[key] = value
+        self.__written()
+
+    def incr(self, key, delta=1, namespace=None):
+        """
+        Отложенный инкремент.
+
+        :param str key: ключ
+        :param int delta: величина инкремента
+        :param str namespace: namespace для формирования ключа
+        """
+        with self.__lock:
+            self.writes += 1
+            item = (namespace, key)
+            if item in self.__counters:
+                self.merged += 1
+            self.__counters[item] = self.__counters.get(item, 0) + delta
+        self.__written()
+
+    def decr(self, key, delta=1, namespace=None):
+        """
+        Отложенный декремент.
+
+        :param str key: ключ
+        :param int delta: величина декремента
+        :param str namespace: namespace для формирования ключа
+        """
+        self.incr(key, -delta, namespace=namespace)
+
+    def flush(self):
+        """
+        Отправить накопленные операции: значения, затем счетчики.
+        """
+        with self.__lock:
+            sets, self.__sets = self.__sets, OrderedDict()
+            counters, self.__counters = self.__counters, OrderedDict()
+            self.flushed_at = time.time()
+            if not sets and not counters:
+                return
+            self.flushes += 1
+            for (namespace, ttl), values in sets.items():
+                if values:
+                    self.conn.set_multi(
+                        dict(values), namespace=namespace, ttl=ttl
+                    )
+            for (namespace, key), delta in counters.items():
+                if delta > 0:
+                    self.conn.incr(key, delta, namespace=namespace)
+                elif delta < 0:
+                    self.conn.decr(key, -delta, namespace=namespace)
+
+    def start(self):
+        """
+        Запустить периодический сброс буфера в текущем IOLoop.
+        """
+        if self.__periodic is None:
+            self.__periodic = PeriodicCallback(
+                self.__flush_safe, self.interval * 1000
+            )
+            self.__periodic.start()
+
+    def stop(self):
+        """
+        Остановить периодический сброс и сбросить буфер.
+        """
+        if self.__periodic is not None:
+            self.__periodic.stop()
+            self.__periodic = None
+        self.flush()
+
+    def attach(self, handler):
+        """
+        Сбросить буфер при завершении сервиса.
+
+        :param services.Handler handler: обработчик сервиса
+        """
+        handler.add_stop_callback(self.stop)
+
+    def stats(self):
+        """
+        Статистика буфера.
+
+        :return: dict
+        """
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'writes': self.writes,
+            'merged': self.merged,
+            'flushes': self.flushes
+        }
+
+    def __written(self):
+        depth = self.depth
+        self.max_depth = max(self.max_depth, depth)
+        if (depth >= self.max_size or
+                time.time() - self.flushed_at >= self.interval):
+            self.__flush_safe()
+
+    def __flush_safe(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("fail to flush cache write buffer")
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Хранение больших значений частями
+---------------------------------
+
+Сервер memcached не сохраняет значения больше 1 МБ. Сериализованное
+значение, размер которого превышает `chunk_size`, разбивается на части:
+под ключом значения сохраняется манифест, части сохраняются под
+отдельными ключами одним `set_multi` с тем же временем жизни и читаются
+одним `get_multi`.
+
+Манифест содержит идентификатор записи, количество частей, размер и
+контрольную сумму md5 значения. Ключи частей включают идентификатор
+записи, поэтому части разных записей одного ключа не смешиваются, а
+отсутствующая или поврежденная часть обнаруживается по контрольной сумме,
+и значение считается отсутствующим.
+
+Манифест имеет заголовок кодека с флагом `codecs.CHUNKED`.
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                // максимальный размер значения, сохраняемого одним ключом
+                "chunk_size": 1000000
+            }
+        }
+    }
+"""
+import os
+from hashlib import md5
+
+from .codecs import CHUNKED, HEADER_SIZE, MAGIC
+
+
+__all__ = ['ChunkError', 'split', 'is_manifest', 'chunk_keys', 'join']
+
+
+#: максимальный размер значения, сохраняемого одним ключом
+CHUNK_SIZE = 1000000
+
+_header = "%s%s%s" % (MAGIC, chr(0), chr(CHUNKED))
+
+
+class ChunkError(Exception):
+    """
+    Исключение. Не удалось сохранить части значения.
+    """
+
+
+def split(key, data, chunk_size=CHUNK_SIZE):
+    """
+    Разбить сериализованное значение на части.
+
+    :param str key: нормализованный ключ значения
+    :param str data: сериализованное значение
+    :param int chunk_size: размер части
+
+    :return: tuple (манифест, dict {ключ части: часть})
+    """
+    token = os.urandom(8).encode('hex')
+    parts = [
+        data[idx:idx + chunk_size]
+        for idx in xrange(0, len(data), chunk_size)
+    ]
+    manifest = "%s%s:%d:%d:%s" % (
+        _header, token, len(parts), len(data), md5(data).hexdigest()
+    )
+    keys = chunk_keys(key, manifest)
+    return manifest, dict(zip(keys, parts))
+
+
+def is_manifest(data):
+    """
+    Значение является манифестом.
+
+    :param str data: сериализованное значение
+
+    :return: bool
+    """
+    return bool(data) and data.startswith(_header)
+
+
+def chunk_keys(key, manifest):
+    """
+    Ключи частей значения.
+
+    :param str key: нормализованный ключ значения
+    :param str manifest: манифест
+
+    :return: list
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    token, count = manifest[HEADER_SIZE:].split(":")[:2]
+    prefix = "%s:%s" % (md5(key).hexdigest(), token)
+    return ["%s:%d" % (prefix, idx) for idx in xrange(int(count))]
+
+
+def join(key, manifest, chunks):
+    """
+    Собрать значение из частей.
+
+    :param str key: нормализованный ключ значения
+    :param str manifest: манифест
+    :param dict chunks: прочитанные части
+
+    :return: str|None значение или None, если части отсутствуют или повреждены
+    """
+    _, _, size, checksum = manifest[HEADER_SIZE:].split(":")
+    parts = []
+    for chunk_key in chunk_keys(key, manifest):
+        part = chunks.get(chunk_key)
+        if part is None:
+            return None
+        parts.append(part)
+    data = "".join(parts)
+    if len(data) != int(size) or md5(data).hexdigest() != checksum:
+        return None
+    return data
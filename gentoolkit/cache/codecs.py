@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Кодеки значений
+---------------
+
+Реестр форматов сериализации и алгоритмов сжатия значений кеша.
+
+Значение в формате JSON без сжатия сохраняется как есть (совместимо с
+ранее записанными данными и с `incr`/`decr`). Остальные значения
+снабжаются заголовком из трех байт: маркер, идентификатор кодека и флаги
+(алгоритм сжатия), поэтому при смене формата читатель всегда декодирует
+значение корректно.
+
+Читаются только значения в формате JSON и в кодеках, указанных в
+настройках подключения (`codec` и `namespace_codecs`); значение в другом
+формате, например pickle в кеше с кодеком json, считается отсутствующим,
+поэтому запись в сервер memcached не позволяет выполнить код у читателей.
+
+Поддерживаемые кодеки:
+
+* json - `gentoolkit.extjson`
+* msgpack - при наличии пакета `msgpack`
+* marshal - модуль `marshal` стандартной библиотеки
+* pickle - модуль `cPickle`
+
+Поддерживаемые алгоритмы сжатия:
+
+* zlib
+* lz4 - при наличии пакета `lz4`
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                // кодек по умолчанию
+                "codec": "json",
+                // кодеки для отдельных namespace
+                "namespace_codecs": {
+                    "namespaceA": "pickle"
+                },
+                // сжатие значений, размер которых превышает threshold
+                "compression": {
+                    "method": "zlib",
+                    "threshold": 1024
+                }
+            }
+        }
+    }
+"""
+import marshal
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+from gentoolkit import extjson as json
+
+
+__all__ = [
+    'UnknownCodec', 'Codec', 'Compressor', 'Serializer',
+    'register_codec', 'register_compressor', 'get_codec', 'get_compressor'
+]
+
+
+#: маркер заголовка, не может быть первым байтом JSON документа
+MAGIC = '\xfe'
+
+#: длина заголовка
+HEADER_SIZE = 3
+
+#: маска флагов алгоритма сжатия
+COMPRESSION_MASK = 0x0f
+
+#: флаг манифеста значения, сохраненного частями (см. `gentoolkit.cache.chunks`)
+CHUNKED = 0x10
+
+
+class UnknownCodec(Exception):
+    """
+    Исключение. Кодек или алгоритм сжатия не зарегистрирован.
+    """
+
+
+class Codec(object):
+    """
+    Формат сериализации.
+    """
+
+    def __init__(self, name, codec_id, dumps, loads):
+        """
+        Конструктор
+
+        :param str name: название
+        :param int codec_id: идентификатор, записывается в заголовок
+        :param callable dumps: сериализация
+        :param callable loads: десериализация
+        """
+        super(Codec, self).__init__()
+        self.name = name
+        self.id = codec_id
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return "cache.Codec<%s>" % self.name
+
+
+class Compressor(object):
+    """
+    Алгоритм сжатия.
+    """
+
+    def __init__(self, name, compressor_id, compress, decompress):
+        """
+        Конструктор
+
+        :param str name: название
+        :param int compressor_id: идентификатор, записывается во флаги заголовка
+        :param callable compress: сжатие
+        :param callable decompress: распаковка
+        """
+        super(Compressor, self).__init__()
+        self.name = name
+        self.id = compressor_id
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return "cache.Compressor<%s>" % self.name
+
+
+_codecs = {}
+_compressors = {}
+
+
+def register_codec(codec):
+    """
+    Зарегистрировать кодек. Доступен по названию и идентификатору.
+
+    :param Codec codec: кодек
+    """
+    _codecs[codec.name] = codec
+    _codecs[codec.id] = codec
+
+
+def register_compressor(compressor):
+    """
+    Зарегистрировать алгоритм сжатия. Доступен по названию и идентификатору.
+
+    :param Compressor compressor: алгоритм сжатия
+    """
+    if not 0 < compressor.id <= COMPRESSION_MASK:
+        raise ValueError("compressor id out of range %s" % compressor.id)
+    _compressors[compressor.name] = compressor
+    _compressors[compressor.id] = compressor
+
+
+def get_codec(name):
+    """
+    Кодек по названию или идентификатору.
+
+    :param str|int name: название или идентификатор
+
+    :return: Codec
+    :raises UnknownCodec: если кодек не зарегистрирован
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise UnknownCodec("codec %s not registered" % name)
+
+
+def get_compressor(name):
+    """
+    Алгоритм сжатия по названию или идентификатору.
+
+    :param str|int name: название или идентификатор
+
+    :return: Compressor
+    :raises UnknownCodec: если алгоритм не зарегистрирован
+    """
+    try:
+        return _compressors[name]
+    except KeyError:
+        raise UnknownCodec("compressor %s not registered" % name)
+
+
+register_codec(Codec('json', 0, json.dumps, json.loads))
+register_codec(Codec('marshal', 2, marshal.dumps, marshal.loads))
+register_codec(Codec(
+    'pickle', 3,
+    lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+    pickle.loads
+))
+if msgpack is not None:
+    register_codec(Codec(
+        'msgpack', 1,
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False)
+    ))
+
+register_compressor(Compressor('zlib', 1, zlib.compress, zlib.decompress))
+if lz4 is not None:
+    register_compressor(Compressor('lz4', 2, lz4.compress, lz4.decompress))
+
+
+class Serializer(object):
+    """
+    Сериализация значений с выбранным кодеком и сжатием.
+    """
+
+    def __init__(self, codec='json', compression=None, threshold=1024,
+                 accept=None):
+        """
+        Конструктор
+
+        :param str codec: название кодека
+        :param str compression: название алгоритма сжатия
+        :param int threshold: минимальный размер значения для сжатия
+        :param list accept: названия кодеков, допустимых при чтении, кроме `codec` и json
+        """
+        super(Serializer, self).__init__()
+        self.codec = get_codec(codec)
+        self.accept = frozenset(
+            [get_codec('json').id, self.codec.id] +
+            [get_codec(name).id for name in accept or []]
+        )
+        self.compressor = get_compressor(compression) if compression else None
+        self.threshold = threshold
+
+    def dumps(self, value):
+        """
+        Сериализовать значение.
+
+        :param value: значение
+
+        :return: str
+        """
+        data = self.codec.dumps(value)
+        flags = 0
+        if self.compressor is not None and len(data) >= self.threshold:
+            compressed = self.compressor.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= self.compressor.id
+        if not self.codec.id and not flags:
+            return data
+        return "%s%s%s%s" % (MAGIC, chr(self.codec.id), chr(flags), data)
+
+    def loads(self, data):
+        """
+        Десериализовать значение в одном из допустимых форматов.
+
+        :param str data: сериализованное значение
+
+        :return: Any
+        :raises UnknownCodec: если формат значения недопустим
+        """
+        if not data.startswith(MAGIC):
+            return json.loads(data)
+        if ord(data[1]) not in self.accept:
+            raise UnknownCodec("codec %s not accepted" % ord(data[1]))
+        codec = get_codec(ord(data[1]))
+        flags = ord(data[2])
+        if flags & CHUNKED:
+            raise ValueError("chunked value manifest can not be decoded")
+        data = data[HEADER_SIZE:]
+        if flags & COMPRESSION_MASK:
+            data = get_compressor(flags & COMPRESSION_MASK).decompress(data)
+        return codec.loads(data)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Объединение чтений из кеша
+--------------------------
+
+`Loader` собирает независимые запросы на чтение, выполненные в течение
+одной итерации IOLoop или внутри явного блока `batch`, и выполняет их
+одним `get_many` на каждый namespace. Повторные запросы одного ключа
+объединяются. Каждый вызов `load` возвращает `Future`, результат которого
+устанавливается после выполнения пакетного запроса.
+
+Объект создается на время обработки запроса и работает как с `Connection`,
+так и с `AsyncConnection`.
+
+Использование в обработчике Tornado::
+
+    class Handler(tornado.web.RequestHandler):
+        def prepare(self):
+            self.loader = Loader(cache.instance.default)
+
+        @gen.coroutine
+        def get(self):
+            user, product = yield [
+                self.loader.load("user:1"),
+                self.loader.load("product:2", namespace="catalog")
+            ]
+
+Использование без IOLoop::
+
+    loader = Loader(cache.instance.default)
+    with loader.batch():
+        user = loader.load("user:1")
+        product = loader.load("product:2")
+    user.result()
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from tornado import gen
+from tornado.concurrent import Future, is_future
+from tornado.ioloop import IOLoop
+
+
+__all__ = ['Loader']
+
+
+class Loader(object):
+    """
+    Объединение чтений из кеша в пакетные запросы.
+    """
+
+    def __init__(self, conn, namespace=None):
+        """
+        Конструктор
+
+        :param Connection|AsyncConnection conn: подключение к кешу
+        :param str namespace: namespace по умолчанию
+        """
+        super(Loader, self).__init__()
+        self.conn = conn
+        self.namespace = namespace
+        self.requests = 0
+        self.deduplicated = 0
+        self.batches = 0
+        # (namespace, key) -> [Future]
+        self.__queue = OrderedDict()
+        self.__scheduled = False
+        self.__depth = 0
+
+    def load(self, key, namespace=None):
+        """
+        Запросить значение. Запрос выполняется в конце текущей итерации
+        IOLoop или при выходе из блока `batch`.
+
+        :param str key: ключ
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(Any|None)
+        """
+        future = Future()
+        item = (namespace or self.namespace, key)
+        waiters = self.__queue.get(item)
+        if waiters is None:
+            self.__queue[item] = [future]
+        else:
+            waiters.append(future)
+            self.deduplicated += 1
+        self.requests += 1
+        if not self.__depth and not self.__scheduled:
+            self.__scheduled = True
+            IOLoop.current().add_callback(self.dispatch)
+        return future
+
+    def load_many(self, keys, namespace=None):
+        """
+        Запросить несколько значений.
+
+        :param list keys: ключи
+        :param str namespace: namespace для формирования ключа
+
+        :return: Future(list) значения в порядке ключей
+        """
+        return gen.multi([self.load(k, namespace=namespace) for k in keys])
+
+    @contextmanager
+    def batch(self):
+        """
+        Явный блок объединения запросов. Запросы выполняются при выходе из
+        внешнего блока.
+        """
+        self.__depth += 1
+        try:
+            yield self
+        finally:
+            self.__depth -= 1
+            if not self.__depth:
+                self.dispatch()
+
+    def dispatch(self):
+        """
+        Выполнить накопленные запросы, по одному `get_many` на namespace.
+        """
+        self.__scheduled = False
+        queue, self.__queue = self.__queue, OrderedDict()
+        groups = OrderedDict()
+        for namespace, key in queue:
+            groups.setdefault(namespace, []).append(key)
+        for namespace, keys in groups.items():
+            self.batches += 1
+            try:
+                result = self.conn.get_many(keys, namespace=namespace)
+            except Exception as exc:
+                self.__fail(queue, namespace, keys, exc)
+                continue
+            if is_future(result):
+                IOLoop.current().add_future(
+                    result,
+                    lambda f, ns=namespace, ks=keys: self.__done(queue, ns, ks, f)
+                )
+            else:
+                self.__resolve(queue, namespace, keys, result[0])
+
+    def __done(self, queue, namespace, keys, future):
+        try:
+            found, _ = future.result()
+        except Exception as exc:
+            self.__fail(queue, namespace, keys, exc)
+        else:
+            self.__resolve(queue, namespace, keys, found)
+
+    @staticmethod
+    def __resolve(queue, namespace, keys, found):
+        for key in keys:
+            value = found.get(key)
+            for future in queue[(namespace, key)]:
+                future.set_result(value)
+
+    @staticmethod
+    def __fail(queue, namespace, keys, exc):
+        for key in keys:
+            for future in queue[(namespace, key)]:
+                future.set_exception(exc)
+
+    def stats(self):
+        """
+        Статистика объединения запросов.
+
+        :return: dict
+        """
+        return {
+            'requests': self.requests,
+            'deduplicated': self.deduplicated,
+            'batches': self.batches,
+            'pending': len(self.__queue)
+        }
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный уровень кеша
+----------------------
+
+Кеш в памяти процесса (L1), расположенный перед сервером memcached.
+Записи вытесняются по алгоритму LRU при превышении ограничения на
+количество записей или на суммарный объем данных, а также по истечении
+времени жизни.
+
+В кеше хранятся сериализованные значения, поэтому объекты, возвращаемые
+из `Connection.get`, не разделяются между вызовами.
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "local": {
+                    // максимальное количество записей
+                    "max_entries": 1024,
+                    // максимальный объем данных в байтах
+                    "max_bytes": 1048576,
+                    // время жизни записи в секундах
+                    "ttl": 5
+                }
+            }
+        }
+    }
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+__all__ = ['LocalCache']
+
+
+class LocalCache(object):
+    """
+    LRU кеш с ограничением по времени жизни, количеству записей и объему.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=1 << 20, ttl=5):
+        """
+        Конструктор
+
+        :param int max_entries: максимальное количество записей
+        :param int max_bytes: максимальный объем данных в байтах
+        :param int ttl: время жизни записи по умолчанию
+        """
+        super(LocalCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires, size, value)
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Получить значение. Прочитанная запись становится самой свежей.
+
+        :param str key: ключ
+
+        :return: str|None
+        """
+        with self.__lock:
+            item = self.__data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] <= time.time():
+                self.size -= item[1]
+                self.misses += 1
+                return None
+            self.__data[key] = item
+            self.hits += 1
+            return item[2]
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохранить значение. Время жизни записи не превышает `ttl` кеша.
+
+        :param str key: ключ
+        :param str value: сериализованное значение
+        :param int ttl: время жизни записи
+
+        :return: Bool
+        """
+        size = len(key) + len(value)
+        with self.__lock:
+            self.__remove(key)
+            if size > self.max_bytes:
+                return False
+            ttl = min(ttl, self.ttl) if ttl else self.ttl
+            self.__data[key] = (time.time() + ttl, size, value)
+            self.size += size
+            while self.__data and (
+                len(self.__data) > self.max_entries or
+                self.size > self.max_bytes
+            ):
+                _, item = self.__data.popitem(last=False)
+                self.size -= item[1]
+                self.evictions += 1
+            return True
+
+    def delete(self, key):
+        """
+        Удалить значение.
+
+        :param str key: ключ
+        """
+        with self.__lock:
+            self.__remove(key)
+
+    def clear(self):
+        """
+        Очистить кеш.
+        """
+        with self.__lock:
+            self.__data.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Статистика использования кеша.
+
+        :return: dict
+        """
+        return {
+            'entries': len(self.__data),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def __remove(self, key):
+        item = self.__data.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики подключений кеша
+------------------------
+
+`ConnectionMetrics` накапливает в памяти процесса статистику операций
+подключения по namespace: попадания, промахи, ошибки, гистограмму времени
+выполнения и размер сериализованных значений.
+
+Метрики всех открытых подключений отправляются в `profiler.Profiler` и
+включаются в отчет экземпляра `services.Pool`::
+
+    class Handler(services.Handler):
+        def start(self):
+            cache.attach_metrics(self)
+            ....
+
+Имена метрик: `cache.<conn_name>.<namespace>.<метрика>`, например
+`cache.default.catalog.hits.sum`, `cache.default.catalog.latency.p99`.
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                // сбор метрик, по умолчанию включен
+                "metrics": true
+            }
+        }
+    }
+"""
+import bisect
+import re
+import threading
+
+
+__all__ = ['Histogram', 'NamespaceMetrics', 'ConnectionMetrics']
+
+
+#: границы интервалов гистограммы времени выполнения в миллисекундах
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_metric_chars = re.compile(r"[^0-9A-Za-z_\-]+")
+
+
+class Histogram(object):
+    """
+    Гистограмма с фиксированными границами интервалов.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Конструктор
+
+        :param tuple buckets: верхние границы интервалов по возрастанию
+        """
+        super(Histogram, self).__init__()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        Учесть значение.
+
+        :param float value: значение
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        Оценка перцентиля по верхней границе интервала.
+
+        :param float percent: перцентиль от 0 до 100
+
+        :return: float
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if idx < len(self.buckets):
+                    return min(self.buckets[idx], self.max)
+                return self.max
+        return self.max
+
+    def report(self):
+        """
+        :return: dict
+        """
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': dict(
+                ("le_%s" % b, c)
+                for b, c in zip(self.buckets + ("inf",), self.counts)
+                if c
+            )
+        }
+
+
+class NamespaceMetrics(object):
+    """
+    Статистика операций одного namespace.
+    """
+
+    def __init__(self):
+        super(NamespaceMetrics, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.operations = {}
+        self.latency = Histogram()
+        self.size = Histogram((64, 256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
+    def report(self):
+        """
+        :return: dict
+        """
+        reads = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_ratio': float(self.hits) / reads if reads else 0.0,
+            'operations': dict(self.operations),
+            'latency': self.latency.report(),
+            'size': self.size.report()
+        }
+
+
+class ConnectionMetrics(object):
+    """
+    Статистика операций подключения по namespace.
+    """
+
+    def __init__(self):
+        super(ConnectionMetrics, self).__init__()
+        # namespace -> NamespaceMetrics
+        self.__namespaces = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, namespace, operation, elapsed, hits=0, misses=0,
+                sizes=(), error=False):
+        """
+        Учесть операцию.
+
+        :param str namespace: namespace
+        :param str operation: операция (get, set, ...)
+        :param float elapsed: время выполнения в секундах
+        :param int hits: количество найденных значений
+        :param int misses: количество отсутствующих значений
+        :param list sizes: размеры сериализованных значений
+        :param bool error: операция завершилась ошибкой
+        """
+        with self.__lock:
+            metrics = self.__namespaces.get(namespace)
+            if metrics is None:
+                metrics = self.__namespaces[namespace] = NamespaceMetrics()
+            metrics.hits += hits
+            metrics.misses += misses
+            if error:
+                metrics.errors += 1
+            metrics.operations[operation] = (
+                metrics.operations.get(operation, 0) + 1
+            )
+            metrics.latency.add(elapsed * 1000)
+            for size in sizes:
+                metrics.size.add(size)
+
+    def report(self):
+        """
+        Статистика по namespace. Namespace по умолчанию обозначается
+        `default`.
+
+        :return: dict
+        """
+        with self.__lock:
+            return dict(
+                (ns or 'default', m.report())
+                for ns, m in self.__namespaces.items()
+            )
+
+    def reset(self):
+        """
+        Сбросить накопленную статистику.
+        """
+        with self.__lock:
+            self.__namespaces = {}
+
+    def flush(self, profiler, prefix):
+        """
+        Добавить метрики в profiler и сбросить статистику.
+
+        :param Profiler profiler: профайлер
+        :param str prefix: префикс метрик
+        """
+        report = self.report()
+        self.reset()
+        for namespace, data in report.items():
+            name = "%s.%s" % (prefix, _metric_chars.sub("_", namespace))
+            for key in ('hits', 'misses', 'errors'):
+                profiler.append("%s.%s.sum" % (name, key), data[key])
+            profiler.append("%s.hit_ratio" % name, data['hit_ratio'])
+            profiler.append("%s.latency.p50" % name, data['latency']['p50'])
+            profiler.append("%s.latency.p99" % name, data['latency']['p99'])
+            profiler.append("%s.latency.max" % name, data['latency']['max'])
+            profiler.append("%s.size" % name, data['size']['avg'])
+            profiler.append(
+                "%s.bytes.sum" % name,
+                int(data['size']['avg'] * data['size']['count'])
+            )
+            for operation, count in data['operations'].items():
+                profiler.append("%s.%s.sum" % (name, operation), count)
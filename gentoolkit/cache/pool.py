@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Пулы клиентов memcached
+-----------------------
+
+Клиент `pylibmc.Client` не может одновременно использоваться несколькими
+потоками. Подключение `Connection` получает клиента из пула на время
+выполнения операции::
+
+    with pool.reserve() as mc:
+        mc.get(key)
+
+Типы пулов:
+
+* single - один клиент на подключение, без синхронизации (по умолчанию)
+* thread_mapped - отдельный клиент для каждого потока
+* checkout - ограниченный набор клиентов, поток ожидает освобождения
+  клиента не более `wait` секунд
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "pool": {
+                    // тип пула
+                    "type": "checkout",
+                    // максимальное количество клиентов
+                    "size": 8,
+                    // время ожидания свободного клиента в секундах
+                    "wait": 0.5
+                }
+            }
+        }
+    }
+"""
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+__all__ = [
+    'PoolTimeout', 'SinglePool', 'ThreadMappedPool', 'CheckoutPool',
+    'create_pool'
+]
+
+
+class PoolTimeout(Exception):
+    """
+    Исключение. Истекло время ожидания свободного клиента.
+    """
+
+
+class SinglePool(object):
+    """
+    Пул из одного клиента, используется без синхронизации.
+    """
+
+    def __init__(self, client):
+        """
+        Конструктор
+
+        :param pylibmc.Client client: клиент
+        """
+        super(SinglePool, self).__init__()
+        self.client = client
+        self.checkouts = 0
+
+    @contextmanager
+    def reserve(self):
+        """
+        Получить клиента на время выполнения операции.
+
+        :return: pylibmc.Client
+        """
+        self.checkouts += 1
+        yield self.client
+
+    def stats(self):
+        """
+        Статистика использования пула.
+
+        :return: dict
+        """
+        return {
+            'type': 'single',
+            'size': 1,
+            'checkouts': self.checkouts
+        }
+
+
+class ThreadMappedPool(SinglePool):
+    """
+    Пул с отдельным клиентом для каждого потока. Клиенты создаются
+    клонированием исходного клиента при первом обращении из потока.
+    """
+
+    def __init__(self, client):
+        super(ThreadMappedPool, self).__init__(client)
+        self.created = 0
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def reserve(self):
+        client = getattr(self.__local, 'client', None)
+        if client is None:
+            client = self.__local.client = self.client.clone()
+            with self.__lock:
+                self.created += 1
+        self.checkouts += 1
+        yield client
+
+    def stats(self):
+        return {
+            'type': 'thread_mapped',
+            'size': self.created,
+            'checkouts': self.checkouts
+        }
+
+
+class CheckoutPool(SinglePool):
+    """
+    Ограниченный пул клиентов. Клиенты создаются клонированием исходного
+    клиента по мере необходимости, но не более `size`.
+    """
+
+    def __init__(self, client, size=8, wait=0.5):
+        """
+        Конструктор
+
+        :param pylibmc.Client client: клиент
+        :param int size: максимальное количество клиентов
+        :param float wait: время ожидания свободного клиента в секундах
+        """
+        super(CheckoutPool, self).__init__(client)
+        self.size = size
+        self.wait = wait
+        self.created = 1
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.__clients = Queue.LifoQueue()
+        self.__clients.put(client)
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def reserve(self):
+        client = self.__checkout()
+        try:
+            yield client
+        finally:
+            with self.__lock:
+                self.in_use -= 1
+            self.__clients.put(client)
+
+    def __checkout(self):
+        try:
+            client = self.__clients.get_nowait()
+        except Queue.Empty:
+            client = None
+            with self.__lock:
+                if self.created < self.size:
+                    self.created += 1
+                    client = self.client.clone()
+            if client is None:
+                started = time.time()
+                try:
+                    client = self.__clients.get(timeout=self.wait)
+                except Queue.Empty:
+                    with self.__lock:
+                        self.timeouts += 1
+                    raise PoolTimeout(
+                        "no free client after %s seconds" % self.wait
+                    )
+                finally:
+                    with self.__lock:
+                        self.waits += 1
+                        self.wait_time += time.time() - started
+        with self.__lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return client
+
+    def stats(self):
+        return {
+            'type': 'checkout',
+            'size': self.size,
+            'created': self.created,
+            'in_use': self.in_use,
+            'max_in_use': self.max_in_use,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'timeouts': self.timeouts
+        }
+
+
+def create_pool(client, config=None):
+    """
+    Создать пул клиентов по настройкам.
+
+    :param pylibmc.Client client: исходный клиент
+    :param dict config: настройки пула
+
+    :return: SinglePool|ThreadMappedPool|CheckoutPool
+    """
+    config = config or {}
+    kind = config.get('type', 'single')
+    if kind == 'single':
+        return SinglePool(client)
+    if kind == 'thread_mapped':
+        return ThreadMappedPool(client)
+    if kind == 'checkout':
+        return CheckoutPool(
+            client,
+            size=config.get('size', 8),
+            wait=config.get('wait', 0.5)
+        )
+    raise ValueError("unknown pool type %s" % kind)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Кольцо консистентного хеширования
+---------------------------------
+
+Распределение ключей между серверами memcached по алгоритму ketama. Каждый
+сервер представлен на кольце `points * weight` виртуальными узлами, поэтому
+при добавлении или удалении сервера перемещается только часть ключей,
+пропорциональная его весу.
+
+Ключи, частота чтения которых превышает `hot_threshold` запросов в секунду,
+считаются горячими: записи таких ключей дублируются на `hot_replicas`
+соседних серверов кольца, а чтения распределяются между репликами. Если на
+реплике значения еще нет, оно читается с основного сервера и копируется на
+реплику со временем жизни не более `hot_ttl`.
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "host": ["10.0.0.1:11211", "10.0.0.2:11211", "10.0.0.3:11211"],
+                "ring": {
+                    // количество виртуальных узлов на единицу веса
+                    "points": 160,
+                    // веса серверов, по умолчанию 1
+                    "weights": {"10.0.0.1:11211": 2},
+                    // порог частоты чтения горячего ключа, запросов в секунду
+                    "hot_threshold": 1000,
+                    // количество серверов, хранящих горячий ключ
+                    "hot_replicas": 2,
+                    // максимальное время жизни копии на реплике
+                    "hot_ttl": 5
+                }
+            }
+        }
+    }
+"""
+import bisect
+import random
+import struct
+import threading
+import time
+from hashlib import md5
+
+import pylibmc
+
+
+__all__ = ['HashRing', 'HotKeys', 'RingClient']
+
+
+class HashRing(object):
+    """
+    Кольцо консистентного хеширования ketama.
+    """
+
+    def __init__(self, hosts, weights=None, points=160):
+        """
+        Конструктор
+
+        :param list hosts: серверы
+        :param dict weights: веса серверов
+        :param int points: количество виртуальных узлов на единицу веса
+        """
+        super(HashRing, self).__init__()
+        weights = weights or {}
+        self.hosts = list(hosts)
+        ring = []
+        for host in self.hosts:
+            # каждый md5 дает четыре точки кольца
+            for idx in xrange(max(int(points * weights.get(host, 1)) // 4, 1)):
+                digest = md5("%s-%d" % (host, idx)).digest()
+                for point in struct.unpack("<4I", digest):
+                    ring.append((point, host))
+        ring.sort()
+        self.__points = [point for point, _ in ring]
+        self.__hosts = [host for _, host in ring]
+
+    @staticmethod
+    def hash(key):
+        """
+        Положение ключа на кольце.
+
+        :param str key: ключ
+
+        :return: int
+        """
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return struct.unpack("<I", md5(key).digest()[:4])[0]
+
+    def get_node(self, key):
+        """
+        Сервер, на котором хранится ключ.
+
+        :param str key: ключ
+
+        :return: str
+        """
+        idx = bisect.bisect(self.__points, self.hash(key))
+        return self.__hosts[idx % len(self.__hosts)]
+
+    def get_nodes(self, key, count):
+        """
+        Несколько различных серверов для ключа, первый из них основной.
+
+        :param str key: ключ
+        :param int count: количество серверов
+
+        :return: list
+        """
+        count = min(count, len(self.hosts))
+        idx = bisect.bisect(self.__points, self.hash(key))
+        nodes = []
+        for step in xrange(len(self.__hosts)):
+            host = self.__hosts[(idx + step) % len(self.__hosts)]
+            if host not in nodes:
+                nodes.append(host)
+                if len(nodes) >= count:
+                    break
+        return nodes
+
+
+class HotKeys(object):
+    """
+    Учет частоты чтения ключей. Частота ключа определяется по количеству
+    чтений за предыдущее окно длительностью `window` секунд.
+    """
+
+    def __init__(self, threshold, window=1.0):
+        """
+        Конструктор
+
+        :param float threshold: порог частоты чтения, запросов в секунду
+        :param float window: длительность окна в секундах
+        """
+        super(HotKeys, self).__init__()
+        self.threshold = threshold
+        self.window = window
+        self.__current = {}
+        self.__hot = frozenset()
+        self.__started = time.time()
+        self.__lock = threading.Lock()
+
+    def touch(self, keys):
+        """
+        Учесть чтение ключей.
+
+        :param list keys: ключи
+        """
+        with self.__lock:
+            now = time.time()
+            if now - self.__started >= self.window:
+                limit = self.threshold * (now - self.__started)
+                self.__hot = frozenset(
+                    k for k, v in self.__current.items() if v >= limit
+                )
+                self.__current = {}
+                self.__started = now
+            for key in keys:
+                self.__current[key] = self.__current.get(key, 0) + 1
+
+    def is_hot(self, key):
+        """
+        Ключ горячий в текущем окне.
+
+        :param str key: ключ
+
+        :return: bool
+        """
+        return key in self.__hot
+
+    def hot(self):
+        """
+        Горячие ключи текущего окна.
+
+        :return: list
+        """
+        return sorted(self.__hot)
+
+
+class RingClient(object):
+    """
+    Клиент memcached с распределением ключей по кольцу консистентного
+    хеширования. Повторяет интерфейс `pylibmc.Client`, используемый
+    `gentoolkit.cache.Connection`, поэтому работает с любым пулом клиентов.
+    """
+
+    def __init__(self, hosts, config=None, params=None, clients=None,
+                 hot_keys=None):
+        """
+        Конструктор
+
+        :param list hosts: серверы
+        :param dict config: настройки кольца
+        :param dict params: параметры `pylibmc.Client`
+        :param dict clients: клиенты серверов (используется при клонировании)
+        :param HotKeys hot_keys: учет горячих ключей (используется при клонировании)
+        """
+        super(RingClient, self).__init__()
+        config = config or {}
+        self.config = config
+        self.params = params or {}
+        self.ring = HashRing(
+            hosts, config.get("weights"), config.get("points", 160)
+        )
+        self.replicas = config.get("hot_replicas", 1)
+        self.hot_ttl = config.get("hot_ttl", 5)
+        threshold = config.get("hot_threshold")
+        if hot_keys is None and threshold and self.replicas > 1:
+            hot_keys = HotKeys(threshold)
+        self.hot_keys = hot_keys
+        self.clients = clients or dict(
+            (host, pylibmc.Client([host], **self.params))
+            for host in self.ring.hosts
+        )
+
+    def clone(self):
+        """
+        Копия клиента для использования в другом потоке. Кольцо и учет
+        горячих ключей общие.
+
+        :return: RingClient
+        """
+        return RingClient(
+            self.ring.hosts, self.config, self.params,
+            clients=dict((h, c.clone()) for h, c in self.clients.items()),
+            hot_keys=self.hot_keys
+        )
+
+    def __replicas(self, key):
+        if self.hot_keys is not None and self.hot_keys.is_hot(key):
+            return self.ring.get_nodes(key, self.replicas)
+        return [self.ring.get_node(key)]
+
+    def __read_node(self, key):
+        nodes = self.__replicas(key)
+        return nodes[0], random.choice(nodes)
+
+    def __ttl(self, ttl):
+        return min(ttl, self.hot_ttl) if ttl else self.hot_ttl
+
+    def get(self, key):
+        if self.hot_keys is not None:
+            self.hot_keys.touch([key])
+        primary, node = self.__read_node(key)
+        value = self.clients[node].get(key)
+        if value is None and node != primary:
+            value = self.clients[primary].get(key)
+            if value is not None:
+                self.clients[node].set(key, value, time=self.hot_ttl)
+        return value
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        if self.hot_keys is not None:
+            self.hot_keys.touch(keys)
+        groups = {}
+        primaries = {}
+        for key in keys:
+            primary, node = self.__read_node(key)
+            groups.setdefault(node, []).append(key)
+            primaries[key] = primary
+        ret = {}
+        repair = {}
+        for node, group in groups.items():
+            ret.update(self.clients[node].get_multi(group) or {})
+            for key in group:
+                if key not in ret and primaries[key] != node:
+                    repair.setdefault(primaries[key], []).append((key, node))
+        for primary, items in repair.items():
+            fetched = self.clients[primary].get_multi(
+                [k for k, _ in items]
+            ) or {}
+            for key, node in items:
+                if key in fetched:
+                    ret[key] = fetched[key]
+                    self.clients[node].set(key, fetched[key], time=self.hot_ttl)
+        return ret
+
+    def gets(self, key):
+        return self.clients[self.ring.get_node(key)].gets(key)
+
+    def set(self, key, value, time=0):
+        nodes = self.__replicas(key)
+        stored = self.clients[nodes[0]].set(key, value, time=time)
+        for node in nodes[1:]:
+            self.clients[node].set(key, value, time=self.__ttl(time))
+        return stored
+
+    def set_multi(self, values, time=0):
+        groups = {}
+        replicas = {}
+        for key, value in values.items():
+            nodes = self.__replicas(key)
+            groups.setdefault(nodes[0], {})[key] = value
+            for node in nodes[1:]:
+                replicas.setdefault(node, {})[key] = value
+        failed = []
+        for node, group in groups.items():
+            failed.extend(self.clients[node].set_multi(group, time=time) or [])
+        for node, group in replicas.items():
+            self.clients[node].set_multi(group, time=self.__ttl(time))
+        return failed
+
+    def add(self, key, value, time=0):
+        return self.clients[self.ring.get_node(key)].add(key, value, time=time)
+
+    def cas(self, key, value, cas, time=0):
+        nodes = self.__replicas(key)
+        stored = self.clients[nodes[0]].cas(key, value, cas, time=time)
+        if stored:
+            self.__drop_replicas(key, nodes)
+        return stored
+
+    def delete(self, key):
+        nodes = self.__replicas(key)
+        self.__drop_replicas(key, nodes)
+        return self.clients[nodes[0]].delete(key)
+
+    def delete_multi(self, keys):
+        return all([self.delete(key) for key in keys])
+
+    def incr(self, key, delta=1):
+        nodes = self.__replicas(key)
+        value = self.clients[nodes[0]].incr(key, delta)
+        self.__drop_replicas(key, nodes)
+        return value
+
+    def decr(self, key, delta=1):
+        nodes = self.__replicas(key)
+        value = self.clients[nodes[0]].decr(key, delta)
+        self.__drop_replicas(key, nodes)
+        return value
+
+    def __drop_replicas(self, key, nodes):
+        for node in nodes[1:]:
+            self.clients[node].delete(key)
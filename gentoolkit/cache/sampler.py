@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Выборка горячих ключей
+----------------------
+
+`KeySampler` учитывает случайную выборку операций подключения (доля
+`rate`) и для каждого namespace хранит наиболее частые ключи по количеству
+чтений, записей и по объему переданных данных. Для подсчета используется
+алгоритм space-saving с ограниченным количеством счетчиков `capacity`,
+поэтому расход памяти не зависит от количества ключей. Оценки в отчете
+пересчитаны на весь поток операций с учетом доли выборки.
+
+Просмотр из manhole::
+
+    >>> from gentoolkit import cache
+    >>> cache.hot_keys()
+    {'default': {'catalog': {'reads': [('product:1', 3200), ...], ...}}}
+    >>> cache.instance.default.sampler.top('catalog', 'bytes', 5)
+
+Периодическая отправка в `profiler.Profiler`::
+
+    class Handler(services.Handler):
+        def start(self):
+            cache.instance.default.sampler.attach(self)
+            ....
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "sampler": {
+                    // доля учитываемых операций
+                    "rate": 0.01,
+                    // количество счетчиков на namespace
+                    "capacity": 64,
+                    // количество ключей в отчете
+                    "top": 10,
+                    // интервал отправки в profiler в секундах
+                    "interval": 60,
+                    // префикс метрик
+                    "prefix": "cache.hot_keys"
+                }
+            }
+        }
+    }
+"""
+import logging
+import random
+import re
+import threading
+
+from tornado.ioloop import PeriodicCallback
+
+from gentoolkit.profiler import Profiler
+
+
+__all__ = ['SpaceSaving', 'KeySampler']
+
+
+#: виды статистики
+KINDS = ('reads', 'writes', 'bytes')
+
+_metric_chars = re.compile(r"[^0-9A-Za-z_\-]+")
+
+
+class SpaceSaving(object):
+    """
+    Приближенный top-K по алгоритму space-saving. Если ключ вытесняет
+    счетчик с минимальным значением, он наследует это значение как
+    погрешность оценки.
+    """
+
+    def __init__(self, capacity=64):
+        """
+        Конструктор
+
+        :param int capacity: количество счетчиков
+        """
+        super(SpaceSaving, self).__init__()
+        self.capacity = capacity
+        # key -> [оценка, погрешность]
+        self.counters = {}
+
+    def offer(self, key, weight=1):
+        """
+        Учесть ключ.
+
+        :param str key: ключ
+        :param int weight: вес
+        """
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def top(self, limit=10):
+        """
+        Наиболее частые ключи.
+
+        :param int limit: количество ключей
+
+        :return: list [(ключ, оценка, погрешность)]
+        """
+        items = sorted(
+            self.counters.items(), key=lambda item: item[1][0], reverse=True
+        )
+        return [(k, v[0], v[1]) for k, v in items[:limit]]
+
+
+class KeySampler(object):
+    """
+    Выборка горячих ключей подключения по namespace.
+    """
+
+    def __init__(self, rate=0.01, capacity=64, top=10, interval=60,
+                 prefix="cache.hot_keys"):
+        """
+        Конструктор
+
+        :param float rate: доля учитываемых операций
+        :param int capacity: количество счетчиков на namespace
+        :param int top: количество ключей в отчете
+        :param float interval: интервал отправки в profiler в секундах
+        :param str prefix: префикс метрик
+        """
+        super(KeySampler, self).__init__()
+        self.rate = rate
+        self.capacity = capacity
+        self.limit = top
+        self.interval = interval
+        self.prefix = prefix
+        self.sampled = 0
+        # namespace -> {вид статистики: SpaceSaving}
+        self.__namespaces = {}
+        self.__lock = threading.Lock()
+        self.__periodic = None
+
+    def record(self, kind, namespace, key, size=0):
+        """
+        Учесть операцию с вероятностью `rate`.
+
+        :param str kind: reads|writes
+        :param str namespace: namespace
+        :param str key: ключ
+        :param int size: размер сериализованного значения
+        """
+        if random.random() >= self.rate:
+            return
+        with self.__lock:
+            counters = self.__namespaces.get(namespace)
+            if counters is None:
+                counters = self.__namespaces[namespace] = dict(
+                    (k, SpaceSaving(self.capacity)) for k in KINDS
+                )
+            counters[kind].offer(key)
+            if size:
+                counters['bytes'].offer(key, size)
+            self.sampled += 1
+
+    def record_many(self, kind, namespace, sizes):
+        """
+        Учесть пакетную операцию.
+
+        :param str kind: reads|writes
+        :param str namespace: namespace
+        :param dict sizes: ключ -> размер сериализованного значения
+        """
+        for key, size in sizes.items():
+            self.record(kind, namespace, key, size)
+
+    def top(self, namespace=None, kind='reads', limit=None):
+        """
+        Наиболее частые ключи namespace с оценкой, пересчитанной на весь
+        поток операций.
+
+        :param str namespace: namespace
+        :param str kind: reads|writes|bytes
+        :param int limit: количество ключей
+
+        :return: list [(ключ, оценка)]
+        """
+        with self.__lock:
+            counters = self.__namespaces.get(namespace or '')
+            if counters is None:
+                return []
+            return [
+                (key, int(count / self.rate))
+                for key, count, _ in counters[kind].top(limit or self.limit)
+            ]
+
+    def report(self, limit=None):
+        """
+        Наиболее частые ключи всех namespace.
+
+        :param int limit: количество ключей
+
+        :return: dict {namespace: {вид статистики: [(ключ, оценка)]}}
+        """
+        return dict(
+            (ns, dict((kind, self.top(ns, kind, limit)) for kind in KINDS))
+            for ns in list(self.__namespaces)
+        )
+
+    def reset(self):
+        """
+        Сбросить накопленную статистику.
+        """
+        with self.__lock:
+            self.__namespaces = {}
+            self.sampled = 0
+
+    def flush(self, profiler=None):
+        """
+        Отправить отчет в profiler и сбросить статистику. Метрика
+        `<prefix>.<namespace>.<вид статистики>.<ключ>`.
+
+        :param Profiler profiler: профайлер
+        """
+        report = self.report()
+        self.reset()
+        profiler = profiler or Profiler(self.prefix)
+        for namespace, kinds in report.items():
+            for kind, items in kinds.items():
+                for key, count in items:
+                    profiler.append(
+                        "%s.%s.%s" % (
+                            _metric_name(namespace or 'default'), kind,
+                            _metric_name(key)
+                        ),
+                        count
+                    )
+        profiler.flush()
+
+    def __flush_safe(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Hot keys flush fail")
+
+    def start(self):
+        """
+        Запустить периодическую отправку отчета в текущем IOLoop.
+        """
+        if self.__periodic is None:
+            self.__periodic = PeriodicCallback(
+                self.__flush_safe, self.interval * 1000
+            )
+            self.__periodic.start()
+
+    def stop(self):
+        """
+        Остановить периодическую отправку и отправить накопленный отчет.
+        """
+        if self.__periodic is not None:
+            self.__periodic.stop()
+            self.__periodic = None
+        self.__flush_safe()
+
+    def attach(self, handler):
+        """
+        Запустить периодическую отправку и отправить отчет при завершении
+        сервиса.
+
+        :param services.Handler handler: обработчик сервиса
+        """
+        self.start()
+        handler.add_stop_callback(self.stop)
+
+
+def _metric_name(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return _metric_chars.sub("_", str(value)).strip("_") or "_"
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+Встроенный сервер memcached
+---------------------------
+
+Сервер текстового протокола memcached на Tornado для установки на одном
+сервере без отдельного memcached и для нагрузочного тестирования
+(см. `gentoolkit.cache.benchmark`). Данные хранятся в памяти процесса,
+при превышении ограничения `max_bytes` вытесняются давно не
+использовавшиеся значения (LRU).
+
+Поддерживаемые команды: get, gets, set, add, replace, cas, incr, decr,
+delete, flush_all, version, stats, quit. Команды изменения данных
+поддерживают `noreply`.
+
+Запуск::
+
+    python -m gentoolkit.cache.server --port 11211 --max-bytes 67108864
+
+Запуск в фоновом потоке::
+
+    with LocalServer(max_bytes=1 << 20) as server:
+        client = pylibmc.Client([server.address])
+"""
+import argparse
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+
+
+__all__ = ['Storage', 'MemcacheServer', 'LocalServer']
+
+
+#: версия протокола, возвращаемая командой version
+VERSION = "1.4.0-gentoolkit"
+
+#: время жизни, начиная с которого оно задано абсолютным временем unix
+RELATIVE_TTL_LIMIT = 60 * 60 * 24 * 30
+
+#: учитываемый объем служебных данных записи
+ITEM_OVERHEAD = 48
+
+#: максимальная длина ключа
+MAX_KEY_LENGTH = 250
+
+#: максимальное значение счетчика
+COUNTER_LIMIT = 1 << 64
+
+
+class Storage(object):
+    """
+    Хранилище значений с вытеснением LRU по объему данных.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        """
+        Конструктор
+
+        :param int max_bytes: максимальный объем данных в байтах
+        """
+        super(Storage, self).__init__()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__cas = 0
+        # key -> [значение, флаги, время устаревания, cas]
+        self.__items = OrderedDict()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key):
+        """
+        Запись по ключу.
+
+        :param str key: ключ
+
+        :return: list [значение, флаги, время устаревания, cas]|None
+        """
+        item = self.__find(key)
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def set(self, key, value, flags=0, ttl=0):
+        """
+        Сохранить значение.
+
+        :param str key: ключ
+        :param str value: значение
+        :param int flags: флаги клиента
+        :param int ttl: время жизни по правилам memcached
+
+        :return: bool
+        """
+        size = len(key) + len(value) + ITEM_OVERHEAD
+        self.__remove(key)
+        if size > self.max_bytes:
+            return False
+        self.__cas += 1
+        self.__items[key] = [value, flags, _expires(ttl), self.__cas]
+        self.size += size
+        while self.size > self.max_bytes:
+            self.__remove(next(iter(self.__items)))
+            self.evictions += 1
+        return True
+
+    def add(self, key, value, flags=0, ttl=0):
+        if self.__find(key) is not None:
+            return False
+        return self.set(key, value, flags, ttl)
+
+    def replace(self, key, value, flags=0, ttl=0):
+        if self.__find(key) is None:
+            return False
+        return self.set(key, value, flags, ttl)
+
+    def cas(self, key, value, flags, ttl, cas):
+        """
+        Сохранить значение, если оно не изменилось после чтения.
+
+        :return: STORED|EXISTS|NOT_FOUND
+        """
+        item = self.__find(key)
+        if item is None:
+            return "NOT_FOUND"
+        if item[3] != cas:
+            return "EXISTS"
+        self.set(key, value, flags, ttl)
+        return "STORED"
+
+    def incr(self, key, delta):
+        """
+        Изменить числовое значение. Отрицательное изменение не уменьшает
+        значение ниже нуля.
+
+        :return: int|None
+        :raises ValueError: если значение не является числом
+        """
+        item = self.__find(key)
+        if item is None:
+            return None
+        if not item[0].isdigit():
+            raise ValueError(key)
+        value = max(int(item[0]) + delta, 0) % COUNTER_LIMIT
+        self.size += len(str(value)) - len(item[0])
+        self.__cas += 1
+        item[0] = str(value)
+        item[3] = self.__cas
+        return value
+
+    def delete(self, key):
+        if self.__find(key) is None:
+            return False
+        self.__remove(key)
+        return True
+
+    def flush(self):
+        self.__items = OrderedDict()
+        self.size = 0
+
+    def __find(self, key):
+        item = self.__items.get(key)
+        if item is None:
+            return None
+        if item[2] and item[2] <= time.time():
+            self.__remove(key)
+            return None
+        self.__items[key] = self.__items.pop(key)
+        return item
+
+    def __remove(self, key):
+        item = self.__items.pop(key, None)
+        if item is not None:
+            self.size -= len(key) + len(item[0]) + ITEM_OVERHEAD
+
+
+def _expires(ttl):
+    if ttl < 0:
+        return -1
+    if not ttl:
+        return 0
+    if ttl > RELATIVE_TTL_LIMIT:
+        return ttl
+    return time.time() + ttl
+
+
+class ClientError(Exception):
+    """
+    Исключение. Некорректная команда клиента.
+    """
+
+
+class MemcacheServer(TCPServer):
+    """
+    Сервер текстового протокола memcached.
+    """
+
+    def __init__(self, max_bytes=64 << 20, **kwargs):
+        """
+        Конструктор
+
+        :param int max_bytes: максимальный объем данных в байтах
+        """
+        super(MemcacheServer, self).__init__(**kwargs)
+        self.storage = Storage(max_bytes)
+        self.started = time.time()
+        self.connections = 0
+        self.commands = {}
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        try:
+            while True:
+                line = yield stream.read_until("\r\n")
+                parts = line[:-2].split()
+                if not parts:
+                    stream.write("ERROR\r\n")
+                    continue
+                command = parts[0].lower()
+                if command == "quit":
+                    break
+                self.commands[command] = self.commands.get(command, 0) + 1
+                try:
+                    response = yield self.execute(stream, command, parts[1:])
+                except ClientError as exc:
+                    response = "CLIENT_ERROR %s\r\n" % exc
+                if response:
+                    stream.write(response)
+        except StreamClosedError:
+            pass
+        except Exception:
+            logging.exception("Memcache server connection fail %s", address)
+        finally:
+            self.connections -= 1
+            stream.close()
+
+    @gen.coroutine
+    def execute(self, stream, command, args):
+        """
+        Выполнить команду.
+
+        :param IOStream stream: соединение
+        :param str command: команда
+        :param list args: аргументы команды
+
+        :return: str ответ
+        """
+        if command in ("get", "gets"):
+            raise gen.Return(self.retrieve(args, command == "gets"))
+        if command in ("set", "add", "replace", "cas"):
+            args, noreply = _noreply(args)
+            if len(args) != (5 if command == "cas" else 4):
+                raise ClientError("bad command line format")
+            try:
+                flags, ttl, length = [int(i) for i in args[1:4]]
+                cas = int(args[4]) if command == "cas" else None
+            except ValueError:
+                raise ClientError("bad command line format")
+            data = yield stream.read_bytes(length + 2)
+            if data[-2:] != "\r\n":
+                raise ClientError("bad data chunk")
+            _check_key(args[0])
+            response = self.store(command, args[0], data[:-2], flags, ttl, cas)
+            raise gen.Return(None if noreply else response)
+        if command in ("incr", "decr"):
+            args, noreply = _noreply(args)
+            if len(args) != 2 or not args[1].isdigit():
+                raise ClientError("invalid numeric delta argument")
+            delta = int(args[1]) * (1 if command == "incr" else -1)
+            try:
+                value = self.storage.incr(args[0], delta)
+            except ValueError:
+                raise ClientError(
+                    "cannot increment or decrement non-numeric value"
+                )
+            response = "NOT_FOUND\r\n" if value is None else "%d\r\n" % value
+            raise gen.Return(None if noreply else response)
+        if command == "delete":
+            args, noreply = _noreply(args)
+            if not args:
+                raise ClientError("bad command line format")
+            deleted = self.storage.delete(args[0])
+            response = "DELETED\r\n" if deleted else "NOT_FOUND\r\n"
+            raise gen.Return(None if noreply else response)
+        if command == "flush_all":
+            args, noreply = _noreply(args)
+            self.storage.flush()
+            raise gen.Return(None if noreply else "OK\r\n")
+        if command == "version":
+            raise gen.Return("VERSION %s\r\n" % VERSION)
+        if command == "stats":
+            raise gen.Return("".join(
+                "STAT %s %s\r\n" % item for item in sorted(self.stats().items())
+            ) + "END\r\n")
+        raise gen.Return("ERROR\r\n")
+
+    def retrieve(self, keys, with_cas):
+        chunks = []
+        for key in keys:
+            item = self.storage.get(key)
+            if item is None:
+                continue
+            if with_cas:
+                chunks.append("VALUE %s %d %d %d\r\n%s\r\n" % (
+                    key, item[1], len(item[0]), item[3], item[0]
+                ))
+            else:
+                chunks.append("VALUE %s %d %d\r\n%s\r\n" % (
+                    key, item[1], len(item[0]), item[0]
+                ))
+        chunks.append("END\r\n")
+        return "".join(chunks)
+
+    def store(self, command, key, value, flags, ttl, cas=None):
+        if command == "cas":
+            return "%s\r\n" % self.storage.cas(key, value, flags, ttl, cas)
+        stored = getattr(self.storage, command)(key, value, flags, ttl)
+        return "STORED\r\n" if stored else "NOT_STORED\r\n"
+
+    def stats(self):
+        """
+        Статистика сервера.
+
+        :return: dict
+        """
+        return {
+            "uptime": int(time.time() - self.started),
+            "version": VERSION,
+            "curr_connections": self.connections,
+            "curr_items": len(self.storage),
+            "bytes": self.storage.size,
+            "limit_maxbytes": self.storage.max_bytes,
+            "get_hits": self.storage.hits,
+            "get_misses": self.storage.misses,
+            "evictions": self.storage.evictions,
+            "cmd_get": self.commands.get("get", 0) + self.commands.get("gets", 0),
+            "cmd_set": sum(
+                self.commands.get(c, 0) for c in ("set", "add", "replace", "cas")
+            )
+        }
+
+
+def _noreply(args):
+    if args and args[-1] == "noreply":
+        return args[:-1], True
+    return args, False
+
+
+def _check_key(key):
+    if len(key) > MAX_KEY_LENGTH:
+        raise ClientError("key too long")
+
+
+class LocalServer(object):
+    """
+    Сервер в фоновом потоке со своим IOLoop на свободном локальном порту.
+    """
+
+    def __init__(self, max_bytes=64 << 20, host="127.0.0.1", port=0):
+        """
+        Конструктор
+
+        :param int max_bytes: максимальный объем данных в байтах
+        :param str host: адрес
+        :param int port: порт, по умолчанию выбирается свободный
+        """
+        super(LocalServer, self).__init__()
+        self.max_bytes = max_bytes
+        self.host = host
+        self.port = port
+        self.server = None
+        self.__loop = None
+        self.__thread = None
+
+    @property
+    def address(self):
+        """
+        Адрес сервера в формате `host:port`.
+        """
+        return "%s:%d" % (self.host, self.port)
+
+    def start(self):
+        """
+        Запустить сервер.
+
+        :return: LocalServer
+        """
+        sockets = bind_sockets(self.port, self.host)
+        self.port = sockets[0].getsockname()[1]
+        started = threading.Event()
+
+        def run():
+            self.__loop = IOLoop()
+            self.__loop.make_current()
+            self.server = MemcacheServer(self.max_bytes)
+            self.server.add_sockets(sockets)
+            self.__loop.add_callback(started.set)
+            self.__loop.start()
+            self.server.stop()
+            self.__loop.close(all_fds=True)
+
+        self.__thread = threading.Thread(target=run, name="memcache-server")
+        self.__thread.daemon = True
+        self.__thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        """
+        Остановить сервер.
+        """
+        if self.__thread is not None:
+            self.__loop.add_callback(self.__loop.stop)
+            self.__thread.join()
+            self.__thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memcached protocol server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11211)
+    parser.add_argument("--max-bytes", type=int, default=64 << 20)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = MemcacheServer(args.max_bytes)
+    server.listen(args.port, args.host)
+    logging.info("Memcache server listen %s:%s", args.host, args.port)
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Разделяемый кеш экземпляров пула
+--------------------------------
+
+Экземпляры `services.Pool` на одном сервере запрашивают у memcached одни
+и те же данные. Разделяемый кеш хранит сериализованные значения в
+анонимной области памяти (mmap), которую пул создает до запуска
+экземпляров, поэтому после fork она общая для всех процессов пула.
+Уровень расположен между локальным кешем процесса (L1, см.
+`gentoolkit.cache.local`) и сервером memcached.
+
+Область разбита на слоты фиксированного размера `slot_size`, слоты
+сгруппированы в корзины по `ways` штук. Ключ отображается в корзину по
+crc32, внутри корзины вытесняется пустая, устаревшая или раньше всех
+устаревающая запись. Значения, не помещающиеся в слот, не сохраняются.
+
+Каждый слот защищен счетчиком версий (seqlock): запись увеличивает
+счетчик до и после изменения слота, чтение повторяется, если счетчик
+нечетный или изменился за время чтения. Чтение не выполняет системных
+вызовов и не берет блокировок. Записи в одну корзину упорядочиваются
+блокировками, распределенными по корзинам: между процессами - блокировкой
+участка файла (`fcntl.lockf`), которую ядро освобождает при завершении
+процесса, между потоками процесса - `threading.Lock`. Слот, запись в
+который прервана завершением процесса, не читается до следующей записи.
+
+Настройки пула::
+
+    {
+        "pool": {
+            "handler_name": {
+                "shared_cache": {
+                    // размер области в байтах
+                    "size": 67108864,
+                    // размер слота в байтах
+                    "slot_size": 1024,
+                    // количество слотов в корзине
+                    "ways": 4,
+                    // максимальное время жизни записи в секундах
+                    "ttl": 60
+                }
+            }
+        }
+    }
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                // использовать разделяемый кеш пула
+                "shared": {"ttl": 60}
+            }
+        }
+    }
+"""
+import errno
+import fcntl
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+
+__all__ = ['SharedCache', 'TieredCache', 'create', 'segment']
+
+
+#: количество попыток чтения слота, изменяемого другим процессом
+READ_RETRIES = 8
+
+# версия, crc32 ключа, время устаревания, длина ключа, длина значения
+_header = struct.Struct("<IIdHI")
+_seq = struct.Struct("<I")
+
+#: разделяемый кеш пула
+_segment = None
+
+
+class SharedCache(object):
+    """
+    Хеш-таблица с фиксированными слотами в разделяемой памяти.
+    """
+
+    def __init__(self, size=1 << 26, slot_size=1024, ways=4, ttl=60, locks=64):
+        """
+        Конструктор. Вызывается до fork экземпляров.
+
+        :param int size: размер области в байтах
+        :param int slot_size: размер слота в байтах
+        :param int ways: количество слотов в корзине
+        :param int ttl: максимальное время жизни записи
+        :param int locks: количество блокировок записи
+        """
+        super(SharedCache, self).__init__()
+        if slot_size <= _header.size:
+            raise ValueError("slot_size must exceed %d" % _header.size)
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = size // (slot_size * ways)
+        if not self.buckets:
+            raise ValueError("size is too small for slot_size and ways")
+        self.size = self.buckets * ways * slot_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.__buf = mmap.mmap(-1, self.size)
+        # файл блокировок наследуется экземплярами пула после fork
+        self.__lockfile = tempfile.TemporaryFile()
+        self.__locks = [threading.Lock() for _ in xrange(locks)]
+
+    def get(self, key):
+        """
+        Получить значение.
+
+        :param str key: ключ
+
+        :return: str|None
+        """
+        key = _encode(key)
+        buf = self.__buf
+        hsh = zlib.crc32(key) & 0xffffffff
+        offset = (hsh % self.buckets) * self.ways * self.slot_size
+        for way in xrange(self.ways):
+            for _ in xrange(READ_RETRIES):
+                seq, slot_hash, expires, klen, vlen = _header.unpack_from(
+                    buf, offset
+                )
+                if seq & 1:
+                    self.retries += 1
+                    continue
+                if slot_hash != hsh or klen != len(key):
+                    break
+                start = offset + _header.size
+                data = buf[start:start + klen + vlen]
+                if _seq.unpack_from(buf, offset)[0] != seq:
+                    self.retries += 1
+                    continue
+                if data[:klen] != key:
+                    break
+                if expires <= time.time():
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                return data[klen:]
+            offset += self.slot_size
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохранить значение. Время жизни записи не превышает `ttl` кеша.
+
+        :param str key: ключ
+        :param str value: сериализованное значение
+        :param int ttl: время жизни записи
+
+        :return: Bool
+        """
+        key = _encode(key)
+        if _header.size + len(key) + len(value) > self.slot_size:
+            self.rejected += 1
+            self.delete(key)
+            return False
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+        hsh = zlib.crc32(key) & 0xffffffff
+        bucket = hsh % self.buckets
+        with self.__locked(bucket):
+            now = time.time()
+            offset = self.__victim(bucket, hsh, key, now)
+            self.__write(
+                offset, hsh, now + ttl, key + value, len(key), len(value)
+            )
+        return True
+
+    def delete(self, key):
+        """
+        Удалить значение.
+
+        :param str key: ключ
+        """
+        key = _encode(key)
+        hsh = zlib.crc32(key) & 0xffffffff
+        bucket = hsh % self.buckets
+        with self.__locked(bucket):
+            offset = self.__find(bucket, hsh, key)
+            if offset is not None:
+                self.__write(offset, 0, 0, "", 0, 0)
+
+    def clear(self):
+        """
+        Очистить кеш.
+        """
+        for bucket in xrange(self.buckets):
+            with self.__locked(bucket):
+                offset = bucket * self.ways * self.slot_size
+                for _ in xrange(self.ways):
+                    if _header.unpack_from(self.__buf, offset)[3]:
+                        self.__write(offset, 0, 0, "", 0, 0)
+                    offset += self.slot_size
+
+    def stats(self):
+        """
+        Статистика использования кеша. Счетчики операций ведутся
+        отдельно в каждом процессе.
+
+        :return: dict
+        """
+        entries = 0
+        used = 0
+        now = time.time()
+        for offset in xrange(0, self.size, self.slot_size):
+            _, _, expires, klen, vlen = _header.unpack_from(self.__buf, offset)
+            if klen and expires > now:
+                entries += 1
+                used += klen + vlen
+        return {
+            'slots': self.size // self.slot_size,
+            'entries': entries,
+            'bytes': used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'evictions': self.evictions
+        }
+
+    @contextmanager
+    def __locked(self, bucket):
+        stripe = bucket % len(self.__locks)
+        with self.__locks[stripe]:
+            _lockf(self.__lockfile, fcntl.LOCK_EX, stripe)
+            try:
+                yield
+            finally:
+                _lockf(self.__lockfile, fcntl.LOCK_UN, stripe)
+
+    def __find(self, bucket, hsh, key):
+        offset = bucket * self.ways * self.slot_size
+        for _ in xrange(self.ways):
+            _, slot_hash, _, klen, _ = _header.unpack_from(self.__buf, offset)
+            if slot_hash == hsh and klen == len(key):
+                start = offset + _header.size
+                if self.__buf[start:start + klen] == key:
+                    return offset
+            offset += self.slot_size
+        return None
+
+    def __victim(self, bucket, hsh, key, now):
+        offset = self.__find(bucket, hsh, key)
+        if offset is not None:
+            return offset
+        victim, oldest = None, None
+        offset = bucket * self.ways * self.slot_size
+        for _ in xrange(self.ways):
+            _, _, expires, klen, _ = _header.unpack_from(self.__buf, offset)
+            if not klen or expires <= now:
+                return offset
+            if oldest is None or expires < oldest:
+                victim, oldest = offset, expires
+            offset += self.slot_size
+        self.evictions += 1
+        return victim
+
+    def __write(self, offset, hsh, expires, data, klen, vlen):
+        seq = _seq.unpack_from(self.__buf, offset)[0]
+        # нечетная версия остается после процесса, завершившегося во
+        # время записи
+        seq = (seq | 1) & 0xffffffff
+        _seq.pack_into(self.__buf, offset, seq)
+        start = offset + _header.size
+        self.__buf[start:start + len(data)] = data
+        _header.pack_into(self.__buf, offset, seq, hsh, expires, klen, vlen)
+        _seq.pack_into(self.__buf, offset, (seq + 1) & 0xffffffff)
+
+
+class TieredCache(object):
+    """
+    Локальный кеш процесса перед разделяемым кешем. Значения, найденные в
+    разделяемом кеше, копируются в локальный.
+    """
+
+    def __init__(self, local, shared, prefix="", ttl=None):
+        """
+        Конструктор
+
+        :param LocalCache local: локальный кеш процесса или None
+        :param SharedCache shared: разделяемый кеш
+        :param str prefix: префикс ключей подключения в разделяемом кеше
+        :param int ttl: максимальное время жизни записи в разделяемом кеше
+        """
+        super(TieredCache, self).__init__()
+        self.local = local
+        self.shared = shared
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.local.get(key) if self.local is not None else None
+        if value is None:
+            value = self.shared.get(self.prefix + key)
+            if value is not None and self.local is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.local is not None:
+            self.local.set(key, value, ttl)
+        if self.ttl:
+            ttl = min(ttl, self.ttl) if ttl else self.ttl
+        return self.shared.set(self.prefix + key, value, ttl)
+
+    def delete(self, key):
+        if self.local is not None:
+            self.local.delete(key)
+        self.shared.delete(self.prefix + key)
+
+    def clear(self):
+        """
+        Очистить локальный кеш. Разделяемый кеш очищается явно через
+        `shared.clear`, так как он общий для всех процессов.
+        """
+        if self.local is not None:
+            self.local.clear()
+
+    def stats(self):
+        return {
+            'local': self.local.stats() if self.local is not None else None,
+            'shared': self.shared.stats()
+        }
+
+
+def create(**config):
+    """
+    Создать разделяемый кеш пула. Вызывается `services.Pool` до запуска
+    экземпляров; повторный вызов возвращает созданный кеш.
+
+    :param dict config: параметры `SharedCache`
+
+    :return: SharedCache
+    """
+    global _segment
+    if _segment is None:
+        _segment = SharedCache(**config)
+    return _segment
+
+
+def segment():
+    """
+    Разделяемый кеш пула.
+
+    :return: SharedCache|None
+    """
+    return _segment
+
+
+def _lockf(fp, operation, stripe):
+    while True:
+        try:
+            return fcntl.lockf(fp, operation, 1, stripe)
+        except IOError as exc:
+            if exc.errno != errno.EINTR:
+                raise
+
+
+def _encode(key):
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    return key
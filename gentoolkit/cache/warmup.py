@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Прогрев кеша
+------------
+
+После выкладки или перезапуска memcached кеш пуст, и вся нагрузка
+приходится на источники данных. Модуль сохраняет снимок горячих данных
+подключения в локальный файл и восстанавливает кеш по нему при старте.
+
+Снимок содержит:
+
+* вызовы функций, декорированных `cached`, с аргументами - выборка из
+  потока вызовов (доля `rate`, не более `capacity` наиболее частых);
+  аргументы должны сериализоваться в JSON, остальные вызовы пропускаются
+* горячие ключи по namespace из выборки `KeySampler`
+  (см. `gentoolkit.cache.sampler`), если она включена
+
+Прогрев `warm` повторяет сохраненные вызовы (значения вычисляются и
+записываются в кеш самими функциями) и/или копирует горячие ключи с
+другого подключения (кластера). Копируются сериализованные значения без
+изменений вместе с отсутствующими на подключении версиями их тегов,
+поэтому копии сбрасываются `invalidate_tags`; время жизни копий не
+превышает `ttl` (по умолчанию `COPY_TTL`) и времени жизни подключения.
+Значения, сохраненные частями, не копируются. Задачи выполняются в `parallelism`
+потоках, для параллельного прогрева подключению нужен пул клиентов
+`thread_mapped` или `checkout`.
+
+Использование::
+
+    class Handler(services.Handler):
+        def start(self):
+            warmup.warm("default", parallelism=8)
+            warmup.attach(self, "default")
+            ....
+
+    # копирование горячих ключей из соседнего кластера
+    warmup.warm("default", source="default_backup")
+
+Настройки подключения::
+
+    {
+        "cache": {
+            "conn_name": {
+                "warmup": {
+                    // доля учитываемых вызовов
+                    "rate": 0.01,
+                    // максимальное количество вызовов в снимке
+                    "capacity": 1000,
+                    // файл снимка
+                    "path": "/var/tmp/cache-conn_name.snapshot",
+                    // интервал сохранения снимка в секундах
+                    "interval": 300
+                }
+            }
+        }
+    }
+"""
+import json
+import logging
+import os
+import random
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from tornado.ioloop import PeriodicCallback
+
+from . import chunks
+from .sampler import SpaceSaving
+
+
+__all__ = ['Recorder', 'register', 'snapshot', 'save', 'load', 'warm', 'attach']
+
+
+#: версия формата снимка
+VERSION = 1
+
+#: количество ключей в одном запросе копирования
+COPY_BATCH = 100
+
+#: максимальное время жизни скопированных значений в секундах
+COPY_TTL = 300
+
+#: функции, декорированные `cached`: идентификатор -> функция
+_registry = {}
+
+
+def register(func_id, func):
+    """
+    Зарегистрировать функцию для повтора вызовов при прогреве. Вызывается
+    декоратором `cached`.
+
+    :param str func_id: идентификатор функции
+    :param callable func: декорированная функция
+    """
+    _registry[func_id] = func
+
+
+def function_id(func):
+    """
+    Идентификатор функции в снимке.
+
+    :param callable func: функция
+
+    :return: str
+    """
+    return "%s.%s" % (func.__module__, func.__name__)
+
+
+class Recorder(object):
+    """
+    Выборка вызовов кешируемых функций подключения.
+    """
+
+    def __init__(self, rate=0.01, capacity=1000, path=None, interval=300):
+        """
+        Конструктор
+
+        :param float rate: доля учитываемых вызовов
+        :param int capacity: максимальное количество вызовов в снимке
+        :param str path: файл снимка
+        :param float interval: интервал сохранения снимка в секундах
+        """
+        super(Recorder, self).__init__()
+        self.rate = rate
+        self.path = path
+        self.interval = interval
+        self.__calls = SpaceSaving(capacity)
+        self.__lock = threading.Lock()
+
+    def record(self, func_id, args, kwargs):
+        """
+        Учесть вызов функции с вероятностью `rate`.
+
+        :param str func_id: идентификатор функции
+        :param tuple args: позиционные аргументы
+        :param dict kwargs: именованные аргументы
+        """
+        if random.random() >= self.rate:
+            return
+        try:
+            call = json.dumps([func_id, args, kwargs], sort_keys=True)
+        except (TypeError, ValueError):
+            return
+        with self.__lock:
+            self.__calls.offer(call)
+
+    def calls(self):
+        """
+        Учтенные вызовы в порядке убывания частоты.
+
+        :return: list [[идентификатор функции, args, kwargs]]
+        """
+        with self.__lock:
+            items = self.__calls.top(self.__calls.capacity)
+        return [json.loads(call) for call, _, _ in items]
+
+
+def snapshot(conn):
+    """
+    Снимок горячих данных подключения.
+
+    :param Connection conn: подключение
+
+    :return: dict
+    """
+    keys = {}
+    if conn.sampler is not None:
+        for namespace, kinds in conn.sampler.report(
+                conn.sampler.capacity).items():
+            keys[namespace] = [key for key, _ in kinds['reads']]
+    recorder = getattr(conn, 'recorder', None)
+    return {
+        'version': VERSION,
+        'calls': recorder.calls() if recorder is not None else [],
+        'keys': keys
+    }
+
+
+def save(conn_name, path=None):
+    """
+    Сохранить снимок подключения в файл. Файл заменяется атомарно.
+
+    :param str conn_name: название подключения
+    :param str path: файл снимка, по умолчанию из настроек
+
+    :return: str путь к файлу
+    """
+    from . import instance
+    conn = instance[conn_name]
+    path = path or _default_path(conn, conn_name)
+    data = zlib.compress(json.dumps(snapshot(conn)))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as fp:
+        fp.write(data)
+    os.rename(tmp, path)
+    return path
+
+
+def load(path):
+    """
+    Прочитать снимок из файла.
+
+    :param str path: файл снимка
+
+    :return: dict|None
+    """
+    try:
+        with open(path, "rb") as fp:
+            data = json.loads(zlib.decompress(fp.read()))
+    except (IOError, OSError):
+        logging.warning("Cache snapshot %s not found", path)
+        return None
+    except (zlib.error, ValueError):
+        logging.warning("Cache snapshot %s is corrupted", path)
+        return None
+    if not isinstance(data, dict) or data.get('version') != VERSION:
+        logging.warning("Cache snapshot %s has unknown version", path)
+        return None
+    return data
+
+
+def warm(conn_name, path=None, source=None, parallelism=4, calls=True,
+         ttl=None):
+    """
+    Прогреть кеш подключения по снимку.
+
+    :param str conn_name: название подключения
+    :param str path: файл снимка, по умолчанию из настроек
+    :param str source: подключение, из которого копируются горячие ключи
+    :param int parallelism: количество потоков
+    :param bool calls: повторить вызовы кешируемых функций
+    :param int ttl: время жизни скопированных значений, по умолчанию `COPY_TTL`
+
+    :return: dict статистика прогрева
+    """
+    from . import instance
+    conn = instance[conn_name]
+    data = load(path or _default_path(conn, conn_name))
+    stats = {'calls': 0, 'skipped': 0, 'copied': 0, 'errors': 0}
+    if data is None:
+        return stats
+    tasks = []
+    if calls:
+        for func_id, args, kwargs in data['calls']:
+            func = _registry.get(func_id)
+            if func is None:
+                stats['skipped'] += 1
+                continue
+            tasks.append(('calls', _call(func, args, kwargs)))
+    if source:
+        origin = instance[source]
+        ttl = min(ttl or COPY_TTL, conn.config.ttl)
+        for namespace, keys in data['keys'].items():
+            if not conn.enabled(namespace):
+                continue
+            for idx in xrange(0, len(keys), COPY_BATCH):
+                tasks.append(('copied', _copy(
+                    origin, conn, namespace, keys[idx:idx + COPY_BATCH], ttl
+                )))
+    if parallelism > 1 and conn.pool.stats().get('type') == 'single':
+        logging.warning(
+            "Cache %s uses single client pool, warm up is sequential",
+            conn_name
+        )
+        parallelism = 1
+
+    def run(task):
+        kind, job = task
+        try:
+            return kind, job()
+        except Exception:
+            logging.exception("Cache warm up task fail")
+            return 'errors', 1
+
+    if parallelism > 1:
+        pool = ThreadPool(parallelism)
+        try:
+            results = pool.map(run, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run(task) for task in tasks]
+    for kind, count in results:
+        stats[kind] += count
+    logging.info("Cache %s warmed up: %s", conn_name, stats)
+    return stats
+
+
+def attach(handler, conn_name, path=None):
+    """
+    Периодически сохранять снимок подключения и сохранить его при
+    завершении сервиса.
+
+    :param services.Handler handler: обработчик сервиса
+    :param str conn_name: название подключения
+    :param str path: файл снимка, по умолчанию из настроек
+
+    :return: PeriodicCallback
+    """
+    from . import instance
+    conn = instance[conn_name]
+    recorder = getattr(conn, 'recorder', None)
+    interval = recorder.interval if recorder is not None else 300
+
+    def store():
+        try:
+            save(conn_name, path)
+        except Exception:
+            logging.exception("Cache snapshot %s save fail", conn_name)
+
+    periodic = PeriodicCallback(store, interval * 1000)
+    periodic.start()
+    handler.add_stop_callback(periodic.stop)
+    handler.add_stop_callback(store)
+    return periodic
+
+
+def _call(func, args, kwargs):
+    def job():
+        func(*args, **dict((str(k), v) for k, v in kwargs.items()))
+        return 1
+    return job
+
+
+def _copy(origin, conn, namespace, keys, ttl):
+    def job():
+        normalized = dict(
+            (origin.normalise_key(namespace, k), conn.normalise_key(namespace, k))
+            for k in keys
+        )
+        with origin.pool.reserve() as mc:
+            found = mc.get_multi(normalized.keys()) or {}
+        values = dict(
+            (normalized[k], v) for k, v in found.items()
+            if v and not chunks.is_manifest(v)
+        )
+        if values:
+            versions = _tag_versions(origin, conn, values.values())
+            with conn.pool.reserve() as mc:
+                # версии тегов, уже измененные на подключении, не заменяются
+                for k, v in versions.items():
+                    mc.add(k, v, time=0)
+                mc.set_multi(values, time=ttl)
+        return len(values)
+    return job
+
+
+def _tag_versions(origin, conn, values):
+    from . import TAG_NAMESPACE, TAGS_KEY, _is_tagged, _normalise
+    tags = set()
+    for data in values:
+        value = conn.loads(data)
+        if _is_tagged(value):
+            tags.update(value[TAGS_KEY])
+    if not tags:
+        return {}
+    keys = dict(
+        (_normalise(origin.key_settings, TAG_NAMESPACE, t),
+         _normalise(conn.key_settings, TAG_NAMESPACE, t))
+        for t in tags
+    )
+    with origin.pool.reserve() as mc:
+        found = mc.get_multi(keys.keys()) or {}
+    return dict((keys[k], v) for k, v in found.items())
+
+
+def _default_path(conn, conn_name):
+    recorder = getattr(conn, 'recorder', None)
+    if recorder is not None and recorder.path:
+        return recorder.path
+    return "/var/tmp/cache-%s.snapshot" % conn_name
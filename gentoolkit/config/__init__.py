@@ -92,6 +92,15 @@ class Proxy(object):
         except AttributeError:
             return get_path(self._defaults, name, default=default)
 
+    def get_revision(self):
+        """
+        Номер ревизии глобальных настроек. Позволяет кешировать значения,
+        вычисленные на основе настроек, до их смены.
+
+        :return: int
+        """
+        return getattr(self._config, "revision", 0)
+
     def __getitem__(self, name):
         """
         Перегрузка доступа по индексу. Сначало преверяется глобальные настройки, потом значения по умолчанию.
@@ -135,10 +144,13 @@ class Config(object):
         super(Config, self).__init__()
         self._data = {}
         self._source = None
+        #: номер ревизии, увеличивается при каждой смене настроек
+        self.revision = 0
 
     def reset(self):
         self._data = {}
         self._source = None
+        self.revision += 1
 
     def init(self, cfg):
         """
@@ -150,6 +162,7 @@ class Config(object):
         """
         self._data = {}
         self._source = None
+        self.revision += 1
 
         if isinstance(cfg, dict):
             self._data = cfg
@@ -74,6 +74,11 @@
                     "incoming": ["127.0.0.1", 8881],
                     // внешний адрес доступа к отчетам
                     "outgoing": ["127.0.0.1", 8880]
+                },
+                // разделяемый кеш экземпляров (см. `gentoolkit.cache.shared`)
+                "shared_cache": {
+                    "size": 67108864,
+                    "slot_size": 1024
                 }
             }
         }
@@ -141,6 +146,8 @@ class Pool(object):
         signal.signal(signal.SIGCHLD, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         try:
+            if "shared_cache" in self.config:
+                self.create_shared_cache()
             for service in self.__services:
                 if service['multiply']:
                     for i in range(service['multiply']):
@@ -155,6 +162,22 @@ class Pool(object):
             self.stop()
             return False
 
+    def create_shared_cache(self):
+        """
+        Создать разделяемый кеш до запуска экземпляров, после fork область
+        памяти общая для всех экземпляров пула.
+
+        :return: SharedCache
+        """
+        from ..cache import shared
+        config = dict(self.config['shared_cache'])
+        segment = shared.create(**config)
+        logging.info(
+            "Shared cache created: %d bytes, %d bytes per slot",
+            segment.size, segment.slot_size
+        )
+        return segment
+
     def stop(self):
         """
         Остановка экземпляров
@@ -97,6 +97,52 @@ class Handler(object):
         """
         raise NotImplementedError()
 
+    def add_stop_callback(self, callback):
+        """
+        Зарегистрировать функцию, которая вызывается при завершении процесса после выхода из `start` (в том числе после остановки через `stop`). Используется для сброса буферов и освобождения ресурсов.
+
+        :param callable callback: функция без аргументов
+        """
+        self.__dict__.setdefault('_stop_callbacks', []).append(callback)
+
+    def run_stop_callbacks(self):
+        """
+        Вызвать зарегистрированные функции завершения. Каждая функция вызывается один раз.
+        """
+        for callback in self.__dict__.pop('_stop_callbacks', []):
+            try:
+                callback()
+            except:
+                logging.exception("Stop callback %s fail", callback)
+
+    def add_report_callback(self, name, callback):
+        """
+        Зарегистрировать функцию, результат которой добавляется в отчет обработчика под ключом `name` (см. `collect_report`).
+
+        :param str name: ключ отчета
+        :param callable callback: функция без аргументов, возвращает данные, сериализуемые в json
+        """
+        self.__dict__.setdefault('_report_callbacks', {})[name] = callback
+
+    def collect_report(self):
+        """
+        Отчет обработчика `report`, дополненный результатами зарегистрированных функций.
+
+        :return: dict
+        """
+        report = self.report()
+        callbacks = self.__dict__.get('_report_callbacks')
+        if not callbacks:
+            return report
+        if not isinstance(report, dict):
+            report = {'report': report} if report is not None else {}
+        for name, callback in callbacks.items():
+            try:
+                report[name] = callback()
+            except:
+                logging.exception("Report callback %s fail", callback)
+        return report
+
     def start_manhole(self, addr, context={}):
         """
         Запустить Manhole на указанном адресе.
@@ -173,6 +219,7 @@ class Context(object):
             self.__handler.stop()
             logging.exception("Handling fail [%s]", self.pid)
             exit_code = 1
+        self.__handler.run_stop_callbacks()
         self.__handler.context = None
         os._exit(exit_code)
 
@@ -184,7 +231,7 @@ class Context(object):
             self.__handler.stop()
             self.__stopped = True
         if sig == signal.SIGUSR1:
-            self.__send_report(self.__handler.report())
+            self.__send_report(self.__handler.collect_report())
 
     def __send_report(self, report):
         """
@@ -28,7 +28,7 @@ setup(
         'arrow>=0.4.4',
         'Babel>=1.3',
         'pytz',
-        'tornado>=4.0.2',
+        'tornado>=4.5',
         'pylibmc>=1.3.0',
         'setproctitle>=1.1.8',
         'simplejson>=3.6.5'
@@ -0,0 +1,1321 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import tempfile
+import threading
+import time
+from hashlib import md5
+
+import nose.tools
+import pylibmc
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from gentoolkit import cache
+from gentoolkit import config
+from gentoolkit import services
+from gentoolkit.cache import codecs
+from gentoolkit.cache.buffer import WriteBuffer
+from gentoolkit.cache.loader import Loader
+from gentoolkit.cache.local import LocalCache
+from gentoolkit.cache.shared import SharedCache
+from gentoolkit.cache import pool
+from gentoolkit.cache import breaker
+from gentoolkit.cache import ring
+from gentoolkit.cache import sampler
+from gentoolkit.cache import shared
+from gentoolkit.cache import warmup
+
+
+class FakeClient(object):
+
+    """
+    In-memory pylibmc.Client mock. Every call is counted in `FakeClient.calls`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.data = {}
+        self.calls = []
+        self.versions = {}
+
+    def clone(self):
+        client = FakeClient()
+        client.data = self.data
+        client.calls = self.calls
+        client.versions = self.versions
+        return client
+
+    def _store(self, key, value, time):
+        self.data[key] = (value, _expires(time))
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] and item[1] <= time.time():
+            del self.data[key]
+            return None
+        return item[0]
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self._alive(key)
+
+    def get_multi(self, keys):
+        self.calls.append(('get_multi', list(keys)))
+        ret = {}
+        for k in keys:
+            value = self._alive(k)
+            if value is not None:
+                ret[k] = value
+        return ret
+
+    def set(self, key, value, time=0):
+        self.calls.append(('set', key))
+        self._store(key, value, time)
+        return True
+
+    def set_multi(self, values, time=0):
+        self.calls.append(('set_multi', sorted(values)))
+        for k, v in values.items():
+            self._store(k, v, time)
+        return []
+
+    def add(self, key, value, time=0):
+        self.calls.append(('add', key))
+        if self._alive(key) is not None:
+            return False
+        self._store(key, value, time)
+        return True
+
+    def gets(self, key):
+        self.calls.append(('gets', key))
+        value = self._alive(key)
+        if value is None:
+            return None, None
+        return value, self.versions.get(key, 0)
+
+    def cas(self, key, value, cas, time=0):
+        self.calls.append(('cas', key))
+        if self._alive(key) is None or self.versions.get(key, 0) != cas:
+            return False
+        self._store(key, value, time)
+        return True
+
+    def delete(self, key):
+        self.calls.append(('delete', key))
+        return self.data.pop(key, None) is not None
+
+    def delete_multi(self, keys):
+        self.calls.append(('delete_multi', list(keys)))
+        return all([self.data.pop(k, None) is not None for k in keys])
+
+    def incr(self, key, delta=1):
+        self.calls.append(('incr', key))
+        value = self._alive(key)
+        if value is None:
+            raise pylibmc.NotFound(key)
+        value = str(int(value) + delta)
+        self.data[key] = (value, self.data[key][1])
+        return int(value)
+
+    def decr(self, key, delta=1):
+        self.calls.append(('decr', key))
+        value = self._alive(key)
+        if value is None:
+            raise pylibmc.NotFound(key)
+        value = str(max(int(value) - delta, 0))
+        self.data[key] = (value, self.data[key][1])
+        return int(value)
+
+
+def _expires(ttl):
+    return time.time() + ttl if ttl else 0
+
+
+origin_client = pylibmc.Client
+
+
+def setup():
+    pylibmc.Client = FakeClient
+    config.init({
+        "cache": {
+            "default": {
+                "host": ["127.0.0.1:11211"],
+                "ttl": 60
+            },
+            "locks": {
+                "host": ["127.0.0.1:11211"],
+                "params": {"behaviors": {"cas": True}},
+                "ttl": 60
+            },
+            "packed": {
+                "host": ["127.0.0.1:11211"],
+                "codec": "marshal",
+                "namespace_codecs": {
+                    "pickled": "pickle"
+                },
+                "compression": {
+                    "method": "zlib",
+                    "threshold": 64
+                }
+            },
+            "generations": {
+                "host": ["127.0.0.1:11211"],
+                "namespace_generations": True,
+                "generation_ttl": 60
+            },
+            "pooled": {
+                "host": ["127.0.0.1:11211"],
+                "pool": {
+                    "type": "checkout",
+                    "size": 2,
+                    "wait": 0.05
+                }
+            },
+            "chunked": {
+                "host": ["127.0.0.1:11211"],
+                "multi_chunk_size": 2
+            },
+            "ring": {
+                "host": ["10.0.0.1:11211", "10.0.0.2:11211", "10.0.0.3:11211"],
+                "ring": {
+                    "hot_threshold": 20,
+                    "hot_replicas": 2,
+                    "hot_ttl": 5
+                }
+            },
+            "sampled": {
+                "host": ["127.0.0.1:11211"],
+                "sampler": {
+                    "rate": 1,
+                    "capacity": 4,
+                    "top": 2
+                }
+            },
+            "breaker": {
+                "host": ["10.0.0.1:11211"],
+                "breaker": {
+                    "threshold": 2,
+                    "cooldown": 0.05,
+                    "secondary": ["10.0.1.1:11211"],
+                    "log_interval": 60
+                }
+            },
+            "large": {
+                "host": ["127.0.0.1:11211"],
+                "chunk_size": 16
+            },
+            "warm": {
+                "host": ["127.0.0.1:11211"],
+                "pool": {"type": "thread_mapped"},
+                "sampler": {"rate": 1, "capacity": 16},
+                "warmup": {"rate": 1, "capacity": 16}
+            },
+            "shared": {
+                "host": ["127.0.0.1:11211"],
+                "ttl": 60,
+                "local": {"max_entries": 8, "ttl": 5},
+                "shared": {"ttl": 30}
+            },
+            "local": {
+                "host": ["127.0.0.1:11211"],
+                "ttl": 60,
+                "local": {
+                    "max_entries": 3,
+                    "max_bytes": 1024,
+                    "ttl": 5
+                }
+            }
+        }
+    })
+
+
+def teardown():
+    pylibmc.Client = origin_client
+    cache.instance.__dict__.clear()
+    config.instance.reset()
+
+
+def connection(name):
+    return cache.Connection(
+        config.Proxy({"params": {}, "ttl": 5, "host": []}, "cache.%s" % name)
+    )
+
+
+def test_local_lru():
+    local = LocalCache(max_entries=2, max_bytes=1024, ttl=5)
+    local.set("a", "1")
+    local.set("b", "2")
+    nose.tools.eq_(local.get("a"), "1")
+    local.set("c", "3")
+    nose.tools.eq_(local.get("b"), None)
+    nose.tools.eq_(local.get("a"), "1")
+    nose.tools.eq_(local.get("c"), "3")
+    nose.tools.eq_(local.stats()['evictions'], 1)
+    nose.tools.eq_(local.stats()['hits'], 3)
+    nose.tools.eq_(local.stats()['misses'], 1)
+
+
+def test_local_bytes_and_ttl():
+    local = LocalCache(max_entries=10, max_bytes=10, ttl=5)
+    local.set("a", "12345")
+    local.set("b", "12345")
+    nose.tools.eq_(local.get("a"), None)
+    nose.tools.eq_(local.get("b"), "12345")
+    nose.tools.ok_(not local.set("c", "12345678901"))
+    local.set("d", "1", ttl=0.01)
+    time.sleep(0.02)
+    nose.tools.eq_(local.get("d"), None)
+    nose.tools.eq_(local.size, 6)
+
+
+def test_connection_local_tier():
+    conn = connection("local")
+    client = conn.pool.client
+    nose.tools.ok_(conn.set("key", {"a": 1}))
+    del client.calls[:]
+    nose.tools.eq_(conn.get("key"), {"a": 1})
+    nose.tools.eq_(conn.get("key"), {"a": 1})
+    nose.tools.eq_(client.calls, [])
+    nose.tools.eq_(conn.local.hits, 2)
+    conn.delete("key")
+    nose.tools.eq_(conn.get("key"), None)
+    nose.tools.eq_(client.calls, [('delete', 'key'), ('get', 'key')])
+
+
+def test_connection_without_local_tier():
+    conn = connection("default")
+    nose.tools.eq_(conn.local, None)
+    conn.set("key", 1)
+    nose.tools.eq_(conn.get("key"), 1)
+
+
+def test_shared_cache_between_processes():
+    segment = SharedCache(size=4096, slot_size=128, ways=2, ttl=60)
+    nose.tools.eq_(segment.stats()['slots'], 32)
+    nose.tools.ok_(not segment.set("big", "x" * 128))
+    segment.set("short", "1", ttl=0.01)
+    time.sleep(0.02)
+    nose.tools.eq_(segment.get("short"), None)
+    pid = os.fork()
+    if not pid:
+        try:
+            segment.set("key", "child")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    nose.tools.eq_(segment.get("key"), "child")
+    for idx in xrange(50):
+        segment.set("key%d" % idx, str(idx))
+    nose.tools.eq_(segment.get("key49"), "49")
+    nose.tools.ok_(segment.stats()['entries'] <= 32)
+    segment.delete("key")
+    nose.tools.eq_(segment.get("key"), None)
+    segment.clear()
+    nose.tools.eq_(segment.stats()['entries'], 0)
+
+
+def test_shared_cache_dead_writer():
+    segment = SharedCache(size=4096, slot_size=128, ways=2, locks=1)
+    pid = os.fork()
+    if not pid:
+        # процесс завершается во время записи, удерживая блокировку
+        try:
+            with segment._SharedCache__locked(0):
+                buf = segment._SharedCache__buf
+                for offset in xrange(0, segment.size, segment.slot_size):
+                    shared._seq.pack_into(buf, offset, 1)
+                os._exit(0)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    nose.tools.eq_(segment.get("key"), None)
+    started = time.time()
+    nose.tools.ok_(segment.set("key", "value"))
+    nose.tools.ok_(time.time() - started < 0.05)
+    nose.tools.eq_(segment.get("key"), "value")
+
+
+def test_connection_shared_tier():
+    shared.create(size=1 << 16, slot_size=256)
+    conn = connection("shared")
+    client = conn.pool.client
+    nose.tools.ok_(conn.set("key", {"a": 1}))
+    # другой экземпляр пула: локальный кеш пуст
+    conn.local.local.clear()
+    del client.calls[:]
+    nose.tools.eq_(conn.get("key"), {"a": 1})
+    nose.tools.eq_(conn.get("key"), {"a": 1})
+    nose.tools.eq_(client.calls, [])
+    stats = conn.local.stats()
+    nose.tools.eq_(stats['shared']['hits'], 1)
+    nose.tools.eq_(stats['local']['hits'], 1)
+    conn.delete("key")
+    conn.local.local.clear()
+    nose.tools.eq_(conn.get("key"), None)
+    nose.tools.eq_(client.calls, [('delete', 'key'), ('get', 'key')])
+
+
+def test_serializer_formats():
+    value = {"a": [1, 2, 3], "b": u"строка"}
+    plain = codecs.Serializer()
+    nose.tools.eq_(plain.dumps(value), '{"a": [1, 2, 3], "b": "\\u0441\\u0442\\u0440\\u043e\\u043a\\u0430"}')
+    for name in ("json", "marshal", "pickle"):
+        serializer = codecs.Serializer(name, compression="zlib", threshold=16)
+        data = serializer.dumps(value)
+        nose.tools.ok_(data.startswith(codecs.MAGIC))
+        nose.tools.eq_(serializer.loads(data), value)
+    nose.tools.eq_(plain.loads('[1, 2]'), [1, 2])
+    pickled = codecs.Serializer("pickle").dumps(value)
+    with nose.tools.assert_raises(codecs.UnknownCodec):
+        plain.loads(pickled)
+    nose.tools.eq_(codecs.Serializer(accept=["pickle"]).loads(pickled), value)
+
+
+def test_serializer_compression_threshold():
+    serializer = codecs.Serializer("json", compression="zlib", threshold=100)
+    nose.tools.eq_(serializer.dumps("short"), '"short"')
+    data = serializer.dumps("x" * 1000)
+    nose.tools.eq_(ord(data[2]), codecs.get_compressor("zlib").id)
+    nose.tools.ok_(len(data) < 100)
+    nose.tools.eq_(serializer.loads(data), "x" * 1000)
+
+
+@nose.tools.raises(codecs.UnknownCodec)
+def test_serializer_unknown_codec():
+    codecs.Serializer("unknown")
+
+
+def test_connection_codecs():
+    conn = connection("packed")
+    client = conn.pool.client
+    conn.set("key", [1] * 100)
+    conn.set("key", {1: 2}, namespace="pickled")
+    nose.tools.eq_(ord(client.data["key"][0][1]), codecs.get_codec("marshal").id)
+    nose.tools.eq_(ord(client.data["key"][0][2]), codecs.get_compressor("zlib").id)
+    nose.tools.eq_(ord(client.data["pickled:key"][0][1]), codecs.get_codec("pickle").id)
+    nose.tools.eq_(conn.get("key"), [1] * 100)
+    nose.tools.eq_(conn.get("key", namespace="pickled"), {1: 2})
+    client.data["legacy"] = ('{"a": 1}', 0)
+    nose.tools.eq_(conn.get("legacy"), {"a": 1})
+
+    # значение в кодеке, не указанном в настройках, не читается
+    plain = connection("default")
+    pickled = codecs.Serializer("pickle").dumps({"a": 1})
+    plain.pool.client.data["foreign"] = (pickled, 0)
+    nose.tools.eq_(plain.get("foreign"), None)
+    nose.tools.eq_(plain.get_many(["foreign"]), ({}, set(["foreign"])))
+
+    # ошибка сериализации не выходит за пределы подключения
+    nose.tools.ok_(not plain.add("unserializable", object()))
+    nose.tools.ok_(not plain.set("unserializable", object()))
+    nose.tools.ok_("unserializable" not in plain.pool.client.data)
+
+
+def test_cached_single_flight():
+    calls = []
+
+    @cache.cached(lambda x: "sf:%s" % x, conn_name="default", ttl=10, lock=True, lock_wait=0.1)
+    def compute(x):
+        calls.append(x)
+        return x * 2
+
+    conn = cache.instance["default"]
+    nose.tools.eq_(compute(1), 2)
+    nose.tools.eq_(compute(1), 2)
+    nose.tools.eq_(calls, [1])
+
+    # soft expired value, other process recomputes it
+    envelope = conn.get("sf:1")
+    envelope[cache.ENVELOPE_KEY] = time.time() - 1
+    envelope["value"] = 3
+    conn.set("sf:1", envelope)
+    conn.add("sf:1:lock", 1)
+    nose.tools.eq_(compute(1), 3)
+    nose.tools.eq_(calls, [1])
+
+    # lock is released, value is recomputed
+    conn.delete("sf:1:lock")
+    nose.tools.eq_(compute(1), 2)
+    nose.tools.eq_(calls, [1, 1])
+    nose.tools.ok_(conn.get("sf:1")[cache.ENVELOPE_KEY] > time.time())
+
+    # no value and lock is held, waiting for result
+    conn.add("sf:2:lock", 1)
+    started = time.time()
+    nose.tools.eq_(compute(2), 4)
+    nose.tools.ok_(time.time() - started >= 0.1)
+    nose.tools.eq_(calls, [1, 1, 2])
+
+
+def test_cached_early_recompute():
+    calls = []
+
+    @cache.cached("xfetch", conn_name="default", ttl=10, beta=1.0)
+    def compute():
+        calls.append(1)
+        time.sleep(0.01)
+        return len(calls)
+
+    conn = cache.instance["default"]
+    nose.tools.eq_(compute(), 1)
+    envelope = conn.get("xfetch")
+    nose.tools.ok_(envelope["delta"] >= 0.01)
+    nose.tools.ok_(envelope[cache.ENVELOPE_KEY] > time.time() + 9)
+    nose.tools.eq_(compute(), 1)
+
+    # expiry is far away compared to computation time
+    nose.tools.ok_(not cache._should_refresh(time.time() + 100, 0.01, 1.0))
+    # expiry is close compared to computation time
+    nose.tools.ok_(cache._should_refresh(time.time() + 0.001, 1000, 1.0))
+
+    envelope["delta"] = 1000
+    conn.set("xfetch", envelope)
+    nose.tools.eq_(compute(), 2)
+
+
+def test_cached_multi():
+    calls = []
+
+    @cache.cached_multi(lambda pk: "user:%s" % pk, conn_name="default")
+    def get_users(ids, suffix=""):
+        calls.append(list(ids))
+        return [{"id": pk, "name": "user%s%s" % (pk, suffix)} for pk in ids]
+
+    conn = cache.instance["default"]
+    client = conn.pool.client
+    nose.tools.eq_(
+        [u["id"] for u in get_users([3, 1])], [3, 1]
+    )
+    del client.calls[:]
+    result = get_users([1, 2, 3, 2])
+    nose.tools.eq_([u["id"] for u in result], [1, 2, 3, 2])
+    nose.tools.eq_(calls, [[3, 1], [2]])
+    nose.tools.eq_(client.calls[0][0], 'get_multi')
+    nose.tools.eq_(sorted(client.calls[0][1]), ['user:1', 'user:2', 'user:3'])
+    nose.tools.eq_(client.calls[1:], [('set_multi', ['user:2'])])
+    nose.tools.eq_(get_users([]), [])
+
+
+def test_get_many():
+    conn = connection("chunked")
+    client = conn.pool.client
+    conn.set_multi({"a": 1, "b": None, "c": [3]}, namespace="ns")
+    del client.calls[:]
+    found, missing = conn.get_many(["a", "b", "c", "d", "e"], namespace="ns")
+    nose.tools.eq_(found, {"a": 1, "b": None, "c": [3]})
+    nose.tools.eq_(missing, set(["d", "e"]))
+    nose.tools.eq_(len(client.calls), 3)
+    nose.tools.eq_(
+        sorted(sum([c[1] for c in client.calls], [])),
+        ["ns:a", "ns:b", "ns:c", "ns:d", "ns:e"]
+    )
+    nose.tools.eq_(conn.get(["c", "x", "a"], namespace="ns"), [[3], None, 1])
+    nose.tools.eq_(conn.get_many([]), ({}, set()))
+
+
+def test_normalise_key():
+    conn = connection("default")
+    nose.tools.eq_(conn.normalise_key("ns", u"ключ"), "ns:\xd0\xba\xd0\xbb\xd1\x8e\xd1\x87")
+    nose.tools.eq_(conn.normalise_key("ns", ["a", 1]), ["ns:a", "ns:1"])
+    nose.tools.ok_(cache.Connection.enabled("ns"))
+    settings = config.instance._data
+    try:
+        config.init({
+            "cache": {
+                "default": {
+                    "host": ["127.0.0.1:11211"],
+                    "cache_prefix": "pfx",
+                    "hash_keys": True
+                },
+                "disabled": ["ns"]
+            }
+        })
+        nose.tools.eq_(conn.normalise_key("", "a"), md5("pfx_a").hexdigest())
+        nose.tools.ok_(not cache.Connection.enabled("ns"))
+        nose.tools.ok_(not conn.set("a", 1, namespace="ns"))
+    finally:
+        config.init(settings)
+    nose.tools.eq_(conn.normalise_key("", "a"), "a")
+    nose.tools.ok_(cache.Connection.enabled("ns"))
+
+
+def test_invalidate_namespace():
+    conn = connection("generations")
+    client = conn.pool.client
+    conn.set("a", 1, namespace="ns")
+    conn.set("b", 2, namespace="other")
+    nose.tools.eq_(conn.get("a", namespace="ns"), 1)
+    generation = conn.generation("ns")
+    nose.tools.eq_(client.data["__generation__:ns"][0], str(generation))
+    nose.tools.ok_(("ns@%d:a" % generation) in client.data)
+
+    del client.calls[:]
+    nose.tools.eq_(conn.get("a", namespace="ns"), 1)
+    nose.tools.eq_(client.calls, [("get", "ns@%d:a" % generation)])
+
+    nose.tools.ok_(conn.invalidate_namespace("ns"))
+    nose.tools.eq_(conn.generation("ns"), generation + 1)
+    nose.tools.eq_(conn.get("a", namespace="ns"), None)
+    nose.tools.eq_(conn.get("b", namespace="other"), 2)
+
+    # other process sees new generation after generation_ttl
+    other = connection("generations")
+    other.pool.client = client
+    nose.tools.eq_(other.generation("ns"), generation + 1)
+    nose.tools.ok_(not connection("default").invalidate_namespace("ns"))
+
+
+def test_invalidate_tags():
+    conn = connection("default")
+    client = conn.pool.client
+    conn.set("a", 1, tags=["product:1"])
+    conn.set_multi({"b": 2, "c": 3}, tags=["product:1", "user:1"])
+    conn.set("d", 4, tags=["user:2"])
+    del client.calls[:]
+    nose.tools.eq_(conn.get("a", tags=["product:1"]), 1)
+    nose.tools.eq_(len(client.calls), 1)
+    nose.tools.eq_(
+        conn.get_many(["a", "b", "c", "d"], tags=["product:1", "user:1"]),
+        ({"a": 1, "b": 2, "c": 3, "d": 4}, set())
+    )
+    nose.tools.ok_(conn.invalidate_tags(["user:1"]))
+    nose.tools.eq_(conn.get("a"), 1)
+    nose.tools.eq_(conn.get("b"), None)
+    nose.tools.eq_(conn.get(["a", "c", "d"]), [1, None, 4])
+
+    # evicted tag version invalidates values
+    del client.data["__tag__:user:2"]
+    nose.tools.eq_(conn.get("d"), None)
+
+    # версия тега, созданная параллельной записью, не перезаписывается
+    fetch = client.get_multi
+
+    def racing_get_multi(keys):
+        found = fetch(keys)
+        client.add("__tag__:user:3", "competitor", time=0)
+        return found
+
+    client.get_multi = racing_get_multi
+    try:
+        versions = conn.tag_versions(["user:3"])
+    finally:
+        client.get_multi = fetch
+    nose.tools.eq_(versions, {"user:3": "competitor"})
+    nose.tools.eq_(client.data["__tag__:user:3"][0], "competitor")
+
+
+def test_cached_tags():
+    calls = []
+
+    @cache.cached(lambda pk: "product:%s" % pk, conn_name="default", tags=lambda pk: ["product:%s" % pk])
+    def get_product(pk):
+        calls.append(pk)
+        return {"id": pk}
+
+    conn = cache.instance["default"]
+    nose.tools.eq_(get_product(1), {"id": 1})
+    nose.tools.eq_(get_product(1), {"id": 1})
+    nose.tools.eq_(calls, [1])
+    conn.invalidate_tags(["product:1"])
+    nose.tools.eq_(get_product(1), {"id": 1})
+    nose.tools.eq_(calls, [1, 1])
+
+
+def test_checkout_pool():
+    clients = pool.CheckoutPool(FakeClient(), size=2, wait=0.05)
+    with clients.reserve() as first:
+        with clients.reserve() as second:
+            nose.tools.ok_(first is not second)
+            with nose.tools.assert_raises(pool.PoolTimeout):
+                with clients.reserve():
+                    pass
+            nose.tools.eq_(clients.in_use, 2)
+    with clients.reserve() as third:
+        nose.tools.ok_(third in (first, second))
+    stats = clients.stats()
+    nose.tools.eq_(stats['created'], 2)
+    nose.tools.eq_(stats['checkouts'], 3)
+    nose.tools.eq_(stats['timeouts'], 1)
+    nose.tools.eq_(stats['max_in_use'], 2)
+    nose.tools.eq_(stats['in_use'], 0)
+
+
+def test_thread_mapped_pool():
+    clients = pool.create_pool(FakeClient(), {"type": "thread_mapped"})
+    reserved = []
+
+    def worker():
+        with clients.reserve() as mc:
+            reserved.append(mc)
+        with clients.reserve() as mc:
+            reserved.append(mc)
+
+    threads = [threading.Thread(target=worker) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    nose.tools.eq_(len(set(reserved)), 3)
+    nose.tools.eq_(clients.stats()['size'], 3)
+
+
+def test_connection_pool():
+    conn = connection("pooled")
+    nose.tools.ok_(isinstance(conn.pool, pool.CheckoutPool))
+    errors = []
+
+    def worker(idx):
+        try:
+            for i in range(20):
+                conn.set("key%s" % idx, i)
+                nose.tools.eq_(conn.get("key%s" % idx), i)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    nose.tools.eq_(errors, [])
+    nose.tools.ok_(conn.pool.stats()['created'] <= 2)
+
+
+def test_loader_batch():
+    conn = connection("default")
+    client = conn.pool.client
+    conn.set_multi({"a": 1, "b": 2})
+    conn.set("c", 3, namespace="ns")
+    del client.calls[:]
+    loader = Loader(conn)
+    with loader.batch():
+        a = loader.load("a")
+        b = loader.load("b")
+        with loader.batch():
+            again = loader.load("a")
+            c = loader.load("c", namespace="ns")
+        missing = loader.load("x")
+        nose.tools.ok_(not a.done())
+    nose.tools.eq_(
+        [f.result() for f in (a, b, again, c, missing)], [1, 2, 1, 3, None]
+    )
+    nose.tools.eq_(len(client.calls), 2)
+    nose.tools.eq_(loader.stats(), {
+        'requests': 5, 'deduplicated': 1, 'batches': 2, 'pending': 0
+    })
+
+
+def test_loader_ioloop_tick():
+    conn = connection("default")
+    client = conn.pool.client
+    conn.set_multi({"a": 1, "b": 2})
+    del client.calls[:]
+    loader = Loader(conn)
+
+    @gen.coroutine
+    def first():
+        value = yield loader.load("a")
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def second():
+        values = yield loader.load_many(["b", "a"])
+        raise gen.Return(values)
+
+    @gen.coroutine
+    def run():
+        values = yield [first(), second()]
+        raise gen.Return(values)
+
+    nose.tools.eq_(IOLoop.current().run_sync(run), [1, [2, 1]])
+    nose.tools.eq_(client.calls, [('get_multi', client.calls[0][1])])
+    nose.tools.eq_(sorted(client.calls[0][1]), ["a", "b"])
+
+
+def test_write_buffer():
+    conn = connection("default")
+    client = conn.pool.client
+    conn.set_multi({"hits": 10, "misses": 10, "reset": 10})
+    del client.calls[:]
+    buf = WriteBuffer(conn, max_size=100, interval=60)
+    buf.set("last_seen", 1)
+    buf.set("last_seen", 2)
+    for i in range(5):
+        buf.incr("hits")
+        buf.incr("misses", 2)
+    buf.decr("misses", 10)
+    buf.incr("reset", 5)
+    buf.set("reset", 0)
+    buf.incr("reset", 3)
+    nose.tools.eq_(buf.depth, 5)
+    nose.tools.eq_(client.calls, [])
+    buf.flush()
+    nose.tools.eq_(conn.get(["last_seen", "hits", "misses", "reset"]), [2, 15, 10, 3])
+    nose.tools.eq_(
+        sorted(c[0] for c in client.calls), ["get_multi", "incr", "incr", "set_multi"]
+    )
+    nose.tools.eq_(buf.stats()['flushes'], 1)
+    nose.tools.eq_(buf.depth, 0)
+
+
+def test_write_buffer_missing_counter():
+    conn = connection("default")
+    conn.set_multi({"b": 10, "c": 10})
+    conn.delete("a")
+    buf = WriteBuffer(conn, max_size=100, interval=60)
+    for key in ("a", "b", "c"):
+        buf.incr(key)
+    buf.flush()
+    nose.tools.eq_(conn.get(["a", "b", "c"]), [None, 11, 11])
+
+
+def test_write_buffer_thresholds():
+    conn = connection("default")
+    client = conn.pool.client
+    buf = WriteBuffer(conn, max_size=2, interval=60)
+    buf.set("a", 1)
+    nose.tools.eq_(buf.depth, 1)
+    buf.set("b", 1)
+    nose.tools.eq_(buf.depth, 0)
+    buf.interval = 0
+    buf.set("c", 1)
+    nose.tools.eq_(buf.depth, 0)
+    nose.tools.eq_(buf.stats()['flushes'], 2)
+
+
+def test_write_buffer_handler_stop():
+    class Handler(services.Handler):
+        def start(self):
+            pass
+
+    conn = connection("default")
+    handler = Handler()
+    buf = WriteBuffer(conn, max_size=100, interval=60)
+    buf.attach(handler)
+    buf.set("on_stop", 1)
+    handler.run_stop_callbacks()
+    nose.tools.eq_(conn.get("on_stop"), 1)
+    handler.run_stop_callbacks()
+
+
+def test_get_missing():
+    conn = connection("default")
+    conn.set("none", None)
+    nose.tools.eq_(conn.get("none", default=cache.MISSING), None)
+    nose.tools.ok_(conn.get("absent", default=cache.MISSING) is cache.MISSING)
+    nose.tools.eq_(conn.get("absent"), None)
+    nose.tools.eq_(
+        conn.get(["none", "absent"], default=cache.MISSING),
+        [None, cache.MISSING]
+    )
+
+
+def test_cached_negative():
+    calls = []
+
+    @cache.cached(lambda pk: "entity:%s" % pk, conn_name="default", negative_ttl=5)
+    def get_entity(pk):
+        calls.append(pk)
+        return None
+
+    @cache.cached(lambda pk: "entity:%s" % pk, conn_name="default")
+    def get_entity_uncached(pk):
+        calls.append(pk)
+        return None
+
+    conn = cache.instance["default"]
+    client = conn.pool.client
+    nose.tools.eq_(get_entity(1), None)
+    nose.tools.eq_(get_entity(1), None)
+    nose.tools.eq_(calls, [1])
+    nose.tools.eq_(client.data["entity:1"][0], "null")
+    nose.tools.ok_(client.data["entity:1"][1] <= time.time() + 5)
+    nose.tools.eq_(get_entity_uncached(1), None)
+    nose.tools.eq_(calls, [1, 1])
+
+
+def test_cached_multi_negative():
+    calls = []
+
+    @cache.cached_multi("negative", conn_name="default", negative_ttl=5)
+    def get_items(ids):
+        calls.append(list(ids))
+        return [pk if pk % 2 else None for pk in ids]
+
+    nose.tools.eq_(get_items([1, 2, 3]), [1, None, 3])
+    nose.tools.eq_(get_items([1, 2, 3]), [1, None, 3])
+    nose.tools.eq_(calls, [[1, 2, 3]])
+    nose.tools.eq_(get_items(i for i in [3, 4]), [3, None])
+    nose.tools.eq_(calls, [[1, 2, 3], [4]])
+
+
+def test_mutex_owner_token():
+    first = cache.Mutex("default", "job", "mutex", ttl=10)
+    second = cache.Mutex("default", "job", "mutex", ttl=10)
+    nose.tools.ok_(first.lock())
+    nose.tools.ok_(not second.lock())
+    nose.tools.ok_(not second.release())
+    nose.tools.ok_(first.owned())
+    # блокировка истекла и захвачена другим владельцем
+    cache.instance["default"].delete("job", namespace="mutex")
+    nose.tools.ok_(second.lock())
+    nose.tools.ok_(not first.update())
+    nose.tools.ok_(not first.release())
+    nose.tools.ok_(second.owned())
+    nose.tools.ok_(second.release())
+    nose.tools.ok_(not second.owned(second.token))
+
+
+def test_mutex_acquire_timeout():
+    holder = cache.Mutex("default", "timeout", "mutex", ttl=10)
+    waiter = cache.Mutex("default", "timeout", "mutex", backoff=0.005)
+    stats = cache.Mutex.stats()
+    nose.tools.ok_(holder.acquire())
+    started = time.time()
+    nose.tools.ok_(not waiter.acquire(timeout=0.05))
+    nose.tools.ok_(0.05 <= time.time() - started < 0.5)
+
+    timer = threading.Timer(0.05, holder.release)
+    timer.start()
+    nose.tools.ok_(waiter.acquire(timeout=2))
+    timer.join()
+    waiter.release()
+
+    current = cache.Mutex.stats()
+    nose.tools.eq_(current['acquired'] - stats['acquired'], 2)
+    nose.tools.eq_(current['contended'] - stats['contended'], 2)
+    nose.tools.eq_(current['timeouts'] - stats['timeouts'], 1)
+    nose.tools.ok_(current['wait_time'] - stats['wait_time'] >= 0.1)
+
+
+def test_mutex_context_renewal():
+    conn = cache.instance["default"]
+    with cache.Mutex("default", "renew", "mutex", ttl=0.06, renew=True) as mutex:
+        time.sleep(0.15)
+        nose.tools.ok_(mutex.owned())
+        with nose.tools.assert_raises(cache.MutexException):
+            with cache.Mutex("default", "renew", "mutex", timeout=0.01):
+                pass
+    nose.tools.eq_(conn.get("renew", namespace="mutex"), None)
+    nose.tools.ok_(cache.Mutex.stats()['renewals'] >= 2)
+
+
+def test_mutex_server_error():
+    mutex = cache.Mutex("default", "down", "mutex")
+    mutex.cache = connection("default")
+    client = mutex.cache.pool.client
+
+    def fail(*args, **kwargs):
+        raise pylibmc.ServerDown("down")
+
+    client.add = fail
+    started = time.time()
+    nose.tools.ok_(not mutex.acquire())
+    nose.tools.ok_(time.time() - started < 0.5)
+    with nose.tools.assert_raises(cache.MutexException):
+        with mutex:
+            pass
+
+
+def test_mutex_release_cas():
+    conn = connection("locks")
+    first = cache.Mutex("default", "cas", "mutex", ttl=10)
+    first.cache = conn
+    nose.tools.ok_(first.lock())
+    client = conn.pool.client
+    gets = client.gets
+
+    def steal(key):
+        # блокировка истекает и захватывается другим владельцем
+        # между чтением и удалением
+        value = gets(key)
+        client.data.pop(key)
+        client.add(key, conn.dumps("other"))
+        return value
+
+    client.gets = steal
+    nose.tools.ok_(not first.release())
+    client.gets = gets
+    nose.tools.eq_(conn.get("cas", namespace="mutex"), "other")
+
+
+def test_mutex_renewal_client():
+    conn = connection("locks")
+    mutex = cache.Mutex("default", "clone", "mutex", ttl=0.03, renew=True)
+    mutex.cache = conn
+    clones = []
+    clone = conn.pool.client.clone
+
+    def tracked():
+        clones.append(clone())
+        return clones[-1]
+
+    conn.pool.client.clone = tracked
+    nose.tools.ok_(mutex.acquire())
+    time.sleep(0.05)
+    nose.tools.ok_(mutex.owned())
+    nose.tools.eq_(len(clones), 1)
+    nose.tools.ok_(('cas', conn.normalise_key("mutex", "clone")) in clones[0].calls)
+    nose.tools.ok_(mutex.release())
+
+
+def test_update_cas():
+    conn = connection("default")
+    client = conn.pool.client
+    result = conn.update("list", lambda v: (v or []) + [1])
+    nose.tools.eq_(result, cache.UpdateResult(True, [1], 0))
+    nose.tools.eq_(conn.update("list", lambda v: v + [2]).value, [1, 2])
+
+    def concurrent(value):
+        # значение изменено другим клиентом между gets и cas
+        if len(value) < 4:
+            client.set("list", codecs.json.dumps(value + ["other"]))
+        return value + [3]
+
+    result = conn.update("list", concurrent)
+    nose.tools.eq_(result.ok, True)
+    nose.tools.eq_(result.retries, 2)
+    nose.tools.eq_(conn.get("list"), [1, 2, "other", "other", 3])
+    nose.tools.eq_(conn.update_stats, {'updates': 3, 'retries': 2, 'failures': 0})
+
+    def conflict(value):
+        client.set("list", codecs.json.dumps([]))
+        return value
+
+    result = conn.update("list", conflict, retries=1)
+    nose.tools.eq_(result, cache.UpdateResult(False, None, 1))
+    nose.tools.eq_(conn.update_stats['failures'], 1)
+
+
+def test_hash_ring():
+    hosts = ["10.0.0.%d:11211" % i for i in range(1, 5)]
+    keys = ["key:%d" % i for i in range(2000)]
+    before = ring.HashRing(hosts)
+    after = ring.HashRing(hosts + ["10.0.0.5:11211"])
+    moved = [k for k in keys if before.get_node(k) != after.get_node(k)]
+    nose.tools.ok_(len(moved) < len(keys) * 0.35)
+    nose.tools.ok_(all(after.get_node(k) == "10.0.0.5:11211" for k in moved))
+
+    weighted = ring.HashRing(hosts, weights={hosts[0]: 3})
+    counts = dict((h, 0) for h in hosts)
+    for k in keys:
+        counts[weighted.get_node(k)] += 1
+    nose.tools.ok_(counts[hosts[0]] > max(counts[h] for h in hosts[1:]))
+
+    nodes = before.get_nodes("key:1", 3)
+    nose.tools.eq_(len(set(nodes)), 3)
+    nose.tools.eq_(nodes[0], before.get_node("key:1"))
+
+
+def test_ring_hot_key_replication():
+    conn = cache.instance["ring"]
+    client = conn.pool.client
+    conn.set("hot", "value")
+    conn.set("cold", "value")
+    primary, replica = client.ring.get_nodes("hot", 2)
+    nose.tools.ok_("hot" in client.clients[primary].data)
+    nose.tools.ok_("hot" not in client.clients[replica].data)
+
+    client.hot_keys.window = 0.05
+    for _ in xrange(50):
+        nose.tools.eq_(conn.get("hot"), "value")
+    time.sleep(0.06)
+    conn.get("hot")
+    nose.tools.eq_(client.hot_keys.hot(), ["hot"])
+    nose.tools.ok_(client.hot_keys.is_hot("hot"))
+
+    for _ in xrange(20):
+        nose.tools.eq_(conn.get("hot"), "value")
+    # копия появилась на реплике при чтении
+    nose.tools.ok_("hot" in client.clients[replica].data)
+
+    conn.set("hot", "other")
+    nose.tools.eq_(client.clients[replica].data["hot"][0], '"other"')
+    nose.tools.eq_(conn.get(["hot", "cold"]), ["other", "value"])
+    conn.delete("hot")
+    nose.tools.ok_("hot" not in client.clients[replica].data)
+    nose.tools.ok_("hot" not in client.clients[primary].data)
+
+
+def test_space_saving():
+    counter = sampler.SpaceSaving(capacity=3)
+    for key in ["a"] * 10 + ["b"] * 5 + ["c", "d", "e", "f"]:
+        counter.offer(key)
+    top = counter.top(2)
+    nose.tools.eq_(top[0], ("a", 10, 0))
+    nose.tools.eq_(top[1], ("b", 5, 0))
+    nose.tools.eq_(len(counter.counters), 3)
+
+
+def test_connection_sampler():
+    conn = cache.instance["sampled"]
+    conn.set("big", "x" * 100, namespace="catalog")
+    for _ in xrange(5):
+        conn.get("hot", namespace="catalog")
+    conn.get("cold", namespace="catalog")
+    conn.get_many(["hot", "big"], namespace="catalog")
+    conn.incr("counter")
+
+    nose.tools.eq_(
+        conn.sampler.top("catalog", "reads"), [("hot", 6), ("big", 1)]
+    )
+    nose.tools.eq_(conn.sampler.top("catalog", "writes"), [("big", 1)])
+    nose.tools.eq_(conn.sampler.top("catalog", "bytes"), [("big", 204)])
+    nose.tools.eq_(conn.sampler.top(None, "writes"), [("counter", 1)])
+    nose.tools.eq_(
+        cache.hot_keys("sampled")["sampled"]["catalog"]["reads"][0],
+        ("hot", 6)
+    )
+
+    class FakeProfiler(object):
+        metrics = []
+
+        def append(self, name, value):
+            self.metrics.append((name, value))
+
+        def flush(self):
+            pass
+
+    profiler = FakeProfiler()
+    conn.sampler.flush(profiler)
+    nose.tools.ok_(("catalog.reads.hot", 6) in profiler.metrics)
+    nose.tools.ok_(("default.writes.counter", 1) in profiler.metrics)
+    nose.tools.eq_(conn.sampler.report(), {})
+
+
+def test_histogram():
+    histogram = cache.metrics.Histogram((1, 10, 100))
+    for value in [0.5] * 90 + [50] * 9 + [500]:
+        histogram.add(value)
+    nose.tools.eq_(histogram.percentile(50), 1)
+    nose.tools.eq_(histogram.percentile(99), 100)
+    nose.tools.eq_(histogram.percentile(100), 500)
+    nose.tools.eq_(histogram.report()['buckets'], {
+        'le_1': 90, 'le_100': 9, 'le_inf': 1
+    })
+
+
+def test_connection_metrics():
+    conn = connection("default")
+    conn.set("a", "x" * 10, namespace="catalog")
+    conn.get("a", namespace="catalog")
+    conn.get("b", namespace="catalog")
+    conn.get_many(["a", "b", "c"], namespace="catalog")
+    conn.incr("counter")
+    conn.pool.client.get = None
+    conn.get("a", namespace="catalog")
+
+    report = conn.metrics.report()
+    catalog = report["catalog"]
+    nose.tools.eq_(catalog["hits"], 2)
+    nose.tools.eq_(catalog["misses"], 3)
+    nose.tools.eq_(catalog["errors"], 1)
+    nose.tools.eq_(catalog["hit_ratio"], 0.4)
+    nose.tools.eq_(catalog["operations"], {'set': 1, 'get': 3, 'get_many': 1})
+    nose.tools.eq_(catalog["size"]["count"], 3)
+    nose.tools.eq_(catalog["size"]["max"], 12)
+    nose.tools.eq_(catalog["latency"]["count"], 5)
+    nose.tools.eq_(report["default"]["operations"], {'incr': 1})
+
+    class FakeProfiler(object):
+        def __init__(self):
+            self.metrics = {}
+
+        def append(self, name, value):
+            self.metrics[name] = value
+
+    profiler = FakeProfiler()
+    conn.metrics.flush(profiler, "cache.default")
+    nose.tools.eq_(profiler.metrics["cache.default.catalog.hits.sum"], 2)
+    nose.tools.eq_(profiler.metrics["cache.default.catalog.bytes.sum"], 36)
+    nose.tools.eq_(profiler.metrics["cache.default.default.incr.sum"], 1)
+    nose.tools.eq_(conn.metrics.report(), {})
+
+
+def test_metrics_report_callback():
+    class Handler(services.Handler):
+        def report(self):
+            return {'status': 1}
+
+    handler = Handler()
+    cache.instance["default"].get("metrics", namespace="reported")
+    handler.add_report_callback('cache', cache.metrics_report)
+    report = handler.collect_report()
+    nose.tools.eq_(report['status'], 1)
+    nose.tools.eq_(report['cache']['default']['reported']['misses'], 1)
+
+
+def test_circuit_breaker():
+    def fail(*args, **kwargs):
+        raise pylibmc.ConnectionError("connection failure")
+
+    protected = breaker.BreakerPool(
+        pool.SinglePool(FakeClient()), "test", threshold=2, cooldown=0.05
+    )
+    probes = []
+    protected.breaker.probe = lambda: probes.append(1) or fail()
+    protected.client.get = fail
+    for _ in xrange(2):
+        with nose.tools.assert_raises(pylibmc.ConnectionError):
+            with protected.reserve() as mc:
+                mc.get("a")
+    nose.tools.eq_(protected.breaker.state, breaker.OPEN)
+    with nose.tools.assert_raises(breaker.CircuitOpen):
+        with protected.reserve() as mc:
+            pass
+    time.sleep(0.08)
+    nose.tools.ok_(probes)
+    nose.tools.eq_(protected.breaker.state, breaker.OPEN)
+
+    protected.breaker.probe = lambda: None
+    time.sleep(0.08)
+    nose.tools.eq_(protected.breaker.state, breaker.CLOSED)
+    # ошибки, не связанные с доступностью сервера, не учитываются
+    with nose.tools.assert_raises(pylibmc.NotFound):
+        with protected.reserve() as mc:
+            raise pylibmc.NotFound("a")
+    nose.tools.eq_(protected.breaker.failures, 0)
+    nose.tools.eq_(protected.breaker.stats()['opened'], 1)
+
+
+def test_connection_failover():
+    def fail(*args, **kwargs):
+        raise pylibmc.ConnectionError("connection failure")
+
+    conn = cache.instance["breaker"]
+    primary, secondary = conn.pool.primary, conn.pool.secondary
+    primary.breaker.probe = fail
+    primary.client.get = fail
+    secondary.client.set("a", '"secondary"')
+    nose.tools.eq_(conn.get("a"), None)
+    nose.tools.eq_(conn.get("a"), None)
+    nose.tools.eq_(primary.breaker.state, breaker.OPEN)
+    nose.tools.eq_(conn.get("a"), "secondary")
+    nose.tools.eq_(conn.pool.stats()['failovers'], 1)
+
+    secondary.breaker.state = breaker.OPEN
+    started = time.time()
+    nose.tools.eq_(conn.get("a", default=cache.MISSING), cache.MISSING)
+    nose.tools.ok_(time.time() - started < 0.05)
+    secondary.breaker.state = breaker.CLOSED
+    primary.breaker.probe = lambda: None
+    time.sleep(0.08)
+    nose.tools.eq_(primary.breaker.state, breaker.CLOSED)
+
+
+def test_rate_limited_log():
+    records = []
+
+    class Collector(logging.Handler):
+        def emit(self, record):
+            if record.msg.startswith("fail at"):
+                records.append(record)
+
+    collector = Collector()
+    logging.getLogger().addHandler(collector)
+    try:
+        log = breaker.RateLimitedLog(interval=0.05)
+        for _ in xrange(3):
+            try:
+                raise ValueError()
+            except ValueError:
+                log.exception("fail at %s", "host")
+        time.sleep(0.06)
+        try:
+            raise breaker.CircuitOpen("host")
+        except breaker.CircuitOpen:
+            log.exception("fail at %s", "host")
+    finally:
+        logging.getLogger().removeHandler(collector)
+    nose.tools.eq_(len(records), 2)
+    nose.tools.ok_(records[0].exc_info)
+    nose.tools.eq_(
+        records[1].getMessage(),
+        "fail at host (2 similar messages suppressed): circuit open"
+    )
+    nose.tools.ok_(not records[1].exc_info)
+    nose.tools.eq_(connection("default").log.interval, breaker.LOG_INTERVAL)
+
+
+def test_chunked_values():
+    conn = cache.instance["large"]
+    client = conn.pool.client
+    value = {"report": "x" * 40}
+    nose.tools.ok_(conn.set("report", value, ttl=30))
+    manifest = client.data["report"][0]
+    nose.tools.ok_(cache.chunks.is_manifest(manifest))
+    parts = cache.chunks.chunk_keys("report", manifest)
+    nose.tools.eq_(len(parts), 4)
+    nose.tools.eq_(client.calls[-1], ('set_multi', sorted(parts + ["report"])))
+    for k in parts:
+        nose.tools.ok_(abs(client.data[k][1] - client.data["report"][1]) < 0.01)
+
+    del client.calls[:]
+    nose.tools.eq_(conn.get("report"), value)
+    nose.tools.eq_(client.calls, [('get', 'report'), ('get_multi', parts)])
+    conn.set("small", 1)
+    nose.tools.eq_(conn.get_many(["report", "small"])[0], {
+        "report": value, "small": 1
+    })
+    conn.set_multi({"a": value, "b": 2})
+    nose.tools.eq_(conn.get(["a", "b"]), [value, 2])
+
+    # часть значения перезаписана другой записью
+    client.data[parts[1]] = ("y" * 16, client.data[parts[1]][1])
+    nose.tools.eq_(conn.get("report", default=cache.MISSING), cache.MISSING)
+    del client.data[parts[2]]
+    nose.tools.eq_(conn.get_many(["report"])[0], {})
+
+
+def test_warmup_snapshot():
+    calls = []
+
+    @cache.cached(lambda pk, lang="en": "page:%s:%s" % (pk, lang), conn_name="warm")
+    def get_page(pk, lang="en"):
+        calls.append((pk, lang))
+        return {"id": pk, "lang": lang}
+
+    conn = cache.instance["warm"]
+    get_page(1)
+    get_page(2, lang="ru")
+    get_page(2, lang="ru")
+    get_page(object())
+    conn.get("hot", namespace="catalog")
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        warmup.save("warm", path)
+        snapshot = warmup.load(path)
+        nose.tools.eq_(snapshot["calls"][0][1:], [[2], {"lang": "ru"}])
+        nose.tools.eq_(len(snapshot["calls"]), 2)
+        nose.tools.ok_("hot" in snapshot["keys"]["catalog"])
+
+        # кеш после перезапуска пуст
+        conn.pool.client.data.clear()
+        del calls[:]
+        source = cache.instance["default"]
+        source.set("hot", "value", namespace="catalog", tags=["goods"])
+        stats = warmup.warm("warm", path, source="default", parallelism=2)
+        nose.tools.eq_(stats, {
+            'calls': 2, 'skipped': 0, 'copied': 1, 'errors': 0
+        })
+        nose.tools.eq_(sorted(calls), [(1, "en"), (2, "ru")])
+        nose.tools.eq_(conn.get("page:2:ru"), {"id": 2, "lang": "ru"})
+        nose.tools.eq_(conn.get("hot", namespace="catalog"), "value")
+        key = conn.normalise_key("catalog", "hot")
+        nose.tools.ok_(
+            conn.pool.client.data[key][1] - time.time() <= conn.config.ttl
+        )
+        conn.invalidate_tags(["goods"])
+        nose.tools.eq_(conn.get("hot", namespace="catalog"), None)
+
+        with open(path, "wb") as fp:
+            fp.write("broken")
+        nose.tools.eq_(warmup.warm("warm", path)["calls"], 0)
+    finally:
+        os.unlink(path)
+    nose.tools.eq_(warmup.warm("warm", path)["calls"], 0)
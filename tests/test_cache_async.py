@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import nose.tools
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+from gentoolkit import cache
+from gentoolkit import config
+from gentoolkit.cache import asynchronous
+from gentoolkit.cache import chunks
+
+
+def setup():
+    config.init({
+        "cache": {
+            "default": {
+                "host": ["127.0.0.1:11211"],
+                "ttl": 60
+            }
+        }
+    })
+
+
+def teardown():
+    config.instance.reset()
+    asynchronous.instance.__dict__.clear()
+
+
+def stream_pair():
+    client, server = socket.socketpair()
+    return IOStream(client), IOStream(server)
+
+
+@gen.coroutine
+def expect(stream, data):
+    received = yield stream.read_bytes(len(data))
+    nose.tools.eq_(received, data)
+
+
+def test_pipelining():
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        client = asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)
+        requests = [
+            client.request("get a b\r\n", asynchronous.parse_values),
+            client.request(
+                asynchronous.storage_command("set", "b", "1", 10),
+                asynchronous.parse_status),
+            client.request("incr c 2\r\n", asynchronous.parse_counter),
+            client.request("incr d 2\r\n", asynchronous.parse_counter),
+        ]
+        # all commands are sent before any response
+        yield expect(
+            server,
+            "get a b\r\nset b 0 10 1\r\n1\r\nincr c 2\r\nincr d 2\r\n"
+        )
+        yield server.write(
+            "VALUE a 0 2 7\r\n10\r\nEND\r\nSTORED\r\n5\r\nNOT_FOUND\r\n")
+        responses = yield requests
+        raise gen.Return(responses)
+
+    responses = IOLoop.current().run_sync(run)
+    nose.tools.eq_(responses, [{"a": ("10", 0, 7)}, "STORED", 5, None])
+
+
+def test_server_error():
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        client = asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)
+        failed = client.request("bad\r\n", asynchronous.parse_status)
+        succeeded = client.request("get a\r\n", asynchronous.parse_values)
+        yield server.write("ERROR\r\nEND\r\n")
+        with nose.tools.assert_raises(asynchronous.MemcacheError):
+            yield failed
+        value = yield succeeded
+        raise gen.Return(value)
+
+    nose.tools.eq_(IOLoop.current().run_sync(run), {})
+
+
+def test_connection():
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        conn = asynchronous.instance["default"]
+        conn.clients = [asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)]
+        stored = conn.set("key", {"a": 1})
+        yield expect(server, 'set key 0 60 8\r\n{"a": 1}\r\n')
+        yield server.write("STORED\r\n")
+        nose.tools.ok_((yield stored))
+
+        found = conn.get_many(["key", "other"], namespace="ns")
+        yield expect(server, "get ns:")
+        yield server.read_until("\r\n")
+        yield server.write('VALUE ns:key 0 8\r\n{"a": 1}\r\nEND\r\n')
+        found = yield found
+        nose.tools.eq_(found, ({"key": {"a": 1}}, set(["other"])))
+
+        added = conn.add("key", 2)
+        yield expect(server, "add key 0 60 1\r\n2\r\n")
+        yield server.write("NOT_STORED\r\n")
+        nose.tools.ok_(not (yield added))
+
+    IOLoop.current().run_sync(run)
+
+
+def test_chunked_value_miss():
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        conn = asynchronous.instance["default"]
+        conn.clients = [asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)]
+        manifest, _ = chunks.split("big", "x" * 10, chunk_size=4)
+        response = "VALUE big 0 %d\r\n%s\r\nEND\r\n" % (
+            len(manifest), manifest
+        )
+
+        value = conn.get("big", default="missing")
+        yield server.read_until("\r\n")
+        yield server.write(response)
+        nose.tools.eq_((yield value), "missing")
+
+        found = conn.get_many(["big"])
+        yield server.read_until("\r\n")
+        yield server.write(response)
+        nose.tools.eq_((yield found), ({}, set(["big"])))
+
+    IOLoop.current().run_sync(run)
+
+
+def test_tagged_value_miss():
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        conn = asynchronous.instance["default"]
+        conn.clients = [asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)]
+        data = conn.dumps({cache.TAGS_KEY: {"goods": 1}, "value": 1})
+        response = "VALUE tagged 0 %d\r\n%s\r\nEND\r\n" % (len(data), data)
+
+        value = conn.get("tagged")
+        yield server.read_until("\r\n")
+        yield server.write(response)
+        nose.tools.eq_((yield value), None)
+
+        found = conn.get_many(["tagged"])
+        yield server.read_until("\r\n")
+        yield server.write(response)
+        nose.tools.eq_((yield found), ({}, set(["tagged"])))
+
+    IOLoop.current().run_sync(run)
+
+
+def test_cached_async():
+    calls = []
+
+    @asynchronous.cached_async("product", conn_name="default")
+    @gen.coroutine
+    def get_product():
+        calls.append(1)
+        raise gen.Return({"id": 1})
+
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        conn = asynchronous.instance["default"]
+        conn.clients = [asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)]
+        result = get_product()
+        yield expect(server, "get product\r\n")
+        yield server.write("END\r\n")
+        yield expect(server, 'set product 0 60 9\r\n{"id": 1}\r\n')
+        yield server.write("STORED\r\n")
+        nose.tools.eq_((yield result), {"id": 1})
+
+        result = get_product()
+        yield expect(server, "get product\r\n")
+        yield server.write('VALUE product 0 9\r\n{"id": 1}\r\nEND\r\n')
+        nose.tools.eq_((yield result), {"id": 1})
+
+    IOLoop.current().run_sync(run)
+    nose.tools.eq_(calls, [1])
+
+
+def test_cached_coroutine_dedupe():
+    calls = []
+
+    @cache.cached(lambda pk: "product:%s" % pk, conn_name="default")
+    @gen.coroutine
+    def get_product(pk):
+        calls.append(pk)
+        yield gen.moment
+        raise gen.Return({"id": pk})
+
+    @gen.coroutine
+    def run():
+        client_stream, server = stream_pair()
+        conn = asynchronous.instance["default"]
+        conn.clients = [asynchronous.StreamClient(
+            "127.0.0.1", 11211, stream=client_stream)]
+        results = [get_product(1) for _ in xrange(50)]
+        yield expect(server, "get product:1\r\n")
+        yield server.write("END\r\n")
+        yield expect(server, 'set product:1 0 60 9\r\n{"id": 1}\r\n')
+        yield server.write("STORED\r\n")
+        values = yield results
+        nose.tools.eq_(values, [{"id": 1}] * 50)
+        nose.tools.eq_(asynchronous._in_flight, {})
+
+    IOLoop.current().run_sync(run)
+    nose.tools.eq_(calls, [1])
+
+
+def test_cached_coroutine_options():
+    with nose.tools.assert_raises(ValueError):
+        @cache.cached("product", lock=True)
+        @gen.coroutine
+        def get_product():
+            pass
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import nose.tools
+import pylibmc
+from tornado.ioloop import IOLoop
+
+from gentoolkit import cache
+from gentoolkit import config
+from gentoolkit.cache import asynchronous
+from gentoolkit.cache import benchmark
+from gentoolkit.cache.server import LocalServer, Storage
+
+
+server = LocalServer(max_bytes=1 << 20)
+
+
+def setup():
+    server.start()
+
+
+def teardown():
+    server.stop()
+
+
+def client():
+    return pylibmc.Client([server.address], behaviors={"cas": True})
+
+
+def raw(command):
+    sock = socket.create_connection((server.host, server.port))
+    try:
+        sock.sendall(command)
+        sock.settimeout(1)
+        return sock.recv(4096)
+    finally:
+        sock.close()
+
+
+def test_storage_lru():
+    storage = Storage(max_bytes=250)
+    storage.set("a", "x" * 50)
+    storage.set("b", "x" * 50)
+    storage.get("a")
+    storage.set("c", "x" * 50)
+    nose.tools.eq_(storage.get("b"), None)
+    nose.tools.eq_(storage.get("a")[0], "x" * 50)
+    nose.tools.eq_(storage.evictions, 1)
+    nose.tools.ok_(storage.size <= 250)
+    nose.tools.ok_(not storage.set("big", "x" * 250))
+
+
+def test_storage_expiry_and_counters():
+    storage = Storage()
+    storage.set("short", "1", ttl=-1)
+    nose.tools.eq_(storage.get("short"), None)
+    storage.set("counter", "5")
+    nose.tools.eq_(storage.incr("counter", 3), 8)
+    nose.tools.eq_(storage.incr("counter", -10), 0)
+    nose.tools.eq_(storage.incr("absent", 1), None)
+    storage.set("text", "abc")
+    with nose.tools.assert_raises(ValueError):
+        storage.incr("text", 1)
+    cas = storage.get("counter")[3]
+    nose.tools.eq_(storage.cas("counter", "1", 0, 0, cas + 1), "EXISTS")
+    nose.tools.eq_(storage.cas("counter", "1", 0, 0, cas), "STORED")
+    nose.tools.eq_(storage.cas("absent", "1", 0, 0, cas), "NOT_FOUND")
+
+
+def test_pylibmc_commands():
+    mc = client()
+    nose.tools.ok_(mc.set("key", "value", time=60))
+    nose.tools.eq_(mc.get("key"), "value")
+    nose.tools.ok_(not mc.add("key", "other"))
+    nose.tools.ok_(mc.add("new", {"a": 1}))
+    nose.tools.eq_(mc.get("new"), {"a": 1})
+    nose.tools.eq_(mc.get_multi(["key", "new", "absent"]), {
+        "key": "value", "new": {"a": 1}
+    })
+
+    value, cas = mc.gets("key")
+    nose.tools.eq_(value, "value")
+    nose.tools.ok_(mc.cas("key", "updated", cas))
+    nose.tools.ok_(not mc.cas("key", "stale", cas))
+    nose.tools.eq_(mc.get("key"), "updated")
+
+    mc.set("counter", "10")
+    nose.tools.eq_(mc.incr("counter", 5), 15)
+    nose.tools.eq_(mc.decr("counter", 20), 0)
+    with nose.tools.assert_raises(pylibmc.NotFound):
+        mc.incr("absent")
+
+    nose.tools.ok_(mc.delete("key"))
+    nose.tools.ok_(not mc.delete("key"))
+    nose.tools.eq_(mc.get("key"), None)
+
+
+def test_protocol_errors():
+    nose.tools.eq_(raw("unknown\r\n"), "ERROR\r\n")
+    nose.tools.eq_(
+        raw("set key 0 0\r\n"), "CLIENT_ERROR bad command line format\r\n"
+    )
+    nose.tools.eq_(raw("set key 0 0 1 noreply\r\n1\r\nget key\r\n"),
+                   "VALUE key 0 1\r\n1\r\nEND\r\n")
+    nose.tools.ok_(raw("version\r\n").startswith("VERSION "))
+    nose.tools.ok_("STAT curr_items" in raw("stats\r\n"))
+
+
+def test_benchmark():
+    results = benchmark.run(keys=20, batch=5, hosts=[server.address])
+    nose.tools.eq_(
+        [name for name, _ in results], list(benchmark.SCENARIOS)
+    )
+    for name, result in results:
+        nose.tools.ok_(result["ops"] > 0)
+    nose.tools.ok_(benchmark.format_results(results).startswith("scenario"))
+
+
+def test_mutex_without_cas():
+    config.init({
+        "cache": {"server": {"host": [server.address], "ttl": 60}}
+    })
+    try:
+        first = cache.Mutex("server", "job", "mutex", ttl=10)
+        second = cache.Mutex("server", "job", "mutex", ttl=10)
+        nose.tools.ok_(first.lock())
+        nose.tools.ok_(not second.lock())
+        nose.tools.ok_(first.update())
+        nose.tools.ok_(first.release())
+        nose.tools.ok_(second.lock())
+        nose.tools.ok_(not first.release())
+        nose.tools.ok_(second.release())
+    finally:
+        cache.instance.__dict__.clear()
+        config.instance.reset()
+
+
+def test_async_namespace_generations():
+    settings = {
+        "host": [server.address],
+        "ttl": 60,
+        "namespace_generations": True,
+        "generation_ttl": 0
+    }
+    config.init({"cache": {"server": settings}})
+    try:
+        conn = cache.instance["server"]
+        aconn = asynchronous.instance["server"]
+        run = IOLoop.current().run_sync
+        nose.tools.ok_(conn.set("key", 1, namespace="gen"))
+        nose.tools.eq_(run(lambda: aconn.get("key", namespace="gen")), 1)
+        nose.tools.ok_(conn.invalidate_namespace("gen"))
+        nose.tools.eq_(run(lambda: aconn.get("key", namespace="gen")), None)
+        nose.tools.ok_(run(lambda: aconn.set("key", 2, namespace="gen")))
+        nose.tools.eq_(conn.get("key", namespace="gen"), 2)
+    finally:
+        cache.instance.__dict__.clear()
+        asynchronous.instance.__dict__.clear()
+        config.instance.reset()
+
+
+def test_async_ring_distribution():
+    second = LocalServer()
+    second.start()
+    hosts = [server.address, second.address]
+    config.init({
+        "cache": {
+            "ring": {"host": hosts, "ttl": 60, "ring": {"points": 40}},
+            "modula": {"host": hosts, "ttl": 60}
+        }
+    })
+    try:
+        conn = cache.instance["ring"]
+        aconn = asynchronous.instance["ring"]
+        keys = ["key%d" % idx for idx in xrange(20)]
+        nose.tools.ok_(conn.set_multi(dict((k, k) for k in keys)))
+        found, missed = IOLoop.current().run_sync(
+            lambda: aconn.get_many(keys)
+        )
+        nose.tools.eq_(missed, set())
+        nose.tools.eq_(found, dict((k, k) for k in keys))
+        nose.tools.ok_(second.server.storage.size > 0)
+        with nose.tools.assert_raises(ValueError):
+            asynchronous.AsyncConnection(
+                config.Proxy({"params": {}, "ttl": 60}, "cache.modula")
+            )
+    finally:
+        second.stop()
+        cache.instance.__dict__.clear()
+        asynchronous.instance.__dict__.clear()
+        config.instance.reset()